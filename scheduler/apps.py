@@ -0,0 +1,25 @@
+from django.apps import AppConfig
+from django.db.models.signals import post_migrate
+
+
+def interleave_failure_ids(sender, using, **kwargs):
+    """
+    Keeps the ids of schedule failures unique across the shards, every time
+    that one of them is migrated.
+    """
+    from .models import ScheduleFailure
+    from .shards import interleave_ids
+
+    interleave_ids(ScheduleFailure._meta.db_table, using)
+
+
+class SchedulerConfig(AppConfig):
+    name = "scheduler"
+
+    def ready(self):
+        # Connects the receivers that invalidate the authentication and
+        # hook caches, the ones that profile tasks and track their memory,
+        # and the one that preloads the worker
+        from . import authentication, hooks, memory, preload, profiling  # noqa
+
+        post_migrate.connect(interleave_failure_ids, sender=self)
@@ -0,0 +1,195 @@
+import uuid
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connections, transaction
+from django.utils.timezone import now
+from rest_framework.fields import BooleanField
+
+from .definitions import DefinitionCache
+from .models import Schedule, ScheduleArchive, ScheduleFailure
+from .shards import group_by_shard, shards
+
+# Has the same columns as the schedule table, along with when each schedule
+# was archived, so migrations that add columns to the schedule table add them
+# to the archive too
+ARCHIVE_TABLE = ScheduleArchive._meta.db_table
+
+# The references to celery definitions, which may have been cleaned up while
+# the schedules were archived
+DEFINITION_COLUMNS = ("celery_cron_definition_id", "celery_interval_definition_id")
+
+
+def enables(data):
+    """
+    Returns whether the data for an update enables the schedule.
+    """
+    if not isinstance(data, dict):
+        return False
+    value = data.get("enabled")
+    return isinstance(value, (bool, int, str)) and value in BooleanField.TRUE_VALUES
+
+
+def archive_batch(using, cutoff, batch_size):
+    """
+    Moves up to `batch_size` of the schedules that were disabled and last
+    changed before `cutoff` into the archive, and returns the number moved.
+    Their failures are deleted, since they can't be requeued any more.
+    """
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    columns = ", ".join(qn(field.column) for field in Schedule._meta.concrete_fields)
+    with transaction.atomic(using=using), connection.cursor() as cursor:
+        cursor.execute(
+            "WITH moved AS (DELETE FROM {table} WHERE id IN ("
+            "SELECT id FROM {table} WHERE NOT enabled AND updated_at < %s "
+            "ORDER BY updated_at LIMIT %s FOR UPDATE SKIP LOCKED"
+            ") RETURNING *), "
+            "failures AS (DELETE FROM {failures} "
+            "WHERE schedule_id IN (SELECT id FROM moved)) "
+            "INSERT INTO {archive} ({columns}, archived_at) "
+            "SELECT {columns}, %s FROM moved".format(
+                table=qn(Schedule._meta.db_table),
+                failures=qn(ScheduleFailure._meta.db_table),
+                archive=qn(ARCHIVE_TABLE),
+                columns=columns,
+            ),
+            [cutoff, batch_size, now()],
+        )
+        return cursor.rowcount
+
+
+def archive_schedules():
+    """
+    Moves the schedules that have been disabled, and not changed, for
+    longer than SCHEDULER_ARCHIVE_AFTER_DAYS into the archive on each shard,
+    in batches of SCHEDULER_BULK_BATCH_SIZE. Returns the number archived.
+    """
+    if not settings.SCHEDULER_ARCHIVE_AFTER_DAYS:
+        return 0
+    cutoff = now() - timedelta(days=settings.SCHEDULER_ARCHIVE_AFTER_DAYS)
+    archived = 0
+    for alias in shards():
+        while True:
+            moved = archive_batch(alias, cutoff, settings.SCHEDULER_BULK_BATCH_SIZE)
+            archived += moved
+            if moved < settings.SCHEDULER_BULK_BATCH_SIZE:
+                break
+    return archived
+
+
+def archived_ids(using, ids):
+    """
+    Returns the ids of the archived schedules on a shard out of `ids`.
+    """
+    connection = connections[using]
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT id FROM {archive} WHERE id = ANY(%s)".format(
+                archive=connection.ops.quote_name(ARCHIVE_TABLE)
+            ),
+            [list(ids)],
+        )
+        return set(schedule_id for schedule_id, in cursor.fetchall())
+
+
+def delete_archived(using, ids):
+    """
+    Deletes the archived schedules on a shard with the given ids, and
+    returns the number deleted.
+    """
+    connection = connections[using]
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "DELETE FROM {archive} WHERE id = ANY(%s)".format(
+                archive=connection.ops.quote_name(ARCHIVE_TABLE)
+            ),
+            [list(ids)],
+        )
+        return cursor.rowcount
+
+
+def delete_archived_schedules(ids):
+    """
+    Deletes the archived schedules with the given ids, and returns the
+    number deleted. Raises ValueError for an invalid id.
+    """
+    deleted = 0
+    ids = [uuid.UUID(str(schedule_id)) for schedule_id in ids]
+    for alias, shard_ids in group_by_shard(ids).items():
+        deleted += delete_archived(alias, shard_ids)
+    return deleted
+
+
+def restore(using, condition, params):
+    """
+    Moves the archived schedules that match `condition` back into the
+    schedule table, and returns their ids. Schedules whose id or external id
+    has been taken since are left in the archive.
+
+    Their celery definitions are linked again, as they may have been cleaned
+    up while the schedules were archived.
+    """
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    fields = Schedule._meta.concrete_fields
+    table = qn(Schedule._meta.db_table)
+    archive = qn(ARCHIVE_TABLE)
+    with transaction.atomic(using=using), connection.cursor() as cursor:
+        cursor.execute(
+            "WITH moved AS (DELETE FROM {archive} WHERE ({condition}) "
+            "AND NOT EXISTS (SELECT 1 FROM {table} s WHERE s.id = {archive}.id "
+            "OR s.external_id = {archive}.external_id) RETURNING *) "
+            "INSERT INTO {table} ({columns}) SELECT {values} FROM moved "
+            "RETURNING id".format(
+                archive=archive,
+                condition=condition,
+                table=table,
+                columns=", ".join(qn(field.column) for field in fields),
+                values=", ".join(
+                    "NULL" if field.column in DEFINITION_COLUMNS else qn(field.column)
+                    for field in fields
+                ),
+            ),
+            params,
+        )
+        restored = [schedule_id for schedule_id, in cursor.fetchall()]
+        if restored:
+            definitions = DefinitionCache()
+            schedules = [
+                definitions.resolve(schedule)
+                for schedule in Schedule.objects.using(using).filter(id__in=restored)
+            ]
+            Schedule.objects.using(using).bulk_update(
+                schedules, ["celery_cron_definition", "celery_interval_definition"]
+            )
+    return restored
+
+
+def restore_schedules(ids):
+    """
+    Restores the archived schedules with the given ids, and returns the ids
+    of the ones that were restored. Raises ValueError for an invalid id.
+    """
+    restored = []
+    ids = [uuid.UUID(str(schedule_id)) for schedule_id in ids]
+    for alias, shard_ids in group_by_shard(ids).items():
+        restored.extend(restore(alias, "id = ANY(%s)", [shard_ids]))
+    return restored
+
+
+def restore_external_ids(user, external_ids):
+    """
+    Restores the user's archived schedules with the given external ids, and
+    returns the ids of the ones that were restored.
+    """
+    restored = []
+    for alias in shards():
+        restored.extend(
+            restore(
+                alias,
+                "created_by_id IS NOT DISTINCT FROM %s AND external_id = ANY(%s)",
+                [user.id if user else None, list(external_ids)],
+            )
+        )
+    return restored
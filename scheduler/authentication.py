@@ -0,0 +1,81 @@
+import hashlib
+import hmac
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from rest_framework.authentication import BasicAuthentication, TokenAuthentication
+from rest_framework.authtoken.models import Token
+
+from .cache import TieredCache
+
+auth_cache = TieredCache(
+    "auth",
+    settings.SCHEDULER_AUTH_CACHE_TTL,
+    shared=settings.SCHEDULER_AUTH_SHARED_CACHE,
+    shared_ttl=settings.SCHEDULER_AUTH_SHARED_CACHE_TTL,
+)
+
+
+def credentials_key(kind, *credentials):
+    """
+    Returns a cache key for credentials, so that they aren't stored as is.
+    """
+    digest = hmac.new(
+        settings.SECRET_KEY.encode("utf-8"),
+        ":".join(credentials).encode("utf-8"),
+        hashlib.sha256,
+    ).hexdigest()
+    return "%s:%s" % (kind, digest)
+
+
+def user_tag(user_id):
+    return "user:%s" % user_id
+
+
+class CachedBasicAuthentication(BasicAuthentication):
+
+    """
+    Basic authentication that caches successful logins, so that the
+    password hash is only checked once per TTL.
+    """
+
+    def authenticate_credentials(self, userid, password, request=None):
+        key = credentials_key("basic", userid, password)
+        user = auth_cache.get(key)
+        if user is None:
+            user, _ = super(CachedBasicAuthentication, self).authenticate_credentials(
+                userid, password, request
+            )
+            auth_cache.set(key, user, tags=[user_tag(user.pk)])
+        return (user, None)
+
+
+class CachedTokenAuthentication(TokenAuthentication):
+
+    """
+    Token authentication that caches the token and user lookup.
+    """
+
+    def authenticate_credentials(self, key):
+        cache_key = credentials_key("token", key)
+        credentials = auth_cache.get(cache_key)
+        if credentials is None:
+            credentials = super(
+                CachedTokenAuthentication, self
+            ).authenticate_credentials(key)
+            auth_cache.set(cache_key, credentials, tags=[user_tag(credentials[0].pk)])
+        return credentials
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def user_changed(sender, instance, **kwargs):
+    auth_cache.invalidate(user_tag(instance.pk))
+
+
+@receiver(post_save, sender=Token)
+@receiver(post_delete, sender=Token)
+def token_changed(sender, instance, **kwargs):
+    auth_cache.delete(credentials_key("token", instance.key))
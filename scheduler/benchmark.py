@@ -0,0 +1,289 @@
+import threading
+import time
+from contextlib import ExitStack
+from datetime import timedelta
+from queue import Empty, Queue
+from unittest import mock
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import connection, transaction
+from django.test.utils import override_settings
+from django.utils.timezone import now
+from djcelery.models import CrontabSchedule, PeriodicTask
+
+from seed_scheduler.utils import percentiles
+
+from .bulk import batched
+from .definitions import DefinitionCache, bump_periodic_tasks, crontab_definition
+from .importer import copy_schedules
+from .memory import peak_rss
+from .models import Delivery, QueueTaskRun, Schedule, ScheduleFailure
+from .stats import delivery_stats
+from .stub import StubServer
+from .tasks import DeliverTask, deliver_task, fire_metric, queue_tasks
+
+BENCHMARK_USERNAME = "bench_scheduler"
+
+
+class QueryCounter(object):
+
+    """
+    A database execute wrapper that counts the queries run through it, from
+    any number of threads.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        with self.lock:
+            self.count += 1
+        return execute(sql, params, many, context)
+
+
+def rate(count, seconds):
+    return round(count / seconds) if seconds else count
+
+
+def dedicated_definitions(count, today):
+    """
+    Returns `count` cron definitions that no CrontabSchedule uses yet, so
+    that no other schedule shares them. They're due on the days before
+    `today`, so celery beat won't queue them for most of a year.
+    """
+    existing = set(crontab_definition(c) for c in CrontabSchedule.objects.all())
+    definitions = []
+    day = today
+    while len(definitions) < count:
+        day -= timedelta(days=1)
+        for minute_of_day in range(24 * 60):
+            hour, minute = divmod(minute_of_day, 60)
+            definition = "%s %s %s %s *" % (minute, hour, day.day, day.month)
+            if definition not in existing:
+                definitions.append(definition)
+            if len(definitions) == count:
+                break
+    return definitions
+
+
+def delete_seeded(user, crontab_ids):
+    """
+    Deletes the schedules created by `user` along with their failures and
+    deliveries, and the definitions in `crontab_ids` along with their
+    PeriodicTasks and QueueTaskRuns.
+    """
+    # Deleted directly, since django-rest-hooks listens for every model's
+    # deletes, so QuerySet.delete() would load each row to send them
+    qn = connection.ops.quote_name
+    schedule_ids = "SELECT id FROM {table} WHERE created_by_id = %s".format(
+        table=qn(Schedule._meta.db_table)
+    )
+    with transaction.atomic(), connection.cursor() as cursor:
+        for model, condition, params in (
+            (ScheduleFailure, "schedule_id IN (%s)" % schedule_ids, [user.id]),
+            (Delivery, "schedule_id IN (%s)" % schedule_ids, [user.id]),
+            (Schedule, "created_by_id = %s", [user.id]),
+            (QueueTaskRun, "celery_cron_definition_id = ANY(%s)", [crontab_ids]),
+            (PeriodicTask, "crontab_id = ANY(%s)", [crontab_ids]),
+            (CrontabSchedule, "id = ANY(%s)", [crontab_ids]),
+        ):
+            cursor.execute(
+                "DELETE FROM {table} WHERE {condition}".format(
+                    table=qn(model._meta.db_table), condition=condition
+                ),
+                params,
+            )
+        bump_periodic_tasks()
+
+
+class Benchmark(object):
+
+    """
+    Measures the fan-out and delivery of schedules from end to end. Seeds
+    `schedules` schedules with COPY, spread across `definitions` cron
+    definitions and `hosts` local StubServers that answer after `latency`
+    seconds, with a 500 for `error_rate` of the deliveries. Then runs
+    QueueTasks for every definition, and DeliverTask for every queued
+    schedule on `concurrency` threads.
+
+    The definitions are dedicated to the benchmark, and QueueTasks doesn't
+    coalesce them with the definitions that are due at the same time, so
+    that other schedules aren't queued. Tasks are kept in memory instead of
+    being sent to the broker, and only the ones for the seeded schedules are
+    run. The seeded schedules and their definitions are deleted afterwards,
+    unless `keep` is set.
+
+    Schedules are only seeded on the default database, so it can't be run
+    against sharded schedules.
+    """
+
+    def __init__(
+        self,
+        schedules=1000,
+        definitions=10,
+        payload_bytes=100,
+        hosts=1,
+        latency=0,
+        error_rate=0,
+        concurrency=10,
+        keep=False,
+        seed=0,
+    ):
+        self.schedules = schedules
+        self.definitions = definitions
+        self.payload_bytes = payload_bytes
+        self.hosts = hosts
+        self.latency = latency
+        self.error_rate = error_rate
+        self.concurrency = concurrency
+        self.keep = keep
+        self.seed = seed
+        self.tasks = []
+        self.schedule_ids = set()
+        self.foreign = 0
+
+    def send_delivery(self, kwargs=None, **options):
+        if kwargs["schedule_id"] in self.schedule_ids:
+            self.tasks.append(kwargs)
+        else:
+            # Schedules from outside of the benchmark are never sent
+            self.foreign += 1
+
+    def seed_schedules(self, user, urls):
+        """
+        Loads the schedules in chunks with COPY, and returns the ids of the
+        definitions that they use.
+        """
+        cache = DefinitionCache()
+        payload = {"data": "x" * self.payload_bytes}
+        definitions = dedicated_definitions(self.definitions, now().date())
+
+        def generate():
+            for index in range(self.schedules):
+                schedule = Schedule(
+                    cron_definition=definitions[index % len(definitions)],
+                    payload=payload,
+                    created_by=user,
+                    updated_by=user,
+                )
+                schedule.endpoint = "%s/%s/" % (urls[index % len(urls)], schedule.id)
+                self.schedule_ids.add(str(schedule.id))
+                yield cache.resolve(schedule)
+
+        for chunk in batched(generate(), settings.SCHEDULER_IMPORT_CHUNK_SIZE):
+            with transaction.atomic():
+                copy_schedules(chunk)
+        return sorted(set(crontab.id for crontab in cache.crontabs.values()))
+
+    def queue(self, crontab_ids):
+        """
+        Runs QueueTasks for each definition.
+        """
+        for crontab_id in crontab_ids:
+            queue_tasks.run("crontab", crontab_id)
+
+    def deliver(self, counter):
+        """
+        Runs DeliverTask for each of the queued schedules, and returns the
+        latency of each delivery and the number that failed.
+        """
+        tasks = Queue()
+        for task in self.tasks:
+            tasks.put(task)
+        latencies = []
+        errors = []
+
+        def work():
+            try:
+                with connection.execute_wrapper(counter):
+                    while True:
+                        try:
+                            kwargs = tasks.get_nowait()
+                        except Empty:
+                            return
+                        started = time.time()
+                        try:
+                            deliver_task.run(**kwargs)
+                        except Exception:
+                            errors.append(kwargs["schedule_id"])
+                        latencies.append(time.time() - started)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=work) for _ in range(self.concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # Write the delivery stats that are still waiting
+        with connection.execute_wrapper(counter):
+            delivery_stats.flush()
+        return latencies, len(errors)
+
+    def run(self):
+        """
+        Runs the benchmark, and returns the rates, delivery latencies, query
+        counts and peak memory use.
+        """
+        user, _ = User.objects.get_or_create(username=BENCHMARK_USERNAME)
+        with ExitStack() as stack:
+            urls = [
+                stack.enter_context(
+                    StubServer(self.latency, self.error_rate, self.seed + index)
+                ).url
+                for index in range(self.hosts)
+            ]
+            stack.enter_context(
+                mock.patch.object(DeliverTask, "apply_async", self.send_delivery)
+            )
+            stack.enter_context(mock.patch.object(fire_metric, "delay"))
+            stack.enter_context(override_settings(SCHEDULER_COALESCE_CRONTABS=False))
+
+            started = time.time()
+            crontab_ids = self.seed_schedules(user, urls)
+            seed_seconds = time.time() - started
+
+            try:
+                queue_counter = QueryCounter()
+                started = time.time()
+                with connection.execute_wrapper(queue_counter):
+                    self.queue(crontab_ids)
+                queue_seconds = time.time() - started
+                queued = len(self.tasks)
+
+                deliver_counter = QueryCounter()
+                started = time.time()
+                latencies, errors = self.deliver(deliver_counter)
+                deliver_seconds = time.time() - started
+            finally:
+                if not self.keep:
+                    delete_seeded(user, crontab_ids)
+
+        return {
+            "schedules": self.schedules,
+            "definitions": len(crontab_ids),
+            "hosts": self.hosts,
+            "payload_bytes": self.payload_bytes,
+            "seed": {
+                "seconds": round(seed_seconds, 3),
+                "schedules_per_second": rate(self.schedules, seed_seconds),
+            },
+            "queue": {
+                "seconds": round(queue_seconds, 3),
+                "queued": queued,
+                "foreign": self.foreign,
+                "schedules_per_second": rate(queued, queue_seconds),
+                "queries": queue_counter.count,
+            },
+            "deliver": {
+                "seconds": round(deliver_seconds, 3),
+                "deliveries": len(latencies),
+                "errors": errors,
+                "deliveries_per_second": rate(len(latencies), deliver_seconds),
+                "latency_seconds": percentiles(latencies),
+                "queries": deliver_counter.count,
+            },
+            "peak_rss_bytes": peak_rss(),
+        }
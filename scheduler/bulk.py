@@ -0,0 +1,415 @@
+import logging
+import time
+import uuid
+from operator import attrgetter
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils.timezone import now
+from rest_framework.exceptions import ValidationError
+
+from .archive import (
+    archived_ids,
+    delete_archived,
+    enables,
+    restore_external_ids,
+    restore_schedules,
+)
+from .definitions import DefinitionCache, enable_periodic_tasks
+from .hooks import get_hooks
+from .models import Schedule
+from .shards import group_by_shard
+
+logger = logging.getLogger(__name__)
+
+# The fields that a sync replaces on existing schedules
+SYNC_FIELDS = (
+    "frequency",
+    "cron_definition",
+    "celery_cron_definition",
+    "interval_definition",
+    "celery_interval_definition",
+    "endpoint",
+    "auth_token",
+    "payload",
+    "next_send_at",
+    "enabled",
+    "end_at",
+    "max_runs",
+)
+
+EXTERNAL_ID_TAKEN = "A schedule with this external id belongs to another user."
+
+
+def chunks(items, size):
+    for start in range(0, len(items), size):
+        end = start + size
+        yield items[start:end]
+
+
+def batched(iterable, size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def log_throughput(action, count, started):
+    elapsed = time.time() - started
+    logger.info(
+        "%s %s schedules in %.3fs (%.0f/s)"
+        % (action, count, elapsed, count / elapsed if elapsed else count)
+    )
+
+
+def item_error(index, errors):
+    return {"index": index, "errors": errors}
+
+
+def parse_id(item):
+    """
+    Returns the schedule UUID for an item that is either an id or a dict
+    with an id, or None if there isn't a valid one.
+    """
+    if isinstance(item, dict):
+        item = item.get("id")
+    try:
+        return uuid.UUID(str(item))
+    except ValueError:
+        return None
+
+
+def validate_creates(serializer, items):
+    """
+    Validates each item with the given serializer, returning the validated
+    data for the valid items and the errors for the rest.
+    """
+    valid = []
+    errors = []
+    for index, item in enumerate(items):
+        try:
+            valid.append(serializer.run_validation(item))
+        except ValidationError as exc:
+            errors.append(item_error(index, exc.detail))
+    return valid, errors
+
+
+def validate_updates(serializer, items):
+    """
+    Looks up the schedules for all items in a single query, and validates
+    each item against its schedule with the given (partial) serializer.
+    Archived schedules that the items enable are restored first. Returns a
+    list of (schedule, validated data) and the errors.
+    """
+    errors = []
+    lookups = []
+    for index, item in enumerate(items):
+        schedule_id = parse_id(item) if isinstance(item, dict) else None
+        if schedule_id is None:
+            errors.append(item_error(index, {"id": ["A valid id is required."]}))
+        else:
+            lookups.append((index, schedule_id, item))
+
+    schedules = {}
+    for alias, ids in group_by_shard(lookup[1] for lookup in lookups).items():
+        schedules.update(Schedule.objects.using(alias).in_bulk(ids))
+    archived = [
+        schedule_id
+        for _, schedule_id, item in lookups
+        if schedule_id not in schedules and enables(item)
+    ]
+    if archived:
+        for alias, ids in group_by_shard(restore_schedules(archived)).items():
+            schedules.update(Schedule.objects.using(alias).in_bulk(ids))
+    updates = []
+    for index, schedule_id, item in lookups:
+        if schedule_id not in schedules:
+            errors.append(item_error(index, {"id": ["Not found."]}))
+            continue
+        try:
+            data = serializer.run_validation(item)
+        except ValidationError as exc:
+            errors.append(item_error(index, exc.detail))
+        else:
+            updates.append((schedules[schedule_id], data))
+    errors.sort(key=lambda error: error["index"])
+    return updates, errors
+
+
+def validate_deletes(items):
+    """
+    Returns the ids of the existing and archived schedules to delete and the
+    errors for the items that aren't valid ids or don't exist.
+    """
+    errors = []
+    lookups = []
+    for index, item in enumerate(items):
+        schedule_id = parse_id(item)
+        if schedule_id is None:
+            errors.append(item_error(index, {"id": ["A valid id is required."]}))
+        else:
+            lookups.append((index, schedule_id))
+
+    existing = set()
+    for alias, ids in group_by_shard(lookup[1] for lookup in lookups).items():
+        existing.update(
+            Schedule.objects.using(alias)
+            .filter(id__in=ids)
+            .values_list("id", flat=True)
+        )
+        existing.update(archived_ids(alias, ids))
+    ids = []
+    for index, schedule_id in lookups:
+        if schedule_id in existing:
+            ids.append(schedule_id)
+        else:
+            errors.append(item_error(index, {"id": ["Not found."]}))
+    errors.sort(key=lambda error: error["index"])
+    return ids, errors
+
+
+def fire_schedules_added(schedules):
+    """
+    Fires the schedule.added webhooks for many new schedules, sending each
+    hook batches of schedules instead of one delivery per schedule.
+    """
+    if not schedules:
+        return
+    hooks = get_hooks("schedule.added")
+    if not hooks:
+        return
+    data = [schedule.hook_data() for schedule in schedules]
+    for hook in hooks:
+        for batch in chunks(data, settings.SCHEDULER_BULK_HOOK_BATCH_SIZE):
+            hook.deliver_hook(
+                None, payload_override={"hook": hook.dict(), "data": batch}
+            )
+
+
+def bulk_create_schedules(validated_data, user):
+    """
+    Creates schedules from validated serializer data, resolving each
+    distinct cron and interval definition only once. Sharded schedules are
+    inserted on each shard in turn.
+    """
+    started = time.time()
+    definitions = DefinitionCache()
+    with transaction.atomic():
+        schedules = [
+            definitions.resolve(Schedule(created_by=user, updated_by=user, **data))
+            for data in validated_data
+        ]
+        for alias, group in group_by_shard(schedules, key=attrgetter("id")).items():
+            Schedule.objects.using(alias).bulk_create(
+                group, batch_size=settings.SCHEDULER_BULK_BATCH_SIZE
+            )
+        fire_schedules_added(schedules)
+    log_throughput("Created", len(schedules), started)
+    return schedules
+
+
+def bulk_update_schedules(updates, user):
+    """
+    Applies a list of (schedule, validated data) updates, re-resolving the
+    celery definitions for schedules whose definitions changed.
+    """
+    started = time.time()
+    definitions = DefinitionCache()
+    updated_at = now()
+    fields = set(["updated_by", "updated_at"])
+    with transaction.atomic():
+        for schedule, data in updates:
+            for attr, value in data.items():
+                setattr(schedule, attr, value)
+            fields.update(data)
+            if "cron_definition" in data:
+                schedule.celery_cron_definition = None
+                fields.add("celery_cron_definition")
+            if "interval_definition" in data:
+                schedule.celery_interval_definition = None
+                fields.add("celery_interval_definition")
+            definitions.resolve(schedule)
+            schedule.updated_by = user
+            schedule.updated_at = updated_at
+        schedules = [schedule for schedule, _ in updates]
+        for alias, group in group_by_shard(schedules, key=attrgetter("id")).items():
+            Schedule.objects.using(alias).bulk_update(
+                group, sorted(fields), batch_size=settings.SCHEDULER_BULK_BATCH_SIZE
+            )
+        enabled = [schedule for schedule in schedules if schedule.enabled]
+        enable_periodic_tasks(
+            set(schedule.celery_cron_definition_id for schedule in enabled)
+            - set([None]),
+            set(schedule.celery_interval_definition_id for schedule in enabled)
+            - set([None]),
+        )
+    log_throughput("Updated", len(schedules), started)
+    return schedules
+
+
+def bulk_delete_schedules(ids):
+    started = time.time()
+    deleted = 0
+    with transaction.atomic():
+        for alias, shard_ids in group_by_shard(ids).items():
+            for batch in chunks(shard_ids, settings.SCHEDULER_BULK_BATCH_SIZE):
+                schedules = Schedule.objects.using(alias).filter(id__in=batch)
+                _, per_model = schedules.delete()
+                deleted += per_model.get(Schedule._meta.label, 0)
+                deleted += delete_archived(alias, batch)
+    log_throughput("Deleted", deleted, started)
+    return deleted
+
+
+def upsert_schedules(cursor, schedules):
+    """
+    Inserts the schedules, updating the existing schedule with the same
+    external id instead if it was created by the same user and has changed.
+    Returns the ids of the created schedules, the number updated, and the
+    external ids of the schedules that were written.
+    """
+    qn = connection.ops.quote_name
+    table = qn(Schedule._meta.db_table)
+    fields = Schedule._meta.concrete_fields
+    sync_columns = [qn(Schedule._meta.get_field(name).column) for name in SYNC_FIELDS]
+    update_columns = sync_columns + [qn("updated_at"), qn("updated_by_id")]
+
+    params = []
+    for schedule in schedules:
+        for field in fields:
+            value = field.pre_save(schedule, True)
+            params.append(field.get_db_prep_save(value, connection))
+    row = "(%s)" % ", ".join(["%s"] * len(fields))
+
+    cursor.execute(
+        "INSERT INTO {table} ({columns}) VALUES {rows} "
+        "ON CONFLICT ({external_id}) DO UPDATE SET {updates} "
+        "WHERE {table}.{created_by} IS NOT DISTINCT FROM EXCLUDED.{created_by} "
+        "AND ({current}) IS DISTINCT FROM ({excluded}) "
+        "RETURNING {id}, {external_id}, xmax = 0".format(
+            table=table,
+            columns=", ".join(qn(field.column) for field in fields),
+            rows=", ".join([row] * len(schedules)),
+            external_id=qn("external_id"),
+            updates=", ".join(
+                "%s = EXCLUDED.%s" % (column, column) for column in update_columns
+            ),
+            created_by=qn("created_by_id"),
+            current=", ".join("%s.%s" % (table, column) for column in sync_columns),
+            excluded=", ".join("EXCLUDED.%s" % column for column in sync_columns),
+            id=qn("id"),
+        ),
+        params,
+    )
+    created = []
+    updated = 0
+    written = set()
+    for schedule_id, external_id, inserted in cursor.fetchall():
+        written.add(external_id)
+        if inserted:
+            created.append(schedule_id)
+        else:
+            updated += 1
+    return created, updated, written
+
+
+def other_users_external_ids(cursor, external_ids, user):
+    """
+    Returns which of the external ids belong to schedules that were created
+    by someone other than `user`.
+    """
+    if not external_ids:
+        return set()
+    cursor.execute(
+        "SELECT external_id FROM scheduler_schedule WHERE external_id = ANY(%s) "
+        "AND created_by_id IS DISTINCT FROM %s",
+        [list(external_ids), user.id if user else None],
+    )
+    return set(external_id for external_id, in cursor.fetchall())
+
+
+def sync_schedules(serializer, items, user):
+    """
+    Makes the user's schedules that have an external id match the given
+    items, in batches inside a single transaction. New external ids are
+    created, changed ones are updated, and the user's enabled schedules
+    that aren't in the items are disabled.
+
+    Nothing is disabled if any of the items are invalid, since the full
+    desired set isn't known. Items with an external id that belongs to
+    another user's schedule are invalid. The user's archived schedules with
+    the same external ids are restored and updated.
+    """
+    started = time.time()
+    definitions = DefinitionCache()
+    summary = {"created": 0, "updated": 0, "unchanged": 0, "disabled": 0}
+    errors = []
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(
+            "CREATE TEMPORARY TABLE scheduler_sync_seen "
+            "(external_id varchar(255) PRIMARY KEY) ON COMMIT DROP"
+        )
+        for batch in batched(enumerate(items), settings.SCHEDULER_BULK_BATCH_SIZE):
+            schedules = {}
+            indexes = {}
+            for index, item in batch:
+                try:
+                    data = serializer.run_validation(item)
+                except ValidationError as exc:
+                    errors.append(item_error(index, exc.detail))
+                    continue
+                # Later items replace earlier items with the same external id
+                schedules[data["external_id"]] = definitions.resolve(
+                    Schedule(created_by=user, updated_by=user, **data)
+                )
+                indexes.setdefault(data["external_id"], []).append(index)
+            if not schedules:
+                continue
+
+            restore_external_ids(user, list(schedules))
+            created, updated, written = upsert_schedules(
+                cursor, list(schedules.values())
+            )
+            # The upsert skips schedules that are unchanged, or that belong to
+            # another user
+            taken = other_users_external_ids(cursor, set(schedules) - written, user)
+            for external_id in taken:
+                errors.extend(
+                    item_error(index, {"external_id": [EXTERNAL_ID_TAKEN]})
+                    for index in indexes[external_id]
+                )
+            summary["created"] += len(created)
+            summary["updated"] += updated
+            summary["unchanged"] += len(schedules) - len(created) - updated - len(taken)
+            cursor.execute(
+                "INSERT INTO scheduler_sync_seen (external_id) "
+                "SELECT unnest(%s) ON CONFLICT DO NOTHING",
+                [list(set(schedules) - taken)],
+            )
+            fire_schedules_added(list(Schedule.objects.filter(id__in=created)))
+
+        if not errors:
+            cursor.execute(
+                "UPDATE scheduler_schedule SET enabled = false, updated_at = %s, "
+                "updated_by_id = %s WHERE created_by_id = %s AND enabled "
+                "AND external_id IS NOT NULL AND NOT EXISTS ("
+                "SELECT 1 FROM scheduler_sync_seen "
+                "WHERE scheduler_sync_seen.external_id = scheduler_schedule.external_id"
+                ")",
+                [now(), user.id, user.id],
+            )
+            summary["disabled"] = cursor.rowcount
+        cursor.execute("DROP TABLE scheduler_sync_seen")
+
+    log_throughput(
+        "Synced",
+        summary["created"] + summary["updated"] + summary["unchanged"],
+        started,
+    )
+    errors.sort(key=lambda error: error["index"])
+    summary["errors"] = errors
+    return summary
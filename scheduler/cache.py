@@ -0,0 +1,94 @@
+import time
+
+from django.core.cache import caches
+
+
+class TieredCache(object):
+
+    """
+    A process-local cache with a TTL, in front of an optional shared Django
+    cache (such as Redis) given by its alias in CACHES.
+
+    Entries can be tagged, so that all of the entries with a tag can be
+    invalidated together. Other processes only see invalidations through the
+    shared cache, so the local TTL should be short.
+    """
+
+    def __init__(self, prefix, ttl, shared=None, shared_ttl=None, max_size=10000):
+        self.prefix = prefix
+        self.ttl = ttl
+        self.shared_alias = shared
+        self.shared_ttl = shared_ttl or ttl
+        self.max_size = max_size
+        self.local = {}
+
+    @property
+    def shared(self):
+        if self.shared_alias:
+            return caches[self.shared_alias]
+        return None
+
+    def shared_key(self, key):
+        return "%s:%s" % (self.prefix, key)
+
+    def tag_key(self, tag):
+        return "%s:tag:%s" % (self.prefix, tag)
+
+    def get(self, key):
+        timestamp = time.time()
+        entry = self.local.get(key)
+        if entry is not None:
+            expires, value, tags = entry
+            if expires > timestamp:
+                return value
+            self.local.pop(key, None)
+
+        shared = self.shared
+        if shared is None:
+            return None
+        entry = shared.get(self.shared_key(key))
+        if entry is None:
+            return None
+        cached_at, value, tags = entry
+        if tags:
+            invalidated = shared.get_many([self.tag_key(tag) for tag in tags])
+            if any(at >= cached_at for at in invalidated.values()):
+                return None
+        self.set_local(key, value, tags, timestamp)
+        return value
+
+    def set_local(self, key, value, tags, timestamp):
+        if len(self.local) >= self.max_size:
+            self.local.clear()
+        self.local[key] = (timestamp + self.ttl, value, tags)
+
+    def set(self, key, value, tags=()):
+        timestamp = time.time()
+        tags = tuple(tags)
+        self.set_local(key, value, tags, timestamp)
+        shared = self.shared
+        if shared is not None:
+            shared.set(self.shared_key(key), (timestamp, value, tags), self.shared_ttl)
+
+    def delete(self, key):
+        self.local.pop(key, None)
+        shared = self.shared
+        if shared is not None:
+            shared.delete(self.shared_key(key))
+
+    def invalidate(self, tag):
+        """
+        Removes all of the entries with the given tag.
+        """
+        for key, (_, _, tags) in list(self.local.items()):
+            if tag in tags:
+                self.local.pop(key, None)
+        shared = self.shared
+        if shared is not None:
+            shared.set(self.tag_key(tag), time.time(), self.shared_ttl)
+
+    def clear(self):
+        """
+        Clears the local tier for this process.
+        """
+        self.local.clear()
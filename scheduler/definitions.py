@@ -0,0 +1,388 @@
+from datetime import timedelta
+from functools import lru_cache
+
+from crontab import CronTab
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Q
+from django.utils.timezone import now
+from djcelery.models import (
+    CrontabSchedule,
+    IntervalSchedule,
+    PeriodicTask,
+    PeriodicTasks,
+)
+
+QUEUE_TASKS_TASK = "seed_scheduler.scheduler.tasks.queue_tasks"
+
+
+# The lowest and highest value of each crontab field
+CRONTAB_FIELD_RANGES = (
+    ("minute", "minute", 0, 59),
+    ("hour", "hour", 0, 23),
+    ("day_of_month", "day", 1, 31),
+    ("month_of_year", "month", 1, 12),
+    ("day_of_week", "weekday", 0, 6),
+)
+
+# CrontabSchedule fields can't be longer than this
+CRONTAB_FIELD_MAX_LENGTH = 64
+
+
+def compress_values(values, low, high):
+    """
+    Returns the shortest of the forms that we use for a sorted list of
+    values, so that equivalent fields are always written the same way:
+    every `step` values across the whole field (*/15), a range with a step
+    (10-50/20), or a list of values and ranges (1,3-5,9).
+    """
+    if len(values) >= 3:
+        step = values[1] - values[0]
+        if all(b - a == step for a, b in zip(values, values[1:])):
+            if values[0] == low and values[-1] + step > high:
+                return "*/%d" % step
+            if step == 1:
+                return "%d-%d" % (values[0], values[-1])
+            return "%d-%d/%d" % (values[0], values[-1], step)
+
+    parts = []
+    start = previous = values[0]
+    for value in values[1:] + [None]:
+        if value is not None and value == previous + 1:
+            previous = value
+            continue
+        if previous - start >= 2:
+            parts.append("%d-%d" % (start, previous))
+        else:
+            parts.extend(str(v) for v in range(start, previous + 1))
+        start = previous = value
+    return ",".join(parts)
+
+
+def canonical_field(matcher, low, high):
+    """
+    Returns the canonical form of a parsed crontab field. Fields that can't
+    be expressed as a set of values, like the last day of the month, are
+    kept as they were written.
+    """
+    if matcher.any:
+        return "*"
+    if any(item.startswith("l") for item in matcher.split):
+        return matcher.input
+    values = sorted(matcher.allowed)
+    if values == list(range(low, high + 1)):
+        return "*"
+    field = compress_values(values, low, high)
+    if len(field) > CRONTAB_FIELD_MAX_LENGTH:
+        return matcher.input
+    return field
+
+
+@lru_cache(maxsize=1024)
+def crontab_kwargs(cron_definition):
+    """
+    Returns the CrontabSchedule lookup for a cron string, with each field in
+    its canonical form, so that equivalent strings like "*/15", "0,15,30,45"
+    and "0-59/15" share a CrontabSchedule and PeriodicTask. The result is
+    memoized, since there are few distinct definitions across schedules, and
+    must not be modified.
+    """
+    # CronTab package just used to parse and validate the string nicely.
+    entry = CronTab(cron_definition)
+    return {
+        name: canonical_field(getattr(entry.matchers, attr), low, high)
+        for name, attr, low, high in CRONTAB_FIELD_RANGES
+    }
+
+
+def canonical_cron_definition(cron_definition):
+    """
+    Returns the canonical cron string for a cron definition.
+    """
+    kwargs = crontab_kwargs(cron_definition)
+    return " ".join(kwargs[name] for name, _, _, _ in CRONTAB_FIELD_RANGES)
+
+
+def crontab_definition(crontab):
+    """
+    Returns the cron string for a CrontabSchedule.
+    """
+    return " ".join(getattr(crontab, name) for name, _, _, _ in CRONTAB_FIELD_RANGES)
+
+
+@lru_cache(maxsize=1024)
+def crontab_entry(cron_definition):
+    """
+    Returns the parsed CronTab for a cron string. The result is memoized and
+    must not be modified.
+    """
+    return CronTab(cron_definition)
+
+
+def crontab_tick(cron_definition, timestamp):
+    """
+    Returns the time that a cron definition was due to run at, for a run
+    that started at `timestamp`. A run that started up to
+    DEFAULT_CLOCK_SKEW_SECONDS early is for the next time.
+    """
+    entry = crontab_entry(cron_definition)
+    following = entry.next(timestamp, default_utc=True)
+    if following <= settings.DEFAULT_CLOCK_SKEW_SECONDS:
+        return (timestamp + timedelta(seconds=following)).replace(microsecond=0)
+    # A run exactly at the due time is for that time, not the one before
+    timestamp += timedelta(seconds=1)
+    previous = entry.previous(timestamp, default_utc=True)
+    return (timestamp + timedelta(seconds=previous)).replace(microsecond=0)
+
+
+@lru_cache(maxsize=1024)
+def interval_kwargs(interval_definition):
+    """
+    Returns the IntervalSchedule lookup for an interval string. The result is
+    memoized and must not be modified.
+    """
+    every, period = interval_definition.split()
+    return {"every": int(every), "period": period}
+
+
+def bump_periodic_tasks():
+    """
+    Tells celery beat that the PeriodicTasks have changed. Saving a
+    PeriodicTask does this too, so this is for changes made with update().
+    """
+    PeriodicTasks.objects.update_or_create(ident=1, defaults={"last_update": now()})
+
+
+def definitions_filter(crontab_ids=(), interval_ids=()):
+    return Q(crontab_id__in=list(crontab_ids)) | Q(interval_id__in=list(interval_ids))
+
+
+def enable_matching_periodic_tasks(definitions):
+    """
+    Re-enables the PeriodicTasks that match `definitions` and were disabled
+    by reconcile_periodic_tasks, now that they are being used again.
+    """
+    enabled = (
+        PeriodicTask.objects.filter(task=QUEUE_TASKS_TASK, enabled=False)
+        .filter(definitions)
+        .update(enabled=True, date_changed=now())
+    )
+    if enabled:
+        bump_periodic_tasks()
+    return enabled
+
+
+def enable_periodic_tasks(crontab_ids=(), interval_ids=()):
+    """
+    Re-enables the PeriodicTasks for the given definitions, if they were
+    disabled while they weren't used.
+    """
+    if not crontab_ids and not interval_ids:
+        return 0
+    return enable_matching_periodic_tasks(definitions_filter(crontab_ids, interval_ids))
+
+
+def get_crontab_schedule(cron_definition):
+    """
+    Gets or creates the CrontabSchedule for a cron string, along with the
+    PeriodicTask that queues its schedules.
+    """
+    kwargs = crontab_kwargs(cron_definition)
+    # The PeriodicTask is enabled before the definition is looked up, so
+    # that reconcile_periodic_tasks either skips the definition, or has
+    # deleted it by the time it is looked up
+    enable_matching_periodic_tasks(
+        Q(**{"crontab__%s" % name: value for name, value in kwargs.items()})
+    )
+    cs, createdcs = CrontabSchedule.objects.get_or_create(**kwargs)
+    if createdcs:
+        # make the periodic task
+        pt = {
+            "name": "Run %s" % canonical_cron_definition(cron_definition),
+            "task": QUEUE_TASKS_TASK,
+            "crontab": cs,
+            "enabled": True,
+            "args": '["crontab", %s]' % cs.id,
+        }
+        PeriodicTask.objects.create(**pt)
+    return cs
+
+
+def get_interval_schedule(interval_definition):
+    """
+    Gets or creates the IntervalSchedule for an interval string, along with
+    the PeriodicTask that queues its schedules.
+    """
+    kwargs = interval_kwargs(interval_definition)
+    # See get_crontab_schedule
+    enable_matching_periodic_tasks(
+        Q(**{"interval__%s" % name: value for name, value in kwargs.items()})
+    )
+    intsch, createdsch = IntervalSchedule.objects.get_or_create(**kwargs)
+    if createdsch:
+        # make the periodic task
+        pt = {
+            "name": "Run %s" % interval_definition,
+            "task": QUEUE_TASKS_TASK,
+            "interval": intsch,
+            "enabled": True,
+            "args": '["interval", %s]' % intsch.id,
+        }
+        PeriodicTask.objects.create(**pt)
+    return intsch
+
+
+class DefinitionCache(object):
+
+    """
+    Resolves each distinct cron or interval string only once, for when
+    many schedules are being written at the same time.
+    """
+
+    def __init__(self):
+        self.crontabs = {}
+        self.intervals = {}
+
+    def crontab(self, cron_definition):
+        if cron_definition not in self.crontabs:
+            self.crontabs[cron_definition] = get_crontab_schedule(cron_definition)
+        return self.crontabs[cron_definition]
+
+    def interval(self, interval_definition):
+        if interval_definition not in self.intervals:
+            self.intervals[interval_definition] = get_interval_schedule(
+                interval_definition
+            )
+        return self.intervals[interval_definition]
+
+    def resolve(self, schedule):
+        """
+        Links the celery definitions for a schedule that doesn't have them
+        yet, without saving it.
+        """
+        if schedule.cron_definition and schedule.celery_cron_definition_id is None:
+            schedule.celery_cron_definition = self.crontab(schedule.cron_definition)
+        if (
+            schedule.interval_definition
+            and schedule.celery_interval_definition_id is None
+        ):
+            schedule.celery_interval_definition = self.interval(
+                schedule.interval_definition
+            )
+        return schedule
+
+
+def reconcile_periodic_tasks():
+    """
+    Disables the PeriodicTasks for definitions that no enabled schedule
+    uses, and enables the ones that are used again. Definitions that no
+    schedule uses, and whose PeriodicTask has been disabled for
+    SCHEDULER_DEFINITION_GC_GRACE seconds, are deleted along with their
+    PeriodicTask and QueueTaskRuns.
+
+    Celery beat is told about all of the changes at once, rather than once
+    per PeriodicTask.
+    """
+    from .models import QueueTaskRun, Schedule
+    from .shards import values_from_shards
+
+    timestamp = now()
+    tasks = PeriodicTask.objects.filter(task=QUEUE_TASKS_TASK)
+    enabled_schedules = Schedule.objects.filter(enabled=True)
+    used = Q(
+        crontab__in=values_from_shards(
+            enabled_schedules.filter(celery_cron_definition__isnull=False),
+            "celery_cron_definition",
+        )
+    ) | Q(
+        interval__in=values_from_shards(
+            enabled_schedules.filter(celery_interval_definition__isnull=False),
+            "celery_interval_definition",
+        )
+    )
+
+    with transaction.atomic():
+        summary = {
+            "disabled": tasks.filter(enabled=True)
+            .exclude(used)
+            .update(enabled=False, date_changed=timestamp),
+            "enabled": tasks.filter(enabled=False)
+            .filter(used)
+            .update(enabled=True, date_changed=timestamp),
+        }
+
+        stale = tasks.filter(
+            enabled=False,
+            date_changed__lt=timestamp
+            - timedelta(seconds=settings.SCHEDULER_DEFINITION_GC_GRACE),
+        )
+        other_tasks = PeriodicTask.objects.exclude(task=QUEUE_TASKS_TASK)
+        crontab_ids = list(
+            CrontabSchedule.objects.filter(id__in=stale.values("crontab"))
+            .exclude(
+                id__in=values_from_shards(
+                    Schedule.objects.filter(celery_cron_definition__isnull=False),
+                    "celery_cron_definition",
+                )
+            )
+            .exclude(id__in=other_tasks.filter(crontab__isnull=False).values("crontab"))
+            .values_list("id", flat=True)
+        )
+        interval_ids = list(
+            IntervalSchedule.objects.filter(id__in=stale.values("interval"))
+            .exclude(
+                id__in=values_from_shards(
+                    Schedule.objects.filter(celery_interval_definition__isnull=False),
+                    "celery_interval_definition",
+                )
+            )
+            .exclude(
+                id__in=other_tasks.filter(interval__isnull=False).values("interval")
+            )
+            .values_list("id", flat=True)
+        )
+
+        # Definitions that are being used again have had their PeriodicTask
+        # enabled, which these locks wait for, and new uses of the rest wait
+        # for them to be deleted
+        locked = list(
+            stale.filter(definitions_filter(crontab_ids, interval_ids))
+            .select_for_update()
+            .values_list("crontab_id", "interval_id")
+        )
+        crontab_ids = [crontab_id for crontab_id, _ in locked if crontab_id]
+        interval_ids = [interval_id for _, interval_id in locked if interval_id]
+
+        # Deleted directly, skipping the per row signals, which would each
+        # tell beat about the change, and the cascades, which are done here
+        # instead. django-rest-hooks listens for every model's deletes, so
+        # QuerySet.delete() would load each row to send them.
+        qn = connection.ops.quote_name
+        with connection.cursor() as cursor:
+            for model, condition, params in (
+                (
+                    PeriodicTask,
+                    "crontab_id = ANY(%s) OR interval_id = ANY(%s)",
+                    [crontab_ids, interval_ids],
+                ),
+                (
+                    QueueTaskRun,
+                    "celery_cron_definition_id = ANY(%s) "
+                    "OR celery_interval_definition_id = ANY(%s)",
+                    [crontab_ids, interval_ids],
+                ),
+                (CrontabSchedule, "id = ANY(%s)", [crontab_ids]),
+                (IntervalSchedule, "id = ANY(%s)", [interval_ids]),
+            ):
+                cursor.execute(
+                    "DELETE FROM {table} WHERE {condition}".format(
+                        table=qn(model._meta.db_table), condition=condition
+                    ),
+                    params,
+                )
+        summary["deleted_crontabs"] = len(crontab_ids)
+        summary["deleted_intervals"] = len(interval_ids)
+
+        if any(summary.values()):
+            bump_periodic_tasks()
+    return summary
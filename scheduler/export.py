@@ -0,0 +1,95 @@
+import csv
+import json
+from datetime import datetime
+
+from django.core.serializers.json import DjangoJSONEncoder
+
+from .filters import ScheduleFilter
+from .models import ScheduleArchive
+from .shards import shard_querysets
+
+# The fields that are exported, leaving out references to the users and
+# celery definitions that are specific to this environment.
+EXPORT_FIELDS = (
+    "id",
+    "external_id",
+    "frequency",
+    "triggered",
+    "cron_definition",
+    "interval_definition",
+    "endpoint",
+    "auth_token",
+    "payload",
+    "next_send_at",
+    "enabled",
+    "end_at",
+    "max_runs",
+    "created_at",
+    "updated_at",
+    "last_run",
+)
+
+
+def export_querysets(queryset, filters):
+    """
+    Returns the querysets to export the schedules in `queryset` from: the
+    schedule table on each shard, followed by the archive on each shard,
+    filtered by the same schedule list `filters`.
+    """
+    archive = ScheduleFilter(filters, queryset=ScheduleArchive.objects.all()).qs
+    return shard_querysets(queryset) + shard_querysets(archive)
+
+
+def iter_schedule_rows(queryset, batch_size):
+    """
+    Yields the exported fields for every schedule in the queryset, reading
+    the rows in batches ordered by id so that memory use stays constant.
+    """
+    queryset = queryset.order_by("id").values(*EXPORT_FIELDS)
+    last_id = None
+    while True:
+        page = queryset if last_id is None else queryset.filter(id__gt=last_id)
+        rows = list(page[:batch_size])
+        for row in rows:
+            yield row
+        if len(rows) < batch_size:
+            return
+        last_id = rows[-1]["id"]
+
+
+def ndjson_lines(rows):
+    for row in rows:
+        yield json.dumps(row, cls=DjangoJSONEncoder) + "\n"
+
+
+class Echo(object):
+
+    """
+    A file-like object for csv.writer that returns what is written to it.
+    """
+
+    def write(self, value):
+        return value
+
+
+def csv_value(value):
+    if value is None:
+        return ""
+    if isinstance(value, (dict, list)):
+        return json.dumps(value)
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return value
+
+
+def csv_lines(rows):
+    writer = csv.writer(Echo())
+    yield writer.writerow(EXPORT_FIELDS)
+    for row in rows:
+        yield writer.writerow([csv_value(row[field]) for field in EXPORT_FIELDS])
+
+
+EXPORT_FORMATS = {
+    "ndjson": ("application/x-ndjson", ndjson_lines),
+    "csv": ("text/csv", csv_lines),
+}
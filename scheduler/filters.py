@@ -0,0 +1,31 @@
+from django_filters import rest_framework as filters
+
+from .models import Delivery, Schedule
+
+
+class ScheduleFilter(filters.FilterSet):
+    class Meta:
+        model = Schedule
+        fields = {
+            "enabled": ["exact"],
+            "external_id": ["exact"],
+            "cron_definition": ["exact"],
+            "interval_definition": ["exact"],
+            "endpoint": ["exact"],
+            "created_at": ["gte", "lte"],
+            "updated_at": ["gte", "lte"],
+            "last_run": ["gte", "lte"],
+            "failure_count": ["gte"],
+            "consecutive_failures": ["gte"],
+            "last_status_code": ["exact"],
+            "last_error_at": ["gte", "lte"],
+        }
+
+
+class DeliveryFilter(filters.FilterSet):
+    # The ledger is only indexed by schedule, so one is always needed
+    schedule = filters.UUIDFilter(field_name="schedule_id", required=True)
+
+    class Meta:
+        model = Delivery
+        fields = {"fired_at": ["gte", "lte"], "status_code": ["exact"]}
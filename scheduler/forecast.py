@@ -0,0 +1,209 @@
+import time
+from datetime import timedelta
+from functools import lru_cache
+from itertools import chain
+
+import numpy as np
+from celery.schedules import ParseException, crontab
+from django.db.models import Count, F, Func, Value
+from django.utils import timezone
+from djcelery.models import CrontabSchedule, IntervalSchedule, PeriodicTask
+
+from .definitions import CRONTAB_FIELD_RANGES, QUEUE_TASKS_TASK
+from .models import Schedule
+from .shards import shard_querysets
+
+# The number of definition minutes expanded at a time, which bounds the size
+# of the definitions by minutes matrices, and of the float copy of them that
+# the matrix product makes, to 8MB however long the forecast is
+CHUNK_CELLS = 2 ** 20
+
+# The size of the lookup table for each crontab field, indexed by value
+CRONTAB_FIELD_SIZES = {name: high + 1 for name, _, _, high in CRONTAB_FIELD_RANGES}
+
+
+class Host(Func):
+
+    """
+    The host of a URL, using a Postgres regular expression substring.
+    """
+
+    function = "substring"
+    template = "%(function)s(%(expressions)s)"
+
+    def __init__(self, expression, **extra):
+        super(Host, self).__init__(
+            expression, Value(r"^[A-Za-z+.-]+://(?:[^@/]*@)?([^:/?#]+)"), **extra
+        )
+
+
+def minute_fields(start, minutes):
+    """
+    Returns an array of each crontab field's value for every minute in the
+    window, with Sunday as day 0 of the week.
+    """
+    start = start.astimezone(timezone.utc).replace(tzinfo=None)
+    times = np.datetime64(start, "m") + np.arange(minutes)
+    months = times.astype("datetime64[M]")
+    days = times.astype("datetime64[D]")
+    return {
+        "minute": times.astype(np.int64) % 60,
+        "hour": times.astype("datetime64[h]").astype(np.int64) % 24,
+        "day_of_month": (days - months.astype("datetime64[D]")).astype(np.int64) + 1,
+        "month_of_year": months.astype(np.int64) % 12 + 1,
+        # 1970-01-01 was a Thursday
+        "day_of_week": (days.astype(np.int64) + 4) % 7,
+    }
+
+
+@lru_cache(maxsize=None)
+def crontab_masks(minute, hour, day_of_month, month_of_year, day_of_week):
+    """
+    Returns a lookup table for each field of a crontab, of whether the
+    crontab fires on each value, using the same parser as celery beat.
+    """
+    entry = crontab(
+        minute=minute,
+        hour=hour,
+        day_of_month=day_of_month,
+        month_of_year=month_of_year,
+        day_of_week=day_of_week,
+    )
+    masks = {}
+    for name, size in CRONTAB_FIELD_SIZES.items():
+        mask = np.zeros(size, dtype=bool)
+        mask[list(getattr(entry, name))] = True
+        masks[name] = mask
+    return masks
+
+
+def crontab_fires(definitions, fields):
+    """
+    Returns a definitions by minutes matrix of whether each crontab
+    definition fires in each minute.
+    """
+    fires = None
+    for name in CRONTAB_FIELD_SIZES:
+        # A definitions by values table, indexed by every minute's value
+        table = np.stack([masks[name] for masks in definitions])
+        field_fires = table[:, fields[name]]
+        fires = field_fires if fires is None else fires & field_fires
+    return fires
+
+
+def interval_fires(interval, last_run_at, start, minutes):
+    """
+    Returns the number of times that an interval definition fires in each
+    minute of the window. Beat runs an interval definition straight away if
+    it has never run, and then every interval after its last run.
+    """
+    every = timedelta(**{interval.period: interval.every}).total_seconds()
+    if every <= 0:
+        return np.zeros(minutes, dtype=np.int64)
+    if last_run_at is None:
+        offset = 0.0
+    else:
+        offset = ((last_run_at - start).total_seconds() + every) % every
+    seconds = np.arange(offset, minutes * 60, every)
+    return np.bincount((seconds // 60).astype(np.int64), minlength=minutes)
+
+
+def forecast(start, minutes):
+    """
+    Returns the expected number of deliveries in each of the `minutes`
+    minutes (at least one) from `start`, for all of the enabled schedules,
+    along with the totals and peak minute for each endpoint host.
+
+    Schedules are counted per definition and host in the database, on each
+    shard, and every definition's fire times are expanded at once as NumPy
+    arrays.
+    """
+    started = time.time()
+    start = start.replace(second=0, microsecond=0)
+    counts = (
+        Schedule.objects.filter(enabled=True)
+        .annotate(host=Host(F("endpoint")))
+        .values("celery_cron_definition", "celery_interval_definition", "host")
+        .annotate(count=Count("id"))
+    )
+    hosts = {}
+    crontab_counts = {}
+    interval_counts = {}
+    for row in chain.from_iterable(shard_querysets(counts)):
+        host = hosts.setdefault(row["host"] or "", len(hosts))
+        if row["celery_cron_definition"] is not None:
+            key = (row["celery_cron_definition"], host)
+            crontab_counts[key] = crontab_counts.get(key, 0) + row["count"]
+        if row["celery_interval_definition"] is not None:
+            key = (row["celery_interval_definition"], host)
+            interval_counts[key] = interval_counts.get(key, 0) + row["count"]
+
+    # deliveries[host, minute], as floats so that the matrix products use
+    # BLAS, which is exact for counts like these
+    deliveries = np.zeros((len(hosts), minutes))
+    skipped = 0
+
+    crontabs = CrontabSchedule.objects.in_bulk(
+        set(crontab_id for crontab_id, _ in crontab_counts)
+    )
+    fields = minute_fields(start, minutes)
+    masks, weights = [], []
+    for (crontab_id, host), count in crontab_counts.items():
+        definition = crontabs[crontab_id]
+        try:
+            masks.append(
+                crontab_masks(*(getattr(definition, n) for n in CRONTAB_FIELD_SIZES))
+            )
+        except (ParseException, ValueError):
+            skipped += count
+            continue
+        weights.append((host, count))
+    chunk_size = max(CHUNK_CELLS // minutes, 1)
+    for index in range(0, len(masks), chunk_size):
+        end = index + chunk_size
+        fires = crontab_fires(masks[index:end], fields)
+        # weights_by_host[host, definition] @ fires[definition, minute]
+        chunk_hosts, chunk_counts = zip(*weights[index:end])
+        weights_by_host = np.zeros((len(hosts), len(chunk_hosts)))
+        weights_by_host[chunk_hosts, np.arange(len(chunk_hosts))] = chunk_counts
+        deliveries += weights_by_host @ fires
+
+    intervals = IntervalSchedule.objects.in_bulk(
+        set(interval_id for interval_id, _ in interval_counts)
+    )
+    last_runs = dict(
+        PeriodicTask.objects.filter(
+            task=QUEUE_TASKS_TASK, interval__in=list(intervals)
+        ).values_list("interval", "last_run_at")
+    )
+    for (interval_id, host), count in interval_counts.items():
+        deliveries[host] += count * interval_fires(
+            intervals[interval_id], last_runs.get(interval_id), start, minutes
+        )
+
+    deliveries = deliveries.round().astype(np.int64)
+    histogram = deliveries.sum(axis=0)
+    peak = int(histogram.argmax())
+    return {
+        "start": start.isoformat(),
+        "minutes": minutes,
+        "total": int(histogram.sum()),
+        "peak": {
+            "at": (start + timedelta(minutes=peak)).isoformat(),
+            "deliveries": int(histogram[peak]),
+        },
+        "histogram": histogram.tolist(),
+        "hosts": sorted(
+            (
+                {
+                    "host": name,
+                    "total": int(deliveries[host].sum()),
+                    "peak": int(deliveries[host].max()),
+                }
+                for name, host in hosts.items()
+            ),
+            key=lambda item: (-item["total"], item["host"]),
+        ),
+        "skipped": skipped,
+        "seconds": round(time.time() - started, 3),
+    }
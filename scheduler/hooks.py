@@ -0,0 +1,75 @@
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from rest_hooks.models import HOOK_EVENTS, Hook
+
+from .cache import TieredCache
+
+hook_cache = TieredCache(
+    "hooks",
+    settings.SCHEDULER_HOOK_CACHE_TTL,
+    shared=settings.SCHEDULER_HOOK_SHARED_CACHE,
+    shared_ttl=settings.SCHEDULER_HOOK_SHARED_CACHE_TTL,
+)
+
+# The tag of every cached list of hooks, which are all invalidated together
+HOOKS_TAG = "hooks"
+
+
+def get_hooks(event_name):
+    """
+    Returns the hooks subscribed to an event, from the cache if possible.
+    """
+    hooks = hook_cache.get(event_name)
+    if hooks is None:
+        hooks = list(Hook.objects.filter(event=event_name))
+        hook_cache.set(event_name, hooks, tags=[HOOKS_TAG])
+    return hooks
+
+
+@receiver(post_save, sender=Hook)
+@receiver(post_delete, sender=Hook)
+def hook_changed(sender, instance, **kwargs):
+    hook_cache.invalidate(HOOKS_TAG)
+    # Other processes may have cached the hooks again before the change was
+    # committed
+    transaction.on_commit(lambda: hook_cache.invalidate(HOOKS_TAG))
+
+
+def find_and_fire_hook(event_name, instance, user_override=None):
+    """
+    A HOOK_FINDER that looks up the hooks from the cache, and batches the
+    deliveries in the outbox when SCHEDULER_HOOK_BATCH_INTERVAL is set.
+    Otherwise it works like the rest_hooks finder.
+    """
+    from .tasks import deliver_batched_hook
+
+    if event_name not in HOOK_EVENTS:
+        raise Exception(
+            '"{}" does not exist in `settings.HOOK_EVENTS`.'.format(event_name)
+        )
+
+    hooks = get_hooks(event_name)
+    # Ignore the user if the user_override is False
+    if user_override is not False:
+        if user_override:
+            user = user_override
+        elif hasattr(instance, "user"):
+            user = instance.user
+        elif isinstance(instance, User):
+            user = instance
+        else:
+            raise Exception(
+                "{} has no `user` property. REST Hooks needs this.".format(
+                    repr(instance)
+                )
+            )
+        hooks = [hook for hook in hooks if hook.user_id == getattr(user, "pk", None)]
+
+    for hook in hooks:
+        if settings.SCHEDULER_HOOK_BATCH_INTERVAL:
+            deliver_batched_hook(hook, hook.serialize_hook(instance)["data"])
+        else:
+            hook.deliver_hook(instance)
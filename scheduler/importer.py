@@ -0,0 +1,264 @@
+import codecs
+import csv
+import io
+import json
+import logging
+import time
+from datetime import datetime
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db import DatabaseError, connection, models, transaction
+from django.utils import timezone
+
+from .bulk import batched, log_throughput
+from .definitions import DefinitionCache
+from .export import EXPORT_FIELDS
+from .models import Schedule
+
+logger = logging.getLogger(__name__)
+
+# Imports accept the same fields as exports, so that an export from one
+# environment can be loaded into another.
+IMPORT_FIELDS = EXPORT_FIELDS
+
+# Each chunk is copied into this temporary table, and inserted from there
+STAGING_TABLE = "scheduler_import_staging"
+
+EXISTS_ERROR = "A schedule with this value already exists."
+DUPLICATE_ERROR = "An earlier row in the import has the same value."
+
+
+def iter_lines(stream, encoding=None):
+    """
+    Yields the non-blank lines of a newline delimited JSON stream. The lines
+    are parsed along with the rest of the row, so that a bad line is
+    rejected instead of stopping the import.
+    """
+    reader = codecs.getreader(encoding or settings.DEFAULT_CHARSET)(stream)
+    for line in reader:
+        line = line.strip()
+        if line:
+            yield line
+
+
+def iter_csv(stream, encoding=None):
+    """
+    Yields a dict for each row of a CSV stream with a header row.
+    """
+    reader = codecs.getreader(encoding or settings.DEFAULT_CHARSET)(stream)
+    for row in csv.DictReader(reader):
+        yield row
+
+
+IMPORT_FORMATS = {"ndjson": iter_lines, "csv": iter_csv}
+
+
+def clean_row(row, user=None):
+    """
+    Returns an unsaved Schedule for an imported row, using the model field
+    validation. Raises a ValidationError if the row is invalid.
+    """
+    if isinstance(row, str):
+        try:
+            row = json.loads(row)
+        except ValueError as exc:
+            raise ValidationError("Invalid JSON: %s" % exc)
+    if not isinstance(row, dict):
+        raise ValidationError("Expected an object.")
+
+    values = {}
+    errors = {}
+    for name in IMPORT_FIELDS:
+        if name not in row:
+            continue
+        field = Schedule._meta.get_field(name)
+        value = row[name]
+        # CSV can't tell the difference between empty and null
+        if value == "" and field.null:
+            value = None
+        if value is None and field.null:
+            values[name] = None
+            continue
+        try:
+            if name == "payload" and isinstance(value, str):
+                try:
+                    value = json.loads(value)
+                except ValueError as exc:
+                    raise ValidationError("Invalid JSON: %s" % exc)
+            value = field.clean(value, None)
+        except ValidationError as exc:
+            errors[name] = exc.messages
+            continue
+        if isinstance(field, models.DateTimeField) and timezone.is_naive(value):
+            value = timezone.make_aware(value, timezone.utc)
+        values[name] = value
+
+    if not values.get("endpoint") and "endpoint" not in errors:
+        errors["endpoint"] = ["This field is required."]
+    if errors:
+        raise ValidationError(errors)
+    return Schedule(created_by=user, updated_by=user, **values)
+
+
+def copy_value(value):
+    if value is None:
+        return None
+    if isinstance(value, bool):
+        return "t" if value else "f"
+    if isinstance(value, (dict, list)):
+        return json.dumps(value)
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return value
+
+
+def copy_schedules(schedules):
+    """
+    Loads the schedules into a staging table with a single COPY, and inserts
+    them into the schedule table from there, skipping the ones whose id or
+    external id is already taken. Returns the ids of the schedules that were
+    inserted. Schedules without timestamps get the current time, and
+    existing timestamps are kept as they are.
+    """
+    fields = Schedule._meta.concrete_fields
+    timestamp = timezone.now()
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for schedule in schedules:
+        row = []
+        for field in fields:
+            value = getattr(schedule, field.attname)
+            if value is None and (
+                getattr(field, "auto_now", False)
+                or getattr(field, "auto_now_add", False)
+            ):
+                value = timestamp
+            # Empty strings are validated away, so an empty value is a null
+            row.append(copy_value(value))
+        writer.writerow(row)
+    buffer.seek(0)
+
+    qn = connection.ops.quote_name
+    table = qn(Schedule._meta.db_table)
+    staging = qn(STAGING_TABLE)
+    columns = ", ".join(qn(field.column) for field in fields)
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "CREATE TEMPORARY TABLE %s (LIKE %s INCLUDING DEFAULTS) ON COMMIT DROP"
+            % (staging, table)
+        )
+        cursor.copy_expert(
+            "COPY %s (%s) FROM STDIN WITH (FORMAT csv)" % (staging, columns), buffer
+        )
+        cursor.execute(
+            "INSERT INTO %s (%s) SELECT %s FROM %s ON CONFLICT DO NOTHING "
+            "RETURNING id" % (table, columns, columns, staging)
+        )
+        inserted = set(schedule_id for schedule_id, in cursor.fetchall())
+        cursor.execute("DROP TABLE %s" % staging)
+    return inserted
+
+
+def conflict_errors(schedules):
+    """
+    Returns the errors for schedules that weren't inserted, by whether their
+    id or their external id was already taken.
+    """
+    if not schedules:
+        return {}
+    taken = set(
+        Schedule.objects.filter(
+            id__in=[schedule.id for schedule in schedules]
+        ).values_list("id", flat=True)
+    )
+    return {
+        schedule.id: {"id": [EXISTS_ERROR]}
+        if schedule.id in taken
+        else {"external_id": [EXISTS_ERROR]}
+        for schedule in schedules
+    }
+
+
+def import_schedules(rows, user=None, chunk_size=None, max_errors=None):
+    """
+    Validates and loads schedules from an iterable of rows in chunks, each
+    chunk with a single COPY in its own transaction. Rows whose id or
+    external id is already taken are rejected on their own, without the
+    rest of their chunk. Each distinct cron and interval definition is only
+    resolved once. No webhooks are fired.
+
+    Returns the number of schedules imported and rejected, the errors for
+    the first `max_errors` rejected rows by their 1-based row number, and
+    the import rate.
+    """
+    chunk_size = chunk_size or settings.SCHEDULER_IMPORT_CHUNK_SIZE
+    if max_errors is None:
+        max_errors = settings.SCHEDULER_IMPORT_MAX_ERRORS
+    started = time.time()
+    definitions = DefinitionCache()
+    summary = {"imported": 0, "rejected": 0, "errors": []}
+
+    def reject(number, errors):
+        summary["rejected"] += 1
+        if len(summary["errors"]) < max_errors:
+            summary["errors"].append({"row": number, "errors": errors})
+
+    for chunk in batched(enumerate(rows, 1), chunk_size):
+        schedules = []
+        numbers = []
+        rejected = []
+        ids = set()
+        external_ids = set()
+        for number, row in chunk:
+            try:
+                schedule = clean_row(row, user)
+            except ValidationError as exc:
+                rejected.append(
+                    (number, getattr(exc, "message_dict", None) or exc.messages)
+                )
+                continue
+            # Duplicates within a chunk would be inserted in any order, so
+            # the later ones are rejected here
+            if schedule.id in ids:
+                rejected.append((number, {"id": [DUPLICATE_ERROR]}))
+                continue
+            if schedule.external_id in external_ids:
+                rejected.append((number, {"external_id": [DUPLICATE_ERROR]}))
+                continue
+            ids.add(schedule.id)
+            if schedule.external_id is not None:
+                external_ids.add(schedule.external_id)
+            schedules.append(definitions.resolve(schedule))
+            numbers.append(number)
+
+        if schedules:
+            try:
+                with transaction.atomic():
+                    inserted = copy_schedules(schedules)
+            except DatabaseError as exc:
+                logger.warning(
+                    "Rejected rows %s-%s: %s" % (numbers[0], numbers[-1], exc)
+                )
+                rejected.extend((number, [str(exc).strip()]) for number in numbers)
+            else:
+                summary["imported"] += len(inserted)
+                skipped = [
+                    (number, schedule)
+                    for number, schedule in zip(numbers, schedules)
+                    if schedule.id not in inserted
+                ]
+                errors = conflict_errors([schedule for _, schedule in skipped])
+                rejected.extend(
+                    (number, errors[schedule.id]) for number, schedule in skipped
+                )
+        for number, errors in sorted(rejected, key=lambda rejection: rejection[0]):
+            reject(number, errors)
+
+    elapsed = time.time() - started
+    log_throughput("Imported", summary["imported"], started)
+    summary["seconds"] = round(elapsed, 3)
+    summary["rows_per_second"] = round(
+        summary["imported"] / elapsed if elapsed else summary["imported"]
+    )
+    return summary
@@ -0,0 +1,96 @@
+import json
+
+from django.core.management import BaseCommand, CommandError
+
+from scheduler.benchmark import Benchmark
+from scheduler.models import Schedule
+from scheduler.shards import shard_querysets, sharded
+
+
+class Command(BaseCommand):
+    help = (
+        "Seed synthetic schedules, queue and deliver them to local HTTP stubs, "
+        "and print the throughput, delivery latency, query counts and peak "
+        "memory use as JSON."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--schedules",
+            type=int,
+            default=1000,
+            help="The number of schedules to seed. Defaults to 1000.",
+        )
+        parser.add_argument(
+            "--definitions",
+            type=int,
+            default=10,
+            help="The number of cron definitions to spread them over. Defaults to 10.",
+        )
+        parser.add_argument(
+            "--payload-bytes",
+            type=int,
+            default=100,
+            help="The size of each schedule's payload. Defaults to 100.",
+        )
+        parser.add_argument(
+            "--hosts",
+            type=int,
+            default=1,
+            help="The number of endpoint hosts, each with its own stub. Defaults to 1.",
+        )
+        parser.add_argument(
+            "--latency",
+            type=float,
+            default=0,
+            help="The number of seconds that the stubs take to answer.",
+        )
+        parser.add_argument(
+            "--error-rate",
+            type=float,
+            default=0,
+            help="The fraction of deliveries that the stubs fail, from 0 to 1.",
+        )
+        parser.add_argument(
+            "--concurrency",
+            type=int,
+            default=10,
+            help="The number of deliveries sent at the same time. Defaults to 10.",
+        )
+        parser.add_argument(
+            "--keep",
+            action="store_true",
+            help="Keep the seeded schedules instead of deleting them afterwards.",
+        )
+        parser.add_argument(
+            "--force",
+            action="store_true",
+            help="Run even though the database already has schedules.",
+        )
+        parser.add_argument("--seed", type=int, default=0)
+
+    def handle(self, *args, **options):
+        if sharded():
+            raise CommandError(
+                "The benchmark only seeds the default database, and can't be "
+                "run against sharded schedules."
+            )
+        if not options["force"] and any(
+            queryset.exists() for queryset in shard_querysets(Schedule.objects.all())
+        ):
+            raise CommandError(
+                "The database already has schedules. The benchmark is meant for "
+                "an empty database. Use --force to run it anyway."
+            )
+        benchmark = Benchmark(
+            schedules=options["schedules"],
+            definitions=options["definitions"],
+            payload_bytes=options["payload_bytes"],
+            hosts=options["hosts"],
+            latency=options["latency"],
+            error_rate=options["error_rate"],
+            concurrency=options["concurrency"],
+            keep=options["keep"],
+            seed=options["seed"],
+        )
+        self.stdout.write(json.dumps(benchmark.run()))
@@ -0,0 +1,68 @@
+from itertools import chain
+
+from django.conf import settings
+from django.core.management import BaseCommand, CommandError
+
+from scheduler.export import EXPORT_FORMATS, export_querysets, iter_schedule_rows
+from scheduler.filters import ScheduleFilter
+from scheduler.models import Schedule
+
+
+def parse_filter(filter_string):
+    name, sep, value = filter_string.partition("=")
+    if not sep:
+        raise CommandError(
+            "Invalid filter format: %s, expected <name>=<value>" % filter_string
+        )
+    return name, value
+
+
+class Command(BaseCommand):
+    help = (
+        "Export schedules as newline delimited JSON or CSV, using the same "
+        "filters as the schedule list API."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--output-format",
+            choices=sorted(EXPORT_FORMATS),
+            default="ndjson",
+            help="The format to export in. Defaults to `ndjson`.",
+        )
+        parser.add_argument(
+            "--output",
+            type=str,
+            default=None,
+            help="The file to write to. Defaults to stdout.",
+        )
+        parser.add_argument(
+            "--filter",
+            type=parse_filter,
+            action="append",
+            default=[],
+            help=(
+                "A schedule list API filter as <name>=<value>, "
+                "e.g.: `enabled=true`. Can be given more than once."
+            ),
+        )
+
+    def handle(self, *args, **options):
+        filters = dict(options["filter"])
+        filterset = ScheduleFilter(filters, queryset=Schedule.objects.all())
+        if not filterset.is_valid():
+            raise CommandError("Invalid filters: %s" % dict(filterset.errors))
+
+        _, lines = EXPORT_FORMATS[options["output_format"]]
+        rows = chain.from_iterable(
+            iter_schedule_rows(queryset, settings.SCHEDULER_BULK_BATCH_SIZE)
+            for queryset in export_querysets(filterset.qs, filters)
+        )
+
+        if options["output"]:
+            with open(options["output"], "w", newline="") as output:
+                for line in lines(rows):
+                    output.write(line)
+        else:
+            for line in lines(rows):
+                self.stdout.write(line, ending="")
@@ -0,0 +1,41 @@
+import json
+
+from django.core.management import BaseCommand, CommandError
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from scheduler.forecast import forecast
+
+
+class Command(BaseCommand):
+    help = (
+        "Print the expected number of deliveries in each minute of a window, "
+        "for all of the enabled schedules, as JSON."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--start",
+            type=str,
+            default=None,
+            help="The ISO 8601 start of the window. Defaults to now.",
+        )
+        parser.add_argument(
+            "--minutes",
+            type=int,
+            default=1440,
+            help="The length of the window in minutes. Defaults to 1440.",
+        )
+
+    def handle(self, *args, **options):
+        start = timezone.now()
+        if options["start"]:
+            start = parse_datetime(options["start"])
+            if start is None:
+                raise CommandError("Invalid start: %s" % options["start"])
+            if timezone.is_naive(start):
+                start = timezone.make_aware(start, timezone.utc)
+        if options["minutes"] < 1:
+            raise CommandError("Minutes must be at least 1")
+
+        self.stdout.write(json.dumps(forecast(start, options["minutes"])))
@@ -0,0 +1,50 @@
+import json
+import sys
+
+from django.contrib.auth.models import User
+from django.core.management import BaseCommand, CommandError
+
+from scheduler.importer import IMPORT_FORMATS, import_schedules
+
+
+class Command(BaseCommand):
+    help = (
+        "Import schedules from newline delimited JSON or CSV, in the format "
+        "written by export_schedules, using Postgres COPY."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "input", type=str, help="The file to read from, or `-` for stdin."
+        )
+        parser.add_argument(
+            "--input-format",
+            choices=sorted(IMPORT_FORMATS),
+            default="ndjson",
+            help="The format to import from. Defaults to `ndjson`.",
+        )
+        parser.add_argument(
+            "--user",
+            type=str,
+            default=None,
+            help="The username to set as the creator of the imported schedules.",
+        )
+
+    def handle(self, *args, **options):
+        user = None
+        if options["user"]:
+            try:
+                user = User.objects.get(username=options["user"])
+            except User.DoesNotExist:
+                raise CommandError("User not found: %s" % options["user"])
+
+        iter_rows = IMPORT_FORMATS[options["input_format"]]
+        if options["input"] == "-":
+            summary = import_schedules(iter_rows(sys.stdin.buffer), user)
+        else:
+            with open(options["input"], "rb") as stream:
+                summary = import_schedules(iter_rows(stream), user)
+
+        self.stdout.write(json.dumps(summary))
+        if summary["rejected"]:
+            self.stderr.write("Rejected %s rows" % summary["rejected"])
@@ -0,0 +1,101 @@
+import json
+
+from django.core.exceptions import ValidationError
+from django.core.management import BaseCommand, CommandError
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from scheduler.models import validate_crontab, validate_interval
+from scheduler.simulation import DEFAULT_DEFINITIONS, Simulation, is_interval
+
+
+class Command(BaseCommand):
+    help = (
+        "Replay celery beat, queuing and delivery for a set of definitions "
+        "against a virtual clock, and print the duplicate and missed runs and "
+        "deliveries, latencies and throughput as JSON. Nothing is kept in the "
+        "database, but it should be otherwise empty."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--definition",
+            action="append",
+            dest="definitions",
+            help="A cron or interval definition to simulate. Can be repeated.",
+        )
+        parser.add_argument(
+            "--schedules",
+            type=int,
+            default=10,
+            help="The number of schedules for each definition. Defaults to 10.",
+        )
+        parser.add_argument(
+            "--hours",
+            type=float,
+            default=24,
+            help="The number of hours to simulate. Defaults to 24.",
+        )
+        parser.add_argument(
+            "--start",
+            type=str,
+            default=None,
+            help="The ISO 8601 time to start the simulation at. Defaults to now.",
+        )
+        parser.add_argument(
+            "--beat-delay",
+            type=float,
+            default=0,
+            help="The most seconds that a task sent by beat waits in the queue.",
+        )
+        parser.add_argument(
+            "--beat-skew",
+            type=float,
+            default=0,
+            help="How many seconds beat's clock is ahead of the workers' clocks.",
+        )
+        parser.add_argument(
+            "--restarts",
+            type=int,
+            default=0,
+            help="The number of times that beat is restarted.",
+        )
+        parser.add_argument(
+            "--no-deliver",
+            action="store_false",
+            dest="deliver",
+            help="Count the deliveries instead of sending them.",
+        )
+        parser.add_argument("--seed", type=int, default=0)
+
+    def handle(self, *args, **options):
+        start = None
+        if options["start"]:
+            start = parse_datetime(options["start"])
+            if start is None:
+                raise CommandError("Invalid start: %s" % options["start"])
+            if timezone.is_naive(start):
+                start = timezone.make_aware(start, timezone.utc)
+
+        definitions = options["definitions"] or DEFAULT_DEFINITIONS
+        for definition in definitions:
+            validate = (
+                validate_interval if is_interval(definition) else validate_crontab
+            )
+            try:
+                validate(definition)
+            except ValidationError as exc:
+                raise CommandError("; ".join(exc.messages))
+
+        simulation = Simulation(
+            definitions=definitions,
+            schedules=options["schedules"],
+            hours=options["hours"],
+            start=start,
+            beat_delay=options["beat_delay"],
+            beat_skew=options["beat_skew"],
+            restarts=options["restarts"],
+            deliver=options["deliver"],
+            seed=options["seed"],
+        )
+        self.stdout.write(json.dumps(simulation.run()))
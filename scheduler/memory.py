@@ -0,0 +1,165 @@
+import os
+import resource
+import sys
+import threading
+import tracemalloc
+
+from billiard import current_process
+from celery.signals import task_postrun, task_prerun, worker_process_init
+from celery.utils.log import get_task_logger
+from django.conf import settings
+
+logger = get_task_logger(__name__)
+
+# The exit code that tells the pool that a worker process stopped to be
+# replaced, rather than because of an error
+EX_RECYCLE = 0x9B
+
+
+def peak_rss():
+    """
+    Returns the peak resident set size of this process in bytes.
+    """
+    # Linux reports this in kilobytes
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def rss():
+    """
+    Returns the current resident set size of this process in bytes.
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except (IOError, OSError):
+        return peak_rss()
+
+
+class MemoryTracker(object):
+
+    """
+    Measures the memory that each task run leaves a worker process using, and
+    asks for the process to be replaced once it uses more than
+    SCHEDULER_WORKER_MAX_RSS_BYTES.
+
+    With SCHEDULER_MEMORY_TRACKING, allocations are also traced, and every
+    SCHEDULER_MEMORY_REPORT_EVERY tasks the lines that allocated the most
+    since the last report are logged.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pid = None
+        self.tasks = 0
+        self.started = {}
+        self.snapshot = None
+        self.recycle = False
+
+    def start(self):
+        """
+        Starts tracking a new process, which may have been forked from a
+        process that was already tracked.
+        """
+        self.pid = os.getpid()
+        self.tasks = 0
+        self.started = {}
+        self.recycle = False
+        self.snapshot = None
+        if settings.SCHEDULER_MEMORY_TRACKING:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            self.snapshot = self.take_snapshot()
+
+    def take_snapshot(self):
+        return tracemalloc.take_snapshot().filter_traces(
+            (
+                tracemalloc.Filter(False, tracemalloc.__file__),
+                tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+            )
+        )
+
+    def task_started(self, task_id):
+        with self.lock:
+            if self.pid != os.getpid():
+                self.start()
+            self.started[task_id] = rss()
+
+    def task_finished(self, task_id, task_name):
+        """
+        Records the memory used by a task run, and returns the current RSS.
+        """
+        with self.lock:
+            if task_id not in self.started:
+                return None
+            used = rss()
+            growth = used - self.started.pop(task_id)
+            self.tasks += 1
+            if settings.SCHEDULER_MEMORY_TRACKING:
+                logger.debug(
+                    "%s grew RSS by %s bytes to %s bytes" % (task_name, growth, used)
+                )
+                if self.tasks % settings.SCHEDULER_MEMORY_REPORT_EVERY == 0:
+                    self.report(used)
+            limit = settings.SCHEDULER_WORKER_MAX_RSS_BYTES
+            if limit and used > limit and not self.recycle:
+                logger.warning(
+                    "Replacing worker process %s after %s tasks, since it uses %s "
+                    "bytes of RSS" % (self.pid, self.tasks, used)
+                )
+                self.recycle = True
+                self.fire_metric("scheduler.worker.recycled.sum", 1)
+            return used
+
+    def report(self, used):
+        """
+        Logs the lines that allocated the most memory since the last report,
+        and returns their statistics.
+        """
+        snapshot = self.take_snapshot()
+        stats = snapshot.compare_to(self.snapshot, "lineno")
+        stats = stats[: settings.SCHEDULER_MEMORY_REPORT_TOP]
+        self.snapshot = snapshot
+        traced, _ = tracemalloc.get_traced_memory()
+        logger.info(
+            "Worker process %s uses %s bytes of RSS and %s traced bytes after %s "
+            "tasks. The most allocated since the last report:\n%s"
+            % (self.pid, used, traced, self.tasks, "\n".join(str(s) for s in stats))
+        )
+        self.fire_metric("scheduler.worker.rss_bytes.last", used)
+        return stats
+
+    def fire_metric(self, name, value):
+        from .tasks import fire_metric
+
+        fire_metric.delay(name, value)
+
+
+tracker = MemoryTracker()
+
+
+@worker_process_init.connect
+def start_worker_process(**kwargs):
+    tracker.start()
+    # The pool process asks for its next task through wait_for_job, after it
+    # has sent the result of the last one, so that is where it can stop
+    process = current_process()
+    wait_for_job = getattr(process, "wait_for_job", None)
+    if wait_for_job is None:
+        return
+
+    def recycling_wait_for_job(*args, **kwargs):
+        if tracker.recycle:
+            sys.exit(EX_RECYCLE)
+        return wait_for_job(*args, **kwargs)
+
+    process.wait_for_job = recycling_wait_for_job
+
+
+@task_prerun.connect
+def track_task_start(sender=None, task_id=None, **kwargs):
+    tracker.task_started(task_id)
+
+
+@task_postrun.connect
+def track_task_finish(sender=None, task_id=None, task=None, **kwargs):
+    tracker.task_finished(task_id, task.name if task is not None else None)
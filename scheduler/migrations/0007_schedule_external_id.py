@@ -0,0 +1,16 @@
+# Generated by Django 2.2.8 on 2026-10-19 09:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [("scheduler", "0006_schedule_last_run")]
+
+    operations = [
+        migrations.AddField(
+            model_name="schedule",
+            name="external_id",
+            field=models.CharField(blank=True, max_length=255, null=True, unique=True),
+        )
+    ]
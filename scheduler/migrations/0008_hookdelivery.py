@@ -0,0 +1,48 @@
+# Generated by Django 2.2.8 on 2026-10-19 11:40
+
+import django.contrib.postgres.fields.jsonb
+import django.core.serializers.json
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("rest_hooks", "0001_initial"),
+        ("scheduler", "0007_schedule_external_id"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="HookDelivery",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "payload",
+                    django.contrib.postgres.fields.jsonb.JSONField(
+                        encoder=django.core.serializers.json.DjangoJSONEncoder
+                    ),
+                ),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+                ("attempts", models.IntegerField(default=0)),
+                ("next_attempt_at", models.DateTimeField(db_index=True, null=True)),
+                ("last_error", models.TextField(blank=True, default="")),
+                (
+                    "hook",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to="rest_hooks.Hook",
+                    ),
+                ),
+            ],
+        )
+    ]
@@ -0,0 +1,140 @@
+from collections import OrderedDict
+
+from crontab import CronTab
+from django.db import migrations
+from django.utils import timezone
+
+# Frozen copies of the definitions in scheduler.definitions as they were when
+# this migration was written, so that later changes to them don't change
+# what it does
+QUEUE_TASKS_TASK = "seed_scheduler.scheduler.tasks.queue_tasks"
+
+CRONTAB_FIELD_RANGES = (
+    ("minute", "minute", 0, 59),
+    ("hour", "hour", 0, 23),
+    ("day_of_month", "day", 1, 31),
+    ("month_of_year", "month", 1, 12),
+    ("day_of_week", "weekday", 0, 6),
+)
+
+CRONTAB_FIELD_MAX_LENGTH = 64
+
+
+def compress_values(values, low, high):
+    if len(values) >= 3:
+        step = values[1] - values[0]
+        if all(b - a == step for a, b in zip(values, values[1:])):
+            if values[0] == low and values[-1] + step > high:
+                return "*/%d" % step
+            if step == 1:
+                return "%d-%d" % (values[0], values[-1])
+            return "%d-%d/%d" % (values[0], values[-1], step)
+
+    parts = []
+    start = previous = values[0]
+    for value in values[1:] + [None]:
+        if value is not None and value == previous + 1:
+            previous = value
+            continue
+        if previous - start >= 2:
+            parts.append("%d-%d" % (start, previous))
+        else:
+            parts.extend(str(v) for v in range(start, previous + 1))
+        start = previous = value
+    return ",".join(parts)
+
+
+def canonical_field(matcher, low, high):
+    if matcher.any:
+        return "*"
+    if any(item.startswith("l") for item in matcher.split):
+        return matcher.input
+    values = sorted(matcher.allowed)
+    if values == list(range(low, high + 1)):
+        return "*"
+    field = compress_values(values, low, high)
+    if len(field) > CRONTAB_FIELD_MAX_LENGTH:
+        return matcher.input
+    return field
+
+
+def crontab_kwargs(cron_definition):
+    entry = CronTab(cron_definition)
+    return {
+        name: canonical_field(getattr(entry.matchers, attr), low, high)
+        for name, attr, low, high in CRONTAB_FIELD_RANGES
+    }
+
+
+def crontab_definition(crontab):
+    return " ".join(getattr(crontab, name) for name, _, _, _ in CRONTAB_FIELD_RANGES)
+
+
+def merge_crontab_schedules(apps, schema_editor):
+    """
+    Merges the CrontabSchedules that are equivalent into the oldest one,
+    moving their Schedules, QueueTaskRuns and other PeriodicTasks across, and
+    writes every CrontabSchedule in its canonical form.
+    """
+    CrontabSchedule = apps.get_model("djcelery", "CrontabSchedule")
+    PeriodicTask = apps.get_model("djcelery", "PeriodicTask")
+    PeriodicTasks = apps.get_model("djcelery", "PeriodicTasks")
+    Schedule = apps.get_model("scheduler", "Schedule")
+    QueueTaskRun = apps.get_model("scheduler", "QueueTaskRun")
+
+    groups = OrderedDict()
+    for crontab in CrontabSchedule.objects.order_by("id"):
+        try:
+            kwargs = crontab_kwargs(crontab_definition(crontab))
+        except ValueError:
+            # Leave anything that the scheduler wouldn't have created alone
+            continue
+        key = tuple(kwargs[name] for name, _, _, _ in CRONTAB_FIELD_RANGES)
+        groups.setdefault(key, []).append(crontab)
+
+    changed = False
+    for key, crontabs in groups.items():
+        kept, duplicate_ids = crontabs[0], [c.id for c in crontabs[1:]]
+        if duplicate_ids:
+            Schedule.objects.filter(celery_cron_definition__in=duplicate_ids).update(
+                celery_cron_definition=kept
+            )
+            QueueTaskRun.objects.filter(
+                celery_cron_definition__in=duplicate_ids
+            ).update(celery_cron_definition=kept)
+            # Keep one of the PeriodicTasks that queue the schedules, which
+            # reconcile_periodic_tasks disables again if none are enabled
+            tasks = PeriodicTask.objects.filter(
+                crontab__in=[c.id for c in crontabs], task=QUEUE_TASKS_TASK
+            ).order_by("crontab_id", "id")
+            task_ids = list(tasks.values_list("id", flat=True))
+            if task_ids:
+                PeriodicTask.objects.filter(id__in=task_ids[1:]).delete()
+                PeriodicTask.objects.filter(id=task_ids[0]).update(
+                    crontab=kept,
+                    args='["crontab", %s]' % kept.id,
+                    enabled=True,
+                    date_changed=timezone.now(),
+                )
+            PeriodicTask.objects.filter(crontab__in=duplicate_ids).update(crontab=kept)
+            CrontabSchedule.objects.filter(id__in=duplicate_ids).delete()
+            changed = True
+
+        kwargs = dict(zip([name for name, _, _, _ in CRONTAB_FIELD_RANGES], key))
+        if any(getattr(kept, name) != value for name, value in kwargs.items()):
+            CrontabSchedule.objects.filter(id=kept.id).update(**kwargs)
+            changed = True
+
+    if changed:
+        PeriodicTasks.objects.update_or_create(
+            ident=1, defaults={"last_update": timezone.now()}
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [("djcelery", "0001_initial"), ("scheduler", "0008_hookdelivery")]
+
+    operations = [
+        migrations.RunPython(merge_crontab_schedules, migrations.RunPython.noop)
+    ]
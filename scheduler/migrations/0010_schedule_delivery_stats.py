@@ -0,0 +1,41 @@
+# Generated by Django 2.2.8 on 2026-10-19 10:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [("scheduler", "0009_merge_crontab_schedules")]
+
+    operations = [
+        migrations.AddField(
+            model_name="schedule",
+            name="success_count",
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="schedule",
+            name="failure_count",
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="schedule",
+            name="consecutive_failures",
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="schedule",
+            name="last_status_code",
+            field=models.IntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="schedule",
+            name="last_latency",
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="schedule",
+            name="last_error_at",
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,43 @@
+# Generated by Django 2.2.8 on 2026-10-19 12:15
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [("scheduler", "0010_schedule_delivery_stats")]
+
+    operations = [
+        migrations.CreateModel(
+            name="Delivery",
+            fields=[
+                ("id", models.BigAutoField(primary_key=True, serialize=False)),
+                ("schedule_id", models.UUIDField()),
+                ("fired_at", models.DateTimeField()),
+                ("attempt", models.SmallIntegerField(default=1)),
+                ("status_code", models.IntegerField(blank=True, null=True)),
+                ("latency", models.FloatField()),
+                ("worker", models.CharField(blank=True, default="", max_length=255)),
+            ],
+            options={"db_table": "scheduler_delivery", "managed": False},
+        ),
+        # The partitions are created as they are needed, by
+        # scheduler.partitions
+        migrations.RunSQL(
+            sql=[
+                "CREATE TABLE scheduler_delivery ("
+                "id bigserial NOT NULL, "
+                "schedule_id uuid NOT NULL, "
+                "fired_at timestamp with time zone NOT NULL, "
+                "attempt smallint NOT NULL DEFAULT 1, "
+                "status_code integer NULL, "
+                "latency double precision NOT NULL, "
+                "worker varchar(255) NOT NULL DEFAULT '', "
+                "PRIMARY KEY (id, fired_at)"
+                ") PARTITION BY RANGE (fired_at)",
+                "CREATE INDEX scheduler_delivery_schedule_id_fired_at "
+                "ON scheduler_delivery (schedule_id, fired_at)",
+            ],
+            reverse_sql=["DROP TABLE scheduler_delivery"],
+        ),
+    ]
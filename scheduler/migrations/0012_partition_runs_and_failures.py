@@ -0,0 +1,226 @@
+from datetime import datetime, timedelta
+
+from django.db import migrations, transaction
+from django.utils import timezone
+
+
+# Frozen copies of the helpers in scheduler.partitions as they were when this
+# migration was written, so that later changes to them don't change what it
+# does
+def period_start(day, period):
+    if isinstance(day, datetime):
+        if timezone.is_aware(day):
+            day = day.astimezone(timezone.utc)
+        day = day.date()
+    if period == "month":
+        return day.replace(day=1)
+    return day
+
+
+def add_periods(start, period, count):
+    if period == "month":
+        month = start.year * 12 + start.month - 1 + count
+        return start.replace(year=month // 12, month=month % 12 + 1, day=1)
+    return start + timedelta(days=count)
+
+
+def period_bound(start):
+    return "%s 00:00:00+00" % start.isoformat()
+
+
+def default_partition_name(table):
+    return "%s_default" % table
+
+
+# The tables to partition, and the column to partition them by
+PARTITIONED_TABLES = [
+    ("QueueTaskRun", "started_at"),
+    ("ScheduleFailure", "initiated_at"),
+]
+
+
+def partition_table(apps, schema_editor):
+    """
+    Turns each table into a partitioned table, with the existing table as a
+    single partition for everything before the start of the month after
+    next. New partitions are created from there on by the manage_partitions
+    task, and rows that fall outside of all of them go in a default partition.
+
+    The existing rows stay where they are, and the only slow steps, building
+    the new primary key index and checking the existing rows' dates, don't
+    block reads or writes.
+    """
+    connection = schema_editor.connection
+    qn = schema_editor.quote_name
+    end = period_bound(add_periods(period_start(timezone.now(), "month"), "month", 2))
+    for model_name, key in PARTITIONED_TABLES:
+        table = apps.get_model("scheduler", model_name)._meta.db_table
+        legacy = "%s_legacy" % table
+        index = "%s_id_%s_uniq" % (table, key)
+        check = "%s_%s_check" % (table, key)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS {index} "
+                "ON {table} (id, {key})".format(
+                    index=qn(index), table=qn(table), key=qn(key)
+                )
+            )
+            cursor.execute(
+                "ALTER TABLE {table} ADD CONSTRAINT {check} "
+                "CHECK ({key} < %s) NOT VALID".format(
+                    table=qn(table), check=qn(check), key=qn(key)
+                ),
+                [end],
+            )
+            cursor.execute(
+                "ALTER TABLE {table} VALIDATE CONSTRAINT {check}".format(
+                    table=qn(table), check=qn(check)
+                )
+            )
+
+        with transaction.atomic(using=connection.alias), connection.cursor() as cursor:
+            cursor.execute("SELECT pg_get_serial_sequence(%s, 'id')", [table])
+            (sequence,) = cursor.fetchone()
+            cursor.execute(
+                "SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint "
+                "WHERE conrelid = %s::regclass AND contype = 'f'",
+                [table],
+            )
+            foreign_keys = cursor.fetchall()
+            cursor.execute(
+                "SELECT array_agg(a.attname::text ORDER BY k.n) FROM pg_index i "
+                "CROSS JOIN LATERAL unnest(i.indkey::int2[]) "
+                "WITH ORDINALITY AS k(attnum, n) "
+                "JOIN pg_attribute a "
+                "ON a.attrelid = i.indrelid AND a.attnum = k.attnum "
+                "WHERE i.indrelid = %s::regclass AND NOT i.indisunique "
+                "GROUP BY i.indexrelid",
+                [table],
+            )
+            indexes = [columns for columns, in cursor.fetchall()]
+            cursor.execute(
+                "SELECT conname FROM pg_constraint "
+                "WHERE conrelid = %s::regclass AND contype = 'p'",
+                [table],
+            )
+            (primary_key,) = cursor.fetchone()
+
+            # The primary key of a partitioned table has to include the
+            # partition key
+            cursor.execute(
+                "ALTER TABLE {table} DROP CONSTRAINT {primary_key}, "
+                "ADD CONSTRAINT {legacy_key} PRIMARY KEY USING INDEX {index}".format(
+                    table=qn(table),
+                    primary_key=qn(primary_key),
+                    legacy_key=qn("%s_pkey" % legacy),
+                    index=qn(index),
+                )
+            )
+            cursor.execute(
+                "ALTER TABLE {table} RENAME TO {legacy}".format(
+                    table=qn(table), legacy=qn(legacy)
+                )
+            )
+            cursor.execute(
+                "CREATE TABLE {table} (LIKE {legacy} INCLUDING DEFAULTS) "
+                "PARTITION BY RANGE ({key})".format(
+                    table=qn(table), legacy=qn(legacy), key=qn(key)
+                )
+            )
+            # The sequence would otherwise be dropped with the legacy partition
+            cursor.execute(
+                "ALTER SEQUENCE {sequence} OWNED BY {table}.id".format(
+                    sequence=sequence, table=qn(table)
+                )
+            )
+            cursor.execute(
+                "ALTER TABLE {table} ADD PRIMARY KEY (id, {key})".format(
+                    table=qn(table), key=qn(key)
+                )
+            )
+            # Matching indexes and foreign keys on the legacy partition are
+            # attached to these, rather than being built and checked again
+            for columns in indexes:
+                cursor.execute(
+                    "CREATE INDEX {index} ON {table} ({columns})".format(
+                        index=qn(
+                            schema_editor._create_index_name(
+                                table, columns, suffix="_part"
+                            )
+                        ),
+                        table=qn(table),
+                        columns=", ".join(qn(column) for column in columns),
+                    )
+                )
+            for name, definition in foreign_keys:
+                cursor.execute(
+                    "ALTER TABLE {table} ADD CONSTRAINT {name} {definition}".format(
+                        table=qn(table), name=qn(name), definition=definition
+                    )
+                )
+            # The check constraint means that the legacy rows don't have to
+            # be scanned again
+            cursor.execute(
+                "ALTER TABLE {table} ATTACH PARTITION {legacy} "
+                "FOR VALUES FROM (MINVALUE) TO (%s)".format(
+                    table=qn(table), legacy=qn(legacy)
+                ),
+                [end],
+            )
+            cursor.execute(
+                "ALTER TABLE {legacy} DROP CONSTRAINT {check}".format(
+                    legacy=qn(legacy), check=qn(check)
+                )
+            )
+            cursor.execute(
+                "CREATE TABLE {default} PARTITION OF {table} DEFAULT".format(
+                    default=qn(default_partition_name(table)), table=qn(table)
+                )
+            )
+
+
+def unpartition_table(apps, schema_editor):
+    """
+    Copies the rows of each partitioned table back into a plain table.
+    """
+    connection = schema_editor.connection
+    qn = schema_editor.quote_name
+    for model_name, _ in PARTITIONED_TABLES:
+        model = apps.get_model("scheduler", model_name)
+        table = model._meta.db_table
+        copy = "%s_copy" % table
+        with transaction.atomic(using=connection.alias), connection.cursor() as cursor:
+            cursor.execute(
+                "CREATE TABLE {copy} AS SELECT * FROM {table}".format(
+                    copy=qn(copy), table=qn(table)
+                )
+            )
+            cursor.execute("DROP TABLE {table} CASCADE".format(table=qn(table)))
+            schema_editor.create_model(model)
+            columns = ", ".join(
+                qn(field.column) for field in model._meta.concrete_fields
+            )
+            cursor.execute(
+                "INSERT INTO {table} ({columns}) SELECT {columns} FROM {copy}".format(
+                    table=qn(table), columns=columns, copy=qn(copy)
+                )
+            )
+            cursor.execute("DROP TABLE {copy}".format(copy=qn(copy)))
+            cursor.execute(
+                "SELECT setval(pg_get_serial_sequence(%s, 'id'), "
+                "COALESCE(MAX(id), 1), MAX(id) IS NOT NULL) FROM {table}".format(
+                    table=qn(table)
+                ),
+                [table],
+            )
+
+
+class Migration(migrations.Migration):
+
+    # Creating the new primary key indexes concurrently can't be done in a
+    # transaction
+    atomic = False
+
+    dependencies = [("scheduler", "0011_delivery")]
+
+    operations = [migrations.RunPython(partition_table, unpartition_table)]
@@ -0,0 +1,63 @@
+# Generated by Django 2.2.8 on 2026-10-19 14:21
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("djcelery", "0001_initial"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ("scheduler", "0012_partition_runs_and_failures"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="schedule",
+            name="celery_cron_definition",
+            field=models.ForeignKey(
+                blank=True,
+                db_constraint=False,
+                null=True,
+                on_delete=django.db.models.deletion.CASCADE,
+                to="djcelery.CrontabSchedule",
+            ),
+        ),
+        migrations.AlterField(
+            model_name="schedule",
+            name="celery_interval_definition",
+            field=models.ForeignKey(
+                blank=True,
+                db_constraint=False,
+                null=True,
+                on_delete=django.db.models.deletion.CASCADE,
+                to="djcelery.IntervalSchedule",
+            ),
+        ),
+        migrations.AlterField(
+            model_name="schedule",
+            name="created_by",
+            field=models.ForeignKey(
+                blank=True,
+                db_constraint=False,
+                null=True,
+                on_delete=django.db.models.deletion.SET_NULL,
+                related_name="schedules_created",
+                to=settings.AUTH_USER_MODEL,
+            ),
+        ),
+        migrations.AlterField(
+            model_name="schedule",
+            name="updated_by",
+            field=models.ForeignKey(
+                blank=True,
+                db_constraint=False,
+                null=True,
+                on_delete=django.db.models.deletion.SET_NULL,
+                related_name="schedules_updated",
+                to=settings.AUTH_USER_MODEL,
+            ),
+        ),
+    ]
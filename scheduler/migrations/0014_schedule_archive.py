@@ -0,0 +1,47 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    # The index on the schedule table is built concurrently, which can't be
+    # done in a transaction
+    atomic = False
+
+    dependencies = [("scheduler", "0013_schedule_unconstrained_references")]
+
+    operations = [
+        migrations.SeparateDatabaseAndState(
+            database_operations=[
+                migrations.RunSQL(
+                    "CREATE INDEX CONCURRENTLY IF NOT EXISTS "
+                    "scheduler_schedule_disabled ON scheduler_schedule (updated_at) "
+                    "WHERE NOT enabled",
+                    "DROP INDEX CONCURRENTLY IF EXISTS scheduler_schedule_disabled",
+                )
+            ],
+            state_operations=[
+                migrations.AddIndex(
+                    model_name="schedule",
+                    index=models.Index(
+                        condition=models.Q(enabled=False),
+                        fields=["updated_at"],
+                        name="scheduler_schedule_disabled",
+                    ),
+                )
+            ],
+        ),
+        # Schedules are moved to and from the archive by scheduler.archive, so
+        # it has the same columns, without the constraints that could stop a
+        # schedule from being archived
+        migrations.RunSQL(
+            sql=[
+                "CREATE TABLE scheduler_schedule_archive "
+                "(LIKE scheduler_schedule INCLUDING DEFAULTS)",
+                "ALTER TABLE scheduler_schedule_archive ADD PRIMARY KEY (id), "
+                "ADD COLUMN archived_at timestamp with time zone NOT NULL",
+                "CREATE INDEX scheduler_schedule_archive_external_id "
+                "ON scheduler_schedule_archive (created_by_id, external_id)",
+            ],
+            reverse_sql=["DROP TABLE scheduler_schedule_archive"],
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 2.2.8 on 2026-10-19 15:48
+
+import django.core.validators
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [("scheduler", "0014_schedule_archive")]
+
+    operations = [
+        migrations.AddField(
+            model_name="schedule",
+            name="end_at",
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="schedule",
+            name="max_runs",
+            field=models.IntegerField(
+                blank=True,
+                null=True,
+                validators=[django.core.validators.MinValueValidator(1)],
+            ),
+        ),
+        # The archive has the same columns as the schedule table
+        migrations.RunSQL(
+            sql=[
+                "ALTER TABLE scheduler_schedule_archive "
+                "ADD COLUMN end_at timestamp with time zone NULL, "
+                "ADD COLUMN max_runs integer NULL"
+            ],
+            reverse_sql=[
+                "ALTER TABLE scheduler_schedule_archive "
+                "DROP COLUMN end_at, DROP COLUMN max_runs"
+            ],
+        ),
+    ]
@@ -0,0 +1,16 @@
+# Generated by Django 2.2.8 on 2026-10-19 16:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [("scheduler", "0015_schedule_end_conditions")]
+
+    operations = [
+        migrations.AddField(
+            model_name="hookdelivery",
+            name="batched",
+            field=models.BooleanField(default=False),
+        )
+    ]
@@ -0,0 +1,105 @@
+# Generated by Django 2.2.8 on 2026-10-19 18:02
+
+import django.contrib.postgres.fields.jsonb
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("djcelery", "0001_initial"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ("scheduler", "0016_hookdelivery_batched"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="ScheduleArchive",
+            fields=[
+                ("id", models.UUIDField(primary_key=True, serialize=False)),
+                (
+                    "external_id",
+                    models.CharField(blank=True, max_length=255, null=True),
+                ),
+                ("frequency", models.IntegerField(blank=True, null=True)),
+                ("triggered", models.IntegerField(default=0)),
+                (
+                    "cron_definition",
+                    models.CharField(blank=True, max_length=500, null=True),
+                ),
+                (
+                    "interval_definition",
+                    models.CharField(blank=True, max_length=100, null=True),
+                ),
+                ("endpoint", models.CharField(max_length=500)),
+                ("auth_token", models.CharField(blank=True, max_length=500, null=True)),
+                (
+                    "payload",
+                    django.contrib.postgres.fields.jsonb.JSONField(
+                        blank=True, default=dict, null=True
+                    ),
+                ),
+                ("next_send_at", models.DateTimeField(blank=True, null=True)),
+                ("enabled", models.BooleanField(default=True)),
+                ("end_at", models.DateTimeField(blank=True, null=True)),
+                ("max_runs", models.IntegerField(blank=True, null=True)),
+                ("updated_at", models.DateTimeField()),
+                ("created_at", models.DateTimeField()),
+                ("last_run", models.DateTimeField(null=True)),
+                ("success_count", models.IntegerField(default=0)),
+                ("failure_count", models.IntegerField(default=0)),
+                ("consecutive_failures", models.IntegerField(default=0)),
+                ("last_status_code", models.IntegerField(blank=True, null=True)),
+                ("last_latency", models.FloatField(blank=True, null=True)),
+                ("last_error_at", models.DateTimeField(blank=True, null=True)),
+                ("archived_at", models.DateTimeField()),
+                (
+                    "celery_cron_definition",
+                    models.ForeignKey(
+                        blank=True,
+                        db_constraint=False,
+                        null=True,
+                        on_delete=django.db.models.deletion.DO_NOTHING,
+                        related_name="+",
+                        to="djcelery.CrontabSchedule",
+                    ),
+                ),
+                (
+                    "celery_interval_definition",
+                    models.ForeignKey(
+                        blank=True,
+                        db_constraint=False,
+                        null=True,
+                        on_delete=django.db.models.deletion.DO_NOTHING,
+                        related_name="+",
+                        to="djcelery.IntervalSchedule",
+                    ),
+                ),
+                (
+                    "created_by",
+                    models.ForeignKey(
+                        blank=True,
+                        db_constraint=False,
+                        null=True,
+                        on_delete=django.db.models.deletion.DO_NOTHING,
+                        related_name="+",
+                        to=settings.AUTH_USER_MODEL,
+                    ),
+                ),
+                (
+                    "updated_by",
+                    models.ForeignKey(
+                        blank=True,
+                        db_constraint=False,
+                        null=True,
+                        on_delete=django.db.models.deletion.DO_NOTHING,
+                        related_name="+",
+                        to=settings.AUTH_USER_MODEL,
+                    ),
+                ),
+            ],
+            options={"db_table": "scheduler_schedule_archive", "managed": False},
+        )
+    ]
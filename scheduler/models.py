@@ -1,20 +1,30 @@
 import uuid
 
-from crontab import CronTab
 from django.contrib.auth.models import User
 from django.contrib.postgres.fields import JSONField
 from django.core.exceptions import ValidationError
+from django.core.serializers.json import DjangoJSONEncoder
+from django.core.validators import MinValueValidator
 from django.db import models
 from django.db.models.signals import pre_save
 from django.dispatch import receiver
 from django.utils.encoding import python_2_unicode_compatible
 from django.utils.translation import ugettext_lazy as _
-from djcelery.models import CrontabSchedule, IntervalSchedule, PeriodicTask
+from djcelery.models import CrontabSchedule, IntervalSchedule
+from rest_hooks.models import Hook
+
+from .definitions import (
+    crontab_kwargs,
+    enable_periodic_tasks,
+    get_crontab_schedule,
+    get_interval_schedule,
+    interval_kwargs,
+)
 
 
 def validate_crontab(value):
     try:
-        CronTab(value)
+        crontab_kwargs(value)
     except ValueError as e:
         raise ValidationError(
             _("%(value)s is not a valid crontab string: %(reason)s"),
@@ -24,8 +34,7 @@ def validate_crontab(value):
 
 def validate_interval(value):
     try:
-        every, period = value.split()
-        int(every)
+        period = interval_kwargs(value)["period"]
         if period not in ["days", "hours", "minutes", "seconds", "microseconds"]:
             raise ValidationError(
                 _(
@@ -45,41 +54,81 @@ def validate_interval(value):
         )
 
 
+class ShardedQuerySet(models.QuerySet):
+    def create(self, **kwargs):
+        # Saved without an alias, unless one was picked, so that the routers
+        # can send the new object to its schedule's shard
+        obj = self.model(**kwargs)
+        self._for_write = True
+        obj.save(force_insert=True, using=self._db)
+        return obj
+
+
 @python_2_unicode_compatible
 class Schedule(models.Model):
 
     """
     Base model with all scheduled tasks
-    frequency: number of times task should run in total (deprecated)
+    frequency: number of times task should run in total (deprecated, see
+        max_runs)
+    triggered: the number of times a schedule with max_runs has been queued
     cron_definition: cron syntax of schedule (i.e. 'm h d dM MY')
     interval_definition: integer and period
         (from: days, hours, minutes, seconds, microseconds) e.g. 1 minutes
     endpoint: what URL to POST to
     payload: what json encoded payload to include on the POST
     next_send_at: when the task is next expected to run (not guarenteed)
+    external_id: an optional unique reference from the client service
+    end_at: when the schedule stops running, after which it is disabled
+    max_runs: how many times the schedule runs, after which it is disabled
+    success_count, failure_count: the number of delivery attempts that
+        succeeded and failed
+    consecutive_failures: the number of failed attempts since the last
+        successful one
+    last_status_code, last_latency: the HTTP status code and seconds taken
+        of the last attempt
+    last_error_at: when the last failed attempt was
+
+    With SCHEDULER_SHARD_DATABASES, schedules are spread across several
+    databases, so the references to users and celery definitions, which are
+    on the default database, have no foreign key constraints.
     """
 
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
-    # frequency and triggered are deprecated and will eventually be removed
+    external_id = models.CharField(max_length=255, unique=True, null=True, blank=True)
+    # frequency is deprecated and will eventually be removed
     frequency = models.IntegerField(null=True, blank=True)
     triggered = models.IntegerField(null=False, blank=False, default=0)
     cron_definition = models.CharField(
         max_length=500, null=True, blank=True, validators=[validate_crontab]
     )
     celery_cron_definition = models.ForeignKey(
-        CrontabSchedule, on_delete=models.CASCADE, null=True, blank=True
+        CrontabSchedule,
+        on_delete=models.CASCADE,
+        null=True,
+        blank=True,
+        db_constraint=False,
     )
     interval_definition = models.CharField(
         max_length=100, null=True, blank=True, validators=[validate_interval]
     )
     celery_interval_definition = models.ForeignKey(
-        IntervalSchedule, on_delete=models.CASCADE, null=True, blank=True
+        IntervalSchedule,
+        on_delete=models.CASCADE,
+        null=True,
+        blank=True,
+        db_constraint=False,
     )
     endpoint = models.CharField(max_length=500, null=False)
     auth_token = models.CharField(max_length=500, null=True, blank=True)
     payload = JSONField(null=True, blank=True, default=dict)
     next_send_at = models.DateTimeField(null=True, blank=True)
     enabled = models.BooleanField(default=True)
+    # Enforced by QueueTasks for all of a definition's schedules at once
+    end_at = models.DateTimeField(null=True, blank=True)
+    max_runs = models.IntegerField(
+        null=True, blank=True, validators=[MinValueValidator(1)]
+    )
     updated_at = models.DateTimeField(auto_now=True)
     created_at = models.DateTimeField(auto_now_add=True)
     created_by = models.ForeignKey(
@@ -88,6 +137,7 @@ class Schedule(models.Model):
         null=True,
         blank=True,
         on_delete=models.SET_NULL,
+        db_constraint=False,
     )
     updated_by = models.ForeignKey(
         User,
@@ -95,30 +145,73 @@ class Schedule(models.Model):
         null=True,
         blank=True,
         on_delete=models.SET_NULL,
+        db_constraint=False,
     )
     user = property(lambda self: self.created_by)
     last_run = models.DateTimeField(null=True)
+    # Delivery stats, written in batches by the workers
+    success_count = models.IntegerField(default=0)
+    failure_count = models.IntegerField(default=0)
+    consecutive_failures = models.IntegerField(default=0)
+    last_status_code = models.IntegerField(null=True, blank=True)
+    last_latency = models.FloatField(null=True, blank=True)
+    last_error_at = models.DateTimeField(null=True, blank=True)
+
+    objects = ShardedQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            # For finding the schedules to archive
+            models.Index(
+                fields=["updated_at"],
+                name="scheduler_schedule_disabled",
+                condition=models.Q(enabled=False),
+            )
+        ]
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super(Schedule, cls).from_db(db, field_names, values)
+        instance._loaded_definitions = instance.definitions_state()
+        return instance
+
+    def definitions_state(self):
+        """
+        Whether the schedule is enabled and which definitions it uses, for
+        telling whether a save starts using a definition. Deferred fields
+        aren't loaded.
+        """
+        return tuple(
+            self.__dict__.get(name)
+            for name in (
+                "enabled",
+                "celery_cron_definition_id",
+                "celery_interval_definition_id",
+            )
+        )
 
     def serialize_hook(self, hook):
         # optional, there are serialization defaults
         # we recommend always sending the Hook
         # metadata along for the ride as well
         # not sending auth token
+        return {"hook": hook.dict(), "data": self.hook_data()}
+
+    def hook_data(self):
         return {
-            "hook": hook.dict(),
-            "data": {
-                "id": str(self.id),
-                "frequency": self.frequency,
-                "triggered": self.triggered,
-                "cron_definition": self.cron_definition,
-                "interval_definition": self.interval_definition,
-                "endpoint": self.endpoint,
-                "payload": self.payload,
-                "next_send_at": self.next_send_at.isoformat(),
-                "enabled": self.enabled,
-                "created_at": self.created_at.isoformat(),
-                "updated_at": self.updated_at.isoformat(),
-            },
+            "id": str(self.id),
+            "frequency": self.frequency,
+            "triggered": self.triggered,
+            "cron_definition": self.cron_definition,
+            "interval_definition": self.interval_definition,
+            "endpoint": self.endpoint,
+            "payload": self.payload,
+            "next_send_at": self.next_send_at and self.next_send_at.isoformat(),
+            "enabled": self.enabled,
+            "end_at": self.end_at and self.end_at.isoformat(),
+            "max_runs": self.max_runs,
+            "created_at": self.created_at.isoformat(),
+            "updated_at": self.updated_at.isoformat(),
         }
 
     def __str__(self):  # __unicode__ on Python 2
@@ -127,51 +220,106 @@ class Schedule(models.Model):
 
 @receiver(pre_save, sender=Schedule)
 def schedule_saved(sender, instance, **kwargs):
+    crontab_ids = []
+    interval_ids = []
     if (
         instance.cron_definition is not None
         and instance.cron_definition != ""
         and instance.celery_cron_definition is None
     ):
-        # CronTab package just used to parse and validate the string nicely.
-        entry = CronTab(instance.cron_definition)
-        schedule = {
-            "minute": entry.matchers.minute.input,
-            "hour": entry.matchers.hour.input,
-            "day_of_week": entry.matchers.weekday.input,
-            "day_of_month": entry.matchers.day.input,
-            "month_of_year": entry.matchers.month.input,
-        }
-        cs, createdcs = CrontabSchedule.objects.get_or_create(**schedule)
-        instance.celery_cron_definition = cs
-        if createdcs:
-            # make the periodic task
-            pt = {
-                "name": "Run %s" % instance.cron_definition,
-                "task": "seed_scheduler.scheduler.tasks.queue_tasks",
-                "crontab": cs,
-                "enabled": True,
-                "args": '["crontab", %s]' % cs.id,
-            }
-            PeriodicTask.objects.create(**pt)
+        instance.celery_cron_definition = get_crontab_schedule(instance.cron_definition)
+    elif instance.celery_cron_definition_id is not None:
+        crontab_ids.append(instance.celery_cron_definition_id)
     if (
         instance.interval_definition is not None
         and instance.interval_definition != ""
         and instance.celery_interval_definition is None
     ):
-        every, period = instance.interval_definition.split()
-        interval = {"every": int(every), "period": period}
-        intsch, createdsch = IntervalSchedule.objects.get_or_create(**interval)
-        instance.celery_interval_definition = intsch
-        if createdsch:
-            # make the periodic task
-            pt = {
-                "name": "Run %s" % instance.interval_definition,
-                "task": "seed_scheduler.scheduler.tasks.queue_tasks",
-                "interval": intsch,
-                "enabled": True,
-                "args": '["interval", %s]' % intsch.id,
-            }
-            PeriodicTask.objects.create(**pt)
+        instance.celery_interval_definition = get_interval_schedule(
+            instance.interval_definition
+        )
+    elif instance.celery_interval_definition_id is not None:
+        interval_ids.append(instance.celery_interval_definition_id)
+    # Existing definitions may have been disabled while they weren't used,
+    # but not while an enabled schedule was using them
+    state = instance.definitions_state()
+    if instance.enabled and state != getattr(instance, "_loaded_definitions", None):
+        enable_periodic_tasks(crontab_ids, interval_ids)
+    instance._loaded_definitions = state
+
+
+@python_2_unicode_compatible
+class ScheduleArchive(models.Model):
+
+    """
+    The schedules that have been archived by scheduler.archive, which moves
+    them to and from a table with the same columns as the schedule table,
+    along with when they were archived. Only used for reading, so that the
+    archive can be filtered like the schedules.
+    """
+
+    id = models.UUIDField(primary_key=True)
+    external_id = models.CharField(max_length=255, null=True, blank=True)
+    frequency = models.IntegerField(null=True, blank=True)
+    triggered = models.IntegerField(default=0)
+    cron_definition = models.CharField(max_length=500, null=True, blank=True)
+    celery_cron_definition = models.ForeignKey(
+        CrontabSchedule,
+        on_delete=models.DO_NOTHING,
+        null=True,
+        blank=True,
+        db_constraint=False,
+        related_name="+",
+    )
+    interval_definition = models.CharField(max_length=100, null=True, blank=True)
+    celery_interval_definition = models.ForeignKey(
+        IntervalSchedule,
+        on_delete=models.DO_NOTHING,
+        null=True,
+        blank=True,
+        db_constraint=False,
+        related_name="+",
+    )
+    endpoint = models.CharField(max_length=500)
+    auth_token = models.CharField(max_length=500, null=True, blank=True)
+    payload = JSONField(null=True, blank=True, default=dict)
+    next_send_at = models.DateTimeField(null=True, blank=True)
+    enabled = models.BooleanField(default=True)
+    end_at = models.DateTimeField(null=True, blank=True)
+    max_runs = models.IntegerField(null=True, blank=True)
+    updated_at = models.DateTimeField()
+    created_at = models.DateTimeField()
+    created_by = models.ForeignKey(
+        User,
+        null=True,
+        blank=True,
+        on_delete=models.DO_NOTHING,
+        db_constraint=False,
+        related_name="+",
+    )
+    updated_by = models.ForeignKey(
+        User,
+        null=True,
+        blank=True,
+        on_delete=models.DO_NOTHING,
+        db_constraint=False,
+        related_name="+",
+    )
+    last_run = models.DateTimeField(null=True)
+    success_count = models.IntegerField(default=0)
+    failure_count = models.IntegerField(default=0)
+    consecutive_failures = models.IntegerField(default=0)
+    last_status_code = models.IntegerField(null=True, blank=True)
+    last_latency = models.FloatField(null=True, blank=True)
+    last_error_at = models.DateTimeField(null=True, blank=True)
+    archived_at = models.DateTimeField()
+
+    class Meta:
+        managed = False
+        db_table = "scheduler_schedule_archive"
+
+    def __str__(self):  # __unicode__ on Python 2
+        return str(self.id)
 
 
 @python_2_unicode_compatible
@@ -197,5 +345,66 @@ class ScheduleFailure(models.Model):
     initiated_at = models.DateTimeField()
     reason = models.TextField()
 
+    objects = ShardedQuerySet.as_manager()
+
+    def __str__(self):  # __unicode__ on Python 2
+        return str(self.id)
+
+
+@python_2_unicode_compatible
+class HookDelivery(models.Model):
+
+    """
+    A webhook delivery waiting in the outbox
+    hook: the webhook to deliver to
+    payload: the JSON payload to POST to the webhook target
+    attempts: the number of failed attempts so far
+    next_attempt_at: when the delivery is next due, or null once it has
+        failed too many times
+    last_error: why the last attempt failed
+    batched: whether the payload is an item of a batched delivery, which is
+        sent in a list with the hook's other items that are due
+    """
+
+    hook = models.ForeignKey(Hook, on_delete=models.CASCADE)
+    payload = JSONField(encoder=DjangoJSONEncoder)
+    batched = models.BooleanField(default=False)
+    created_at = models.DateTimeField(auto_now_add=True)
+    attempts = models.IntegerField(default=0)
+    next_attempt_at = models.DateTimeField(null=True, db_index=True)
+    last_error = models.TextField(blank=True, default="")
+
+    def __str__(self):  # __unicode__ on Python 2
+        return str(self.id)
+
+
+@python_2_unicode_compatible
+class Delivery(models.Model):
+
+    """
+    An attempt to deliver a schedule's payload, kept in a table that is
+    partitioned by day on fired_at, so that old days can be dropped
+    schedule_id: the schedule that was delivered, which may since be deleted
+    fired_at: when the attempt was made
+    attempt: which attempt this was, starting from 1
+    status_code: the HTTP status code of the response, or null if there was
+        no response
+    latency: how long the attempt took, in seconds
+    worker: the host and process that made the attempt
+    """
+
+    id = models.BigAutoField(primary_key=True)
+    schedule_id = models.UUIDField()
+    fired_at = models.DateTimeField()
+    attempt = models.SmallIntegerField(default=1)
+    status_code = models.IntegerField(null=True, blank=True)
+    latency = models.FloatField()
+    worker = models.CharField(max_length=255, blank=True, default="")
+
+    class Meta:
+        # The table is created by its migration, as Django can't partition it
+        managed = False
+        db_table = "scheduler_delivery"
+
     def __str__(self):  # __unicode__ on Python 2
         return str(self.id)
@@ -0,0 +1,155 @@
+import json
+import logging
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+import requests
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.utils.timezone import now
+from prometheus_client import Gauge
+from requests.adapters import HTTPAdapter
+
+from seed_scheduler import utils
+
+from .models import HookDelivery
+
+logger = logging.getLogger(__name__)
+
+backlog = Gauge(
+    "scheduler_hook_outbox_backlog",
+    "The number of webhook deliveries waiting in the outbox",
+)
+backlog.set_function(
+    lambda: HookDelivery.objects.filter(next_attempt_at__isnull=False).count()
+)
+
+
+def get_session():
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=settings.SCHEDULER_HOOK_CONCURRENCY,
+        pool_maxsize=settings.SCHEDULER_HOOK_CONCURRENCY,
+    )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    session.headers.update(
+        {
+            "Content-Type": "application/json",
+            "Authorization": "Token %s" % settings.HOOK_AUTH_TOKEN,
+        }
+    )
+    return session
+
+
+def claim_deliveries(limit):
+    """
+    Returns the deliveries that are due, and pushes their next attempt back
+    past the request timeout so that other workers don't send them too. If
+    this worker dies, they are sent again once that time has passed.
+    """
+    timestamp = now()
+    with transaction.atomic():
+        deliveries = list(
+            HookDelivery.objects.select_related("hook")
+            .select_for_update(skip_locked=True, of=("self",))
+            .filter(next_attempt_at__lte=timestamp)
+            .order_by("next_attempt_at", "id")[:limit]
+        )
+        lease = timedelta(seconds=settings.DEFAULT_REQUEST_TIMEOUT * 2)
+        HookDelivery.objects.filter(
+            id__in=[delivery.id for delivery in deliveries]
+        ).update(next_attempt_at=timestamp + lease)
+    return deliveries
+
+
+def group_deliveries(deliveries):
+    """
+    Returns the deliveries in the groups that are sent together. Batched
+    items for the same webhook are sent together, up to
+    SCHEDULER_HOOK_BATCH_SIZE at a time, and other deliveries on their own.
+    """
+    groups = []
+    batches = OrderedDict()
+    for delivery in deliveries:
+        if delivery.batched:
+            batches.setdefault(delivery.hook_id, []).append(delivery)
+        else:
+            groups.append([delivery])
+    size = settings.SCHEDULER_HOOK_BATCH_SIZE
+    for batch in batches.values():
+        while batch:
+            groups.append(batch[:size])
+            batch = batch[size:]
+    return groups
+
+
+def group_payload(group):
+    hook = group[0].hook
+    if group[0].batched:
+        return {"hook": hook.dict(), "data": [delivery.payload for delivery in group]}
+    return group[0].payload
+
+
+def post_delivery(session, group):
+    """
+    POSTs a group of deliveries to their webhook, returning None if it was
+    delivered or the error if it wasn't.
+    """
+    try:
+        response = session.post(
+            group[0].hook.target,
+            data=json.dumps(group_payload(group), cls=DjangoJSONEncoder),
+            timeout=settings.DEFAULT_REQUEST_TIMEOUT,
+        )
+        response.raise_for_status()
+    except requests.RequestException as exc:
+        return exc
+    return None
+
+
+def record_failure(delivery, error):
+    delivery.attempts += 1
+    delivery.last_error = str(error)
+    if delivery.attempts >= settings.SCHEDULER_HOOK_MAX_ATTEMPTS:
+        logger.warning(
+            "Giving up on webhook delivery %s to %s after %s attempts: %s"
+            % (delivery.id, delivery.hook.target, delivery.attempts, error)
+        )
+        delivery.next_attempt_at = None
+    else:
+        delivery.next_attempt_at = now() + timedelta(
+            seconds=utils.calculate_retry_delay(delivery.attempts)
+        )
+    delivery.save(update_fields=["attempts", "last_error", "next_attempt_at"])
+
+
+def deliver_outbox(session=None):
+    """
+    Sends the webhook deliveries that are due, in batches of
+    SCHEDULER_HOOK_OUTBOX_BATCH_SIZE with up to SCHEDULER_HOOK_CONCURRENCY
+    requests at a time. Delivered rows are removed, and failed ones are
+    retried with an exponential backoff. Batched items are combined. Returns
+    the number delivered.
+    """
+    session = session or get_session()
+    batch_size = settings.SCHEDULER_HOOK_OUTBOX_BATCH_SIZE
+    delivered = 0
+    with ThreadPoolExecutor(settings.SCHEDULER_HOOK_CONCURRENCY) as executor:
+        while True:
+            deliveries = claim_deliveries(batch_size)
+            groups = group_deliveries(deliveries)
+            errors = executor.map(lambda group: post_delivery(session, group), groups)
+            succeeded = []
+            for group, error in zip(groups, errors):
+                if error is None:
+                    succeeded.extend(delivery.id for delivery in group)
+                else:
+                    for delivery in group:
+                        record_failure(delivery, error)
+            HookDelivery.objects.filter(id__in=succeeded).delete()
+            delivered += len(succeeded)
+            if len(deliveries) < batch_size:
+                return delivered
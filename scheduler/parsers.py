@@ -0,0 +1,36 @@
+import codecs
+import json
+
+from django.conf import settings
+from rest_framework.exceptions import ParseError
+from rest_framework.parsers import BaseParser
+
+
+def iter_ndjson(stream, encoding=None):
+    """
+    Lazily parses a stream of newline delimited JSON, one item at a time.
+    """
+    if stream is None:
+        return
+    reader = codecs.getreader(encoding or settings.DEFAULT_CHARSET)(stream)
+    for number, line in enumerate(reader, 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            yield json.loads(line)
+        except ValueError as exc:
+            raise ParseError("NDJSON parse error on line %s - %s" % (number, exc))
+
+
+class NDJSONParser(BaseParser):
+
+    """
+    Parses newline delimited JSON into a list, with one item per line.
+    """
+
+    media_type = "application/x-ndjson"
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        parser_context = parser_context or {}
+        return list(iter_ndjson(stream, parser_context.get("encoding")))
@@ -0,0 +1,212 @@
+import re
+from datetime import datetime, timedelta
+
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+from django.utils import timezone
+
+# Partitions that have been created and committed, by database, table and
+# start date
+known_partitions = set()
+
+BOUNDS = re.compile(r"FROM \((.+)\) TO \((.+)\)")
+
+
+def period_start(day, period):
+    """
+    Returns the first day of the partition that `day` falls in. Partitions
+    start at midnight UTC.
+    """
+    if isinstance(day, datetime):
+        if timezone.is_aware(day):
+            day = day.astimezone(timezone.utc)
+        day = day.date()
+    if period == "month":
+        return day.replace(day=1)
+    return day
+
+
+def add_periods(start, period, count):
+    """
+    Returns the start of the partition `count` partitions after the one that
+    starts on `start`, or before it if `count` is negative.
+    """
+    if period == "month":
+        month = start.year * 12 + start.month - 1 + count
+        return start.replace(year=month // 12, month=month % 12 + 1, day=1)
+    return start + timedelta(days=count)
+
+
+def next_period(start, period):
+    return add_periods(start, period, 1)
+
+
+def period_bound(start):
+    return "%s 00:00:00+00" % start.isoformat()
+
+
+def partition_name(table, start):
+    return "%s_p%s" % (table, start.strftime("%Y%m%d"))
+
+
+def default_partition_name(table):
+    return "%s_default" % table
+
+
+def parse_bound(bound):
+    if bound in ("MINVALUE", "MAXVALUE"):
+        return None
+    return datetime.strptime(bound.strip("'")[:10], "%Y-%m-%d").date()
+
+
+def list_partitions(table, using=DEFAULT_DB_ALIAS):
+    """
+    Returns the name, start date and end date of each of the range partitions
+    of `table`, ordered by their start date. The start or end date is None if
+    the partition has no lower or upper bound.
+    """
+    with connections[using].cursor() as cursor:
+        cursor.execute(
+            "SELECT child.relname, pg_get_expr(child.relpartbound, child.oid) "
+            "FROM pg_inherits "
+            "JOIN pg_class child ON child.oid = pg_inherits.inhrelid "
+            "WHERE pg_inherits.inhparent = %s::regclass",
+            [table],
+        )
+        rows = cursor.fetchall()
+    partitions = []
+    for name, bound in rows:
+        match = BOUNDS.search(bound)
+        if match:
+            partitions.append(
+                (name, parse_bound(match.group(1)), parse_bound(match.group(2)))
+            )
+    return sorted(partitions, key=lambda p: (p[1] is not None, p[1]))
+
+
+def overlaps(partition, start, end):
+    _, partition_start, partition_end = partition
+    return (partition_start is None or partition_start < end) and (
+        partition_end is None or partition_end > start
+    )
+
+
+def create_partition(table, start, period, using=DEFAULT_DB_ALIAS):
+    """
+    Creates the partition of `table` for the period that starts on `start`,
+    unless an existing partition already covers some of it.
+    """
+    if (using, table, start) in known_partitions:
+        return
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    end = next_period(start, period)
+    name = partition_name(table, start)
+    with transaction.atomic(using=using), connection.cursor() as cursor:
+        # Only one process creates each table's partitions at a time
+        cursor.execute("SELECT pg_advisory_xact_lock(hashtext(%s))", [table])
+        if not any(overlaps(p, start, end) for p in list_partitions(table, using)):
+            cursor.execute(
+                "SELECT to_regclass(%s)", [qn(default_partition_name(table))]
+            )
+            (default,) = cursor.fetchone()
+            if default is None:
+                cursor.execute(
+                    "CREATE TABLE {partition} PARTITION OF {table} "
+                    "FOR VALUES FROM (%s) TO (%s)".format(
+                        partition=qn(name), table=qn(table)
+                    ),
+                    [period_bound(start), period_bound(end)],
+                )
+            else:
+                move_from_default(cursor, table, default, name, start, end)
+    # A partition created in a transaction that is rolled back is gone again
+    transaction.on_commit(
+        lambda: known_partitions.add((using, table, start)), using=using
+    )
+
+
+def move_from_default(cursor, table, default, name, start, end):
+    """
+    Creates a partition of `table` for a table with a default partition. The
+    rows in the default partition that belong in the new one are moved
+    across in the same transaction, so that they never disappear from the
+    table.
+    """
+    qn = cursor.db.ops.quote_name
+    cursor.execute(
+        "SELECT a.attname FROM pg_partitioned_table p "
+        "JOIN pg_attribute a ON a.attrelid = p.partrelid "
+        "AND a.attnum = p.partattrs[0] "
+        "WHERE p.partrelid = %s::regclass",
+        [table],
+    )
+    (key,) = cursor.fetchone()
+    cursor.execute(
+        "CREATE TABLE {partition} (LIKE {table} INCLUDING DEFAULTS)".format(
+            partition=qn(name), table=qn(table)
+        )
+    )
+    cursor.execute(
+        "WITH moved AS (DELETE FROM {default} WHERE {key} >= %s AND {key} < %s "
+        "RETURNING *) INSERT INTO {partition} SELECT * FROM moved".format(
+            default=default, key=qn(key), partition=qn(name)
+        ),
+        [period_bound(start), period_bound(end)],
+    )
+    cursor.execute(
+        "ALTER TABLE {table} ATTACH PARTITION {partition} "
+        "FOR VALUES FROM (%s) TO (%s)".format(table=qn(table), partition=qn(name)),
+        [period_bound(start), period_bound(end)],
+    )
+
+
+def ensure_partitions(table, days, period, using=DEFAULT_DB_ALIAS):
+    """
+    Creates the partitions of `table` that `days` fall in.
+    """
+    for start in sorted(set(period_start(day, period) for day in days)):
+        create_partition(table, start, period, using)
+
+
+def drop_partitions(table, before, using=DEFAULT_DB_ALIAS):
+    """
+    Detaches and drops the partitions of `table` that end on or before
+    `before`, and returns their names.
+    """
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    if isinstance(before, datetime):
+        before = before.date()
+    dropped = []
+    for name, start, end in list_partitions(table, using):
+        if end is None or end > before:
+            continue
+        with transaction.atomic(using=using), connection.cursor() as cursor:
+            cursor.execute(
+                "ALTER TABLE {table} DETACH PARTITION {partition}".format(
+                    table=qn(table), partition=qn(name)
+                )
+            )
+            cursor.execute("DROP TABLE {partition}".format(partition=qn(name)))
+        known_partitions.discard((using, table, start))
+        dropped.append(name)
+    return dropped
+
+
+def maintain_partitions(table, period, ahead, keep, using=DEFAULT_DB_ALIAS):
+    """
+    Creates the partitions of `table` from the current period until `ahead`
+    periods from now, and drops the ones that ended more than `keep` periods
+    before the current one. Nothing is dropped if `keep` is 0. Returns the
+    names of the partitions that were dropped.
+    """
+    current = period_start(timezone.now(), period)
+    ensure_partitions(
+        table,
+        [add_periods(current, period, n) for n in range(ahead + 1)],
+        period,
+        using,
+    )
+    if not keep:
+        return []
+    return drop_partitions(table, add_periods(current, period, -keep), using)
@@ -0,0 +1,223 @@
+"""
+Benchmarks for the schedule and failed task endpoints with large tables.
+
+These aren't run with the tests. Run them against Postgres with:
+
+    py.test scheduler/perf_suite.py
+
+SCHEDULER_BENCHMARK_SCHEDULES sets the number of schedules that are seeded
+(100000 by default), and SCHEDULER_BENCHMARK_FAILURES the number of failed
+tasks (10000 by default). Each benchmark also checks that the endpoint
+doesn't use more queries than its budget in QUERY_BUDGETS. They're skipped
+when schedules are sharded, since they're only seeded on the default
+database.
+"""
+import os
+from datetime import timedelta
+from unittest import mock
+from uuid import uuid4
+
+import pytest
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from djcelery.models import CrontabSchedule
+from rest_framework.test import APIClient
+
+from .benchmark import delete_seeded
+from .bulk import batched
+from .definitions import DefinitionCache
+from .importer import copy_schedules
+from .models import Schedule, ScheduleFailure
+from .shards import sharded
+from .views import CreatedAtCursorPagination, IdCursorPagination
+
+SCHEDULES = int(os.environ.get("SCHEDULER_BENCHMARK_SCHEDULES", 100000))
+FAILURES = int(os.environ.get("SCHEDULER_BENCHMARK_FAILURES", 10000))
+DEFINITIONS = ["%s * * * *" % minute for minute in range(60)]
+PAGE_SIZE = 1000
+
+# The most queries that each request may use. Lower these when a change
+# makes an endpoint use fewer queries, so that regressions are caught.
+QUERY_BUDGETS = {
+    "list": 1,
+    "list_filtered": 1,
+    "list_page": 1,
+    "retrieve": 1,
+    # The savepoints, the definition lookup, re-enabling its periodic task,
+    # the insert and the webhook lookups
+    "create_existing_definition": 8,
+    # Also the new definition and its periodic task, which tells beat
+    "create_new_definition": 15,
+    # The schedule, re-enabling its periodic task and the update
+    "update": 6,
+    "failed_tasks": 1,
+}
+
+pytestmark = pytest.mark.django_db
+
+
+@pytest.fixture(scope="module")
+def seeded(django_db_setup, django_db_blocker):
+    """
+    Seeds the schedules and failed tasks once for all of the benchmarks,
+    and deletes them afterwards, along with the definitions that they added.
+    """
+    if sharded():
+        pytest.skip("The benchmarks only seed the default database")
+    with django_db_blocker.unblock():
+        user = User.objects.create_superuser(
+            "benchmark-%s" % uuid4(), "benchmark@example.com", "benchmark"
+        )
+        cache = DefinitionCache()
+        started_at = timezone.now()
+        existing = CrontabSchedule.objects.order_by("-id").values_list("id", flat=True)
+        last_crontab_id = existing.first() or 0
+
+        def generate():
+            for index in range(SCHEDULES):
+                schedule = Schedule(
+                    cron_definition=DEFINITIONS[index % len(DEFINITIONS)],
+                    endpoint="http://example.com/%s/" % (index % 100),
+                    payload={"index": index},
+                    enabled=index % 10 != 0,
+                    created_by=user,
+                    updated_by=user,
+                )
+                # Spread out, so that the pagination cursors are realistic
+                schedule.created_at = started_at - timedelta(seconds=index)
+                yield cache.resolve(schedule)
+
+        ids = []
+        for chunk in batched(generate(), settings.SCHEDULER_IMPORT_CHUNK_SIZE):
+            with transaction.atomic():
+                copy_schedules(chunk)
+            ids.extend(schedule.id for schedule in chunk[: FAILURES - len(ids)])
+
+        for chunk in batched(ids, settings.SCHEDULER_IMPORT_CHUNK_SIZE):
+            ScheduleFailure.objects.bulk_create(
+                ScheduleFailure(
+                    schedule_id=schedule_id,
+                    task_id=uuid4(),
+                    initiated_at=started_at,
+                    reason="Benchmark",
+                )
+                for schedule_id in chunk
+            )
+
+        yield {"user": user, "ids": ids}
+
+        crontab_ids = list(
+            CrontabSchedule.objects.filter(id__gt=last_crontab_id)
+            .exclude(
+                id__in=Schedule.objects.exclude(created_by=user)
+                .filter(celery_cron_definition__isnull=False)
+                .values("celery_cron_definition")
+            )
+            .values_list("id", flat=True)
+        )
+        delete_seeded(user, crontab_ids)
+        user.delete()
+
+
+@pytest.fixture
+def api_client(seeded):
+    api_client = APIClient()
+    api_client.force_authenticate(user=seeded["user"])
+    with mock.patch.object(
+        CreatedAtCursorPagination, "page_size", PAGE_SIZE
+    ), mock.patch.object(IdCursorPagination, "page_size", PAGE_SIZE):
+        yield api_client
+
+
+def check_queries(name, request):
+    """
+    Makes the request once outside of the benchmark, and checks its status
+    and query count.
+    """
+    with CaptureQueriesContext(connection) as queries:
+        response = request()
+    assert response.status_code < 300, response.content
+    assert len(queries) <= QUERY_BUDGETS[name], "\n".join(
+        query["sql"] for query in queries.captured_queries
+    )
+    return response
+
+
+def test_list(benchmark, api_client):
+    request = lambda: api_client.get("/api/v1/schedule/")  # noqa: E731
+    response = check_queries("list", request)
+    assert len(response.data["results"]) == min(PAGE_SIZE, SCHEDULES)
+    benchmark(request)
+
+
+def test_list_filtered(benchmark, api_client):
+    request = lambda: api_client.get(  # noqa: E731
+        "/api/v1/schedule/",
+        {"enabled": "true", "cron_definition": DEFINITIONS[1], "fields": "id,url"},
+    )
+    check_queries("list_filtered", request)
+    benchmark(request)
+
+
+def test_list_deep_page(benchmark, api_client):
+    url = "/api/v1/schedule/"
+    for _ in range(10):
+        url = api_client.get(url).data["next"] or url
+    request = lambda: api_client.get(url)  # noqa: E731
+    check_queries("list_page", request)
+    benchmark(request)
+
+
+def test_retrieve(benchmark, api_client, seeded):
+    url = "/api/v1/schedule/%s/" % seeded["ids"][-1]
+    request = lambda: api_client.get(url)  # noqa: E731
+    check_queries("retrieve", request)
+    benchmark(request)
+
+
+def test_create_existing_definition(benchmark, api_client):
+    data = {"cron_definition": DEFINITIONS[0], "endpoint": "http://example.com/"}
+    request = lambda: api_client.post(  # noqa: E731
+        "/api/v1/schedule/", data, format="json"
+    )
+    check_queries("create_existing_definition", request)
+    benchmark(request)
+
+
+def test_create_new_definition(benchmark, api_client):
+    minutes = iter(range(60 * 24 * 365))
+
+    def request():
+        # A new definition each time, for the first week of minutes
+        minute = next(minutes)
+        return api_client.post(
+            "/api/v1/schedule/",
+            {
+                "cron_definition": "%s %s * * %s"
+                % (minute % 60, minute // 60 % 24, minute // 1440 % 7),
+                "endpoint": "http://example.com/",
+            },
+            format="json",
+        )
+
+    check_queries("create_new_definition", request)
+    benchmark(request)
+
+
+def test_update(benchmark, api_client, seeded):
+    url = "/api/v1/schedule/%s/" % seeded["ids"][0]
+    request = lambda: api_client.patch(  # noqa: E731
+        url, {"endpoint": "http://example.com/updated/"}, format="json"
+    )
+    check_queries("update", request)
+    benchmark(request)
+
+
+def test_failed_tasks(benchmark, api_client):
+    request = lambda: api_client.get("/api/v1/failed-tasks/")  # noqa: E731
+    response = check_queries("failed_tasks", request)
+    assert len(response.data["results"]) == min(PAGE_SIZE, FAILURES, SCHEDULES)
+    benchmark(request)
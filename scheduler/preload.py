@@ -0,0 +1,52 @@
+from importlib import import_module
+
+from celery.signals import worker_init
+from celery.utils.log import get_task_logger
+from django.conf import settings
+from django.db import connections
+from djcelery.models import CrontabSchedule
+
+from .definitions import crontab_definition, crontab_entry, crontab_kwargs
+from .tasks import get_delivery_session
+
+logger = get_task_logger(__name__)
+
+# Modules that the tasks only import when they're first used, so that the
+# web processes don't have to
+PRELOAD_MODULES = ("seed_services_client.metrics",)
+
+
+def preload():
+    """
+    Does the work that every worker process would otherwise repeat, once in
+    the parent process before the pool forks: imports the modules that the
+    tasks defer, reads the settings, parses the cron definitions and sets
+    up the delivery session. Connections can't be shared with the worker
+    processes, so the database connection is closed again.
+    """
+    for name in PRELOAD_MODULES:
+        try:
+            import_module(name)
+        except ImportError:
+            logger.warning("Could not preload %s" % name)
+
+    # Django keeps the settings that have been read
+    for name in dir(settings._wrapped):
+        if name.isupper():
+            getattr(settings, name)
+
+    try:
+        for crontab in CrontabSchedule.objects.all():
+            definition = crontab_definition(crontab)
+            crontab_kwargs(definition)
+            crontab_entry(definition)
+    finally:
+        connections.close_all()
+
+    get_delivery_session()
+
+
+@worker_init.connect
+def preload_worker(**kwargs):
+    if settings.SCHEDULER_WORKER_PRELOAD:
+        preload()
@@ -0,0 +1,188 @@
+import os
+import random
+import sys
+import tempfile
+import threading
+from collections import Counter
+
+from celery.signals import task_postrun, task_prerun
+from celery.utils.log import get_task_logger
+from django.conf import settings
+
+logger = get_task_logger(__name__)
+
+# Set this message header on a task to profile it, whatever the sample rate
+PROFILE_HEADER = "profile"
+
+
+class Sampler(object):
+
+    """
+    A sampling profiler that records the stack of the thread that started
+    it every `interval` seconds of wall clock time, so that time spent
+    waiting on the database and endpoints shows up too. The samples are
+    taken by a background thread, which gets to run while the profiled
+    thread is blocked. The stacks are kept in the collapsed format that
+    flame graph tools read.
+    """
+
+    extension = "collapsed"
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.stacks = Counter()
+        self.stopped = threading.Event()
+        self.ident = None
+        self.thread = None
+
+    def sample(self, frame):
+        names = []
+        while frame is not None:
+            code = frame.f_code
+            names.append(
+                "%s (%s:%s)" % (code.co_name, code.co_filename, code.co_firstlineno)
+            )
+            frame = frame.f_back
+        self.stacks[";".join(reversed(names))] += 1
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.ident)
+            if frame is not None:
+                self.sample(frame)
+
+    def start(self):
+        self.ident = threading.get_ident()
+        self.thread = threading.Thread(target=self.run, name="profiler", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def add(self, profile):
+        """
+        Adds the samples of another Sampler to this one.
+        """
+        self.stacks.update(profile.stacks)
+        return self
+
+    def write(self, f):
+        for stack, samples in sorted(self.stacks.items()):
+            f.write(("%s %s\n" % (stack, samples)).encode("utf-8"))
+
+
+def profile_dir():
+    return settings.SCHEDULER_PROFILE_DIR or os.path.join(
+        tempfile.gettempdir(), "seed_scheduler_profiles"
+    )
+
+
+class ProfileStore(object):
+
+    """
+    Aggregates the profiles of a worker process for each task, in one file
+    per task and process under a directory for the task name. Once the files
+    use more than SCHEDULER_PROFILE_MAX_BYTES, the oldest ones are deleted.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pid = None
+        self.samples = {}
+
+    def path(self, task_name, extension):
+        return os.path.join(
+            profile_dir(), task_name, "%s.%s" % (os.getpid(), extension)
+        )
+
+    def add(self, task_name, profile):
+        """
+        Adds a profile to the totals for its task, and writes them out.
+        """
+        with self.lock:
+            if self.pid != os.getpid():
+                # Don't write the totals of the process that forked this one
+                self.pid = os.getpid()
+                self.samples = {}
+            total = self.samples.get(task_name)
+            total = profile if total is None else total.add(profile)
+            self.samples[task_name] = total
+            path = self.path(task_name, profile.extension)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Written to a temporary file first, so that profiles being
+            # pulled from the directory are never half written
+            temporary = "%s.tmp" % path
+            with open(temporary, "wb") as f:
+                total.write(f)
+            os.replace(temporary, path)
+            self.prune()
+        return path
+
+    def prune(self):
+        """
+        Deletes the oldest profiles until they fit in
+        SCHEDULER_PROFILE_MAX_BYTES.
+        """
+        files = []
+        for root, _, names in os.walk(profile_dir()):
+            for name in names:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, path))
+        used = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if used <= settings.SCHEDULER_PROFILE_MAX_BYTES:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            used -= size
+
+
+store = ProfileStore()
+# The profiles running for each task id
+active = {}
+
+
+def should_profile(task):
+    """
+    Returns whether this run of a task should be profiled.
+    """
+    headers = getattr(task.request, "headers", None) or {}
+    if headers.get(PROFILE_HEADER):
+        return True
+    rate = settings.SCHEDULER_PROFILE_RATE
+    if not rate:
+        return False
+    names = settings.SCHEDULER_PROFILE_TASKS
+    if names and task.name not in names:
+        return False
+    return random.random() < rate
+
+
+@task_prerun.connect
+def start_profile(sender=None, task_id=None, task=None, **kwargs):
+    # Retries run inside of the task that they retry when tasks are eager,
+    # and only one profile can run at a time
+    if active or task is None or not should_profile(task):
+        return
+    profile = Sampler(settings.SCHEDULER_PROFILE_INTERVAL)
+    active[task_id] = profile
+    profile.start()
+
+
+@task_postrun.connect
+def stop_profile(sender=None, task_id=None, task=None, **kwargs):
+    profile = active.pop(task_id, None)
+    if profile is None:
+        return
+    profile.stop()
+    try:
+        store.add(task.name, profile)
+    except OSError:
+        logger.exception("Could not write the profile for %s" % task.name)
@@ -0,0 +1,134 @@
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, connections
+from rest_framework.permissions import SAFE_METHODS
+
+from .authentication import credentials_key
+from .cache import TieredCache
+from .routers import REPLICA, read_from_replica
+
+logger = logging.getLogger(__name__)
+
+# Clients that wrote recently, whose reads stay on the primary
+pinned_clients = TieredCache(
+    "replica-pin",
+    settings.SCHEDULER_REPLICA_PIN_SECONDS,
+    shared=settings.SCHEDULER_REPLICA_SHARED_CACHE,
+)
+
+
+def replica_configured():
+    return bool(settings.SCHEDULER_REPLICA_DATABASE)
+
+
+def replica_lag():
+    """
+    Returns the number of seconds that the replica is behind the primary, or
+    0 if it has replayed everything that it has received.
+    """
+    with connections[REPLICA].cursor() as cursor:
+        cursor.execute(
+            "SELECT CASE WHEN NOT pg_is_in_recovery() "
+            "OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 "
+            "ELSE COALESCE(EXTRACT(EPOCH FROM "
+            "now() - pg_last_xact_replay_timestamp()), 0) END"
+        )
+        return float(cursor.fetchone()[0])
+
+
+class LagMonitor(object):
+
+    """
+    Checks the replica's lag at most every SCHEDULER_REPLICA_LAG_CHECK_INTERVAL
+    seconds. The replica is only used while it is at most
+    SCHEDULER_REPLICA_MAX_LAG seconds behind. The lag is reported as a metric
+    by the report_replica_lag task, rather than by every process.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.checked_at = None
+        self.lag = None
+
+    def check(self):
+        try:
+            lag = replica_lag()
+        except DatabaseError:
+            logger.exception("Could not check the replica's lag")
+            return None
+        if lag > settings.SCHEDULER_REPLICA_MAX_LAG:
+            logger.warning("The replica is %s seconds behind, not using it" % lag)
+        return lag
+
+    def available(self):
+        if not replica_configured():
+            return False
+        with self.lock:
+            now = time.monotonic()
+            if (
+                self.checked_at is None
+                or now - self.checked_at
+                >= settings.SCHEDULER_REPLICA_LAG_CHECK_INTERVAL
+            ):
+                self.lag = self.check()
+                self.checked_at = now
+            return (
+                self.lag is not None and self.lag <= settings.SCHEDULER_REPLICA_MAX_LAG
+            )
+
+
+lag_monitor = LagMonitor()
+
+
+def fanout_database():
+    """
+    Returns the database that QueueTasks reads the schedules to deliver from.
+    """
+    if settings.SCHEDULER_REPLICA_FANOUT and lag_monitor.available():
+        return REPLICA
+    return DEFAULT_DB_ALIAS
+
+
+def client_key(request):
+    client = request.META.get("HTTP_AUTHORIZATION") or request.META.get(
+        "REMOTE_ADDR", ""
+    )
+    return credentials_key("client", client)
+
+
+def stream_from_replica(content):
+    with read_from_replica():
+        for chunk in content:
+            yield chunk
+
+
+class ReplicaMiddleware(object):
+
+    """
+    Serves read-only requests from the replica, unless the client wrote
+    something in the last SCHEDULER_REPLICA_PIN_SECONDS seconds, so that
+    clients always read their own writes. The writes are recorded in
+    SCHEDULER_REPLICA_SHARED_CACHE, and every request is served from the
+    primary without it, since the other processes wouldn't know about them.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if not replica_configured() or pinned_clients.shared is None:
+            return self.get_response(request)
+        if request.method not in SAFE_METHODS:
+            response = self.get_response(request)
+            pinned_clients.set(client_key(request), True)
+            return response
+        if pinned_clients.get(client_key(request)) or not lag_monitor.available():
+            return self.get_response(request)
+        with read_from_replica():
+            response = self.get_response(request)
+        if response.streaming:
+            response.streaming_content = stream_from_replica(response.streaming_content)
+        return response
@@ -0,0 +1,89 @@
+import threading
+from contextlib import contextmanager
+
+from django.db import DEFAULT_DB_ALIAS
+
+from .shards import shard_for, sharded, shards
+
+# The alias of the replica in DATABASES, when SCHEDULER_REPLICA_DATABASE is set
+REPLICA = "replica"
+
+state = threading.local()
+
+
+@contextmanager
+def read_from_replica():
+    """
+    Sends the reads in this thread to the replica.
+    """
+    previous = getattr(state, "replica", False)
+    state.replica = True
+    try:
+        yield
+    finally:
+        state.replica = previous
+
+
+class ReplicaRouter(object):
+
+    """
+    Sends reads to the replica inside read_from_replica, and everything else
+    to the primary.
+    """
+
+    def db_for_read(self, model, **hints):
+        if getattr(state, "replica", False):
+            return REPLICA
+        return DEFAULT_DB_ALIAS
+
+    def db_for_write(self, model, **hints):
+        # Objects read from the replica are still saved to the primary
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        databases = (DEFAULT_DB_ALIAS, REPLICA)
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db != REPLICA
+
+
+# The models that are stored on the shard of the schedule they belong to
+SHARDED_MODELS = ("scheduler.Schedule", "scheduler.ScheduleFailure")
+
+
+class ShardRouter(object):
+
+    """
+    Sends the reads and writes of a schedule or schedule failure instance to
+    the shard that the schedule is stored on, when there is more than one
+    shard. Other queries for them go to the default database unless they
+    pick a shard with using().
+    """
+
+    def db_for_instance(self, model, instance):
+        if (
+            not sharded()
+            or instance is None
+            or model._meta.label not in SHARDED_MODELS
+            or instance._meta.label not in SHARDED_MODELS
+        ):
+            return None
+        if instance._meta.label == "scheduler.Schedule":
+            return shard_for(instance.pk)
+        return shard_for(instance.schedule_id)
+
+    def db_for_read(self, model, **hints):
+        return self.db_for_instance(model, hints.get("instance"))
+
+    def db_for_write(self, model, **hints):
+        return self.db_for_instance(model, hints.get("instance"))
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Schedules refer to users and definitions on the default database
+        databases = set(shards()) | set([DEFAULT_DB_ALIAS, REPLICA])
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
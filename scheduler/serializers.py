@@ -1,8 +1,12 @@
+from collections import OrderedDict
+
+from django.conf import settings
 from django.contrib.auth.models import Group, User
 from rest_framework import serializers
+from rest_framework.reverse import reverse
 from rest_hooks.models import Hook
 
-from .models import Schedule, ScheduleFailure
+from .models import Delivery, Schedule, ScheduleFailure
 
 
 class UserSerializer(serializers.HyperlinkedModelSerializer):
@@ -29,10 +33,19 @@ class ScheduleSerializer(serializers.HyperlinkedModelSerializer):
             "updated_by",
             "celery_cron_definition",
             "celery_interval_definition",
+            "last_run",
+            "success_count",
+            "failure_count",
+            "consecutive_failures",
+            "last_status_code",
+            "last_latency",
+            "last_error_at",
+            "triggered",
         )
         fields = (
             "url",
             "id",
+            "external_id",
             "frequency",
             "cron_definition",
             "interval_definition",
@@ -41,13 +54,135 @@ class ScheduleSerializer(serializers.HyperlinkedModelSerializer):
             "auth_token",
             "next_send_at",
             "enabled",
+            "end_at",
+            "max_runs",
+            "triggered",
             "created_at",
             "created_by",
             "updated_at",
             "updated_by",
+            "last_run",
+            "success_count",
+            "failure_count",
+            "consecutive_failures",
+            "last_status_code",
+            "last_latency",
+            "last_error_at",
         )
 
 
+# The Schedule column that each ScheduleSerializer field is formatted from
+SCHEDULE_VALUES_COLUMNS = {
+    "url": "id",
+    "id": "id",
+    "external_id": "external_id",
+    "frequency": "frequency",
+    "cron_definition": "cron_definition",
+    "interval_definition": "interval_definition",
+    "endpoint": "endpoint",
+    "payload": "payload",
+    "auth_token": "auth_token",
+    "next_send_at": "next_send_at",
+    "enabled": "enabled",
+    "end_at": "end_at",
+    "max_runs": "max_runs",
+    "triggered": "triggered",
+    "created_at": "created_at",
+    "created_by": "created_by_id",
+    "updated_at": "updated_at",
+    "updated_by": "updated_by_id",
+    "last_run": "last_run",
+    "success_count": "success_count",
+    "failure_count": "failure_count",
+    "consecutive_failures": "consecutive_failures",
+    "last_status_code": "last_status_code",
+    "last_latency": "last_latency",
+    "last_error_at": "last_error_at",
+}
+
+URL_PLACEHOLDER = "pk-placeholder"
+
+
+def hyperlink(view_name, request, format=None):
+    """
+    Returns a function that formats the detail URL for a pk, reversing the
+    URL only once.
+    """
+    url = reverse(
+        view_name, kwargs={"pk": URL_PLACEHOLDER}, request=request, format=format
+    )
+    prefix, suffix = url.split(URL_PLACEHOLDER)
+    return lambda pk: "%s%s%s" % (prefix, pk, suffix)
+
+
+class ScheduleValuesSerializer(serializers.BaseSerializer):
+
+    """
+    A read only ScheduleSerializer for rows from Schedule.objects.values(),
+    that formats each column directly instead of building a model instance
+    and reversing the hyperlinks for every row. `fields` limits the output to
+    some of the ScheduleSerializer fields.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.field_names = kwargs.pop("fields", None) or ScheduleSerializer.Meta.fields
+        super(ScheduleValuesSerializer, self).__init__(*args, **kwargs)
+        self._formatters = None
+
+    @staticmethod
+    def columns(field_names):
+        """
+        Returns the columns to select for the given fields.
+        """
+        return sorted(set(SCHEDULE_VALUES_COLUMNS[name] for name in field_names))
+
+    def get_formatters(self):
+        request = self.context.get("request")
+        format = self.context.get("format")
+        user_url = hyperlink("user-detail", request, format)
+        datetime_field = serializers.DateTimeField()
+        formatters = {
+            "url": hyperlink("schedule-detail", request, format),
+            "id": str,
+            "next_send_at": datetime_field.to_representation,
+            "end_at": datetime_field.to_representation,
+            "created_at": datetime_field.to_representation,
+            "created_by": user_url,
+            "updated_at": datetime_field.to_representation,
+            "updated_by": user_url,
+            "last_run": datetime_field.to_representation,
+            "last_error_at": datetime_field.to_representation,
+        }
+        return [
+            (name, SCHEDULE_VALUES_COLUMNS[name], formatters.get(name))
+            for name in self.field_names
+        ]
+
+    def to_representation(self, row):
+        if self._formatters is None:
+            self._formatters = self.get_formatters()
+        data = OrderedDict()
+        for name, column, formatter in self._formatters:
+            value = row[column]
+            if formatter is not None and value is not None:
+                value = formatter(value)
+            data[name] = value
+        return data
+
+
+class ScheduleSyncSerializer(ScheduleSerializer):
+    # Existing external ids are expected when syncing, so this replaces the
+    # unique validation with a required field
+    external_id = serializers.CharField(max_length=255)
+
+
+class ForecastSerializer(serializers.Serializer):
+    start = serializers.DateTimeField(required=False)
+    minutes = serializers.IntegerField(
+        min_value=1, max_value=settings.SCHEDULER_FORECAST_MAX_MINUTES, default=1440
+    )
+
+
 class HookSerializer(serializers.ModelSerializer):
     class Meta:
         model = Hook
@@ -59,3 +194,19 @@ class ScheduleFailureSerializer(serializers.HyperlinkedModelSerializer):
     class Meta:
         model = ScheduleFailure
         fields = ("url", "id", "schedule", "task_id", "initiated_at", "reason")
+
+
+class DeliverySerializer(serializers.ModelSerializer):
+    schedule = serializers.UUIDField(source="schedule_id")
+
+    class Meta:
+        model = Delivery
+        fields = (
+            "id",
+            "schedule",
+            "fired_at",
+            "attempt",
+            "status_code",
+            "latency",
+            "worker",
+        )
@@ -0,0 +1,252 @@
+import heapq
+import queue
+import threading
+import uuid
+from itertools import islice
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+
+
+def shards():
+    """
+    Returns the aliases of the databases that schedules are stored on.
+    """
+    return settings.SCHEDULER_SHARDS
+
+
+def sharded():
+    return len(shards()) > 1
+
+
+def shard_for(schedule_id):
+    """
+    Returns the alias of the database that the schedule with `schedule_id`
+    is stored on, along with its failures.
+    """
+    aliases = shards()
+    if len(aliases) == 1:
+        return aliases[0]
+    return aliases[uuid.UUID(str(schedule_id)).int % len(aliases)]
+
+
+def group_by_shard(items, key=None):
+    """
+    Returns the items in a dict by the alias of the shard that each one's
+    schedule id, from `key` if it is given, is stored on.
+    """
+    groups = {}
+    for item in items:
+        schedule_id = item if key is None else key(item)
+        groups.setdefault(shard_for(schedule_id), []).append(item)
+    return groups
+
+
+def on_shard(queryset, schedule_id):
+    """
+    Returns the queryset on the shard of a single schedule. Unsharded
+    querysets, and ones for invalid ids, are left to the routers.
+    """
+    if not sharded():
+        return queryset
+    try:
+        return queryset.using(shard_for(schedule_id))
+    except ValueError:
+        return queryset
+
+
+def interleave_ids(table, using):
+    """
+    Sets the id sequence of `table` on a shard to only hand out the ids that
+    are one more than the shard's index, modulo the number of shards, so that
+    the ids of the rows on different shards never clash. Only changes the
+    sequence when its increment doesn't match the number of shards.
+    """
+    aliases = shards()
+    if using not in aliases:
+        return False
+    connection = connections[using]
+    if table not in connection.introspection.table_names():
+        return False
+    step = len(aliases)
+    offset = aliases.index(using) + 1
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT pg_get_serial_sequence(%s, 'id')", [table])
+        (sequence,) = cursor.fetchone()
+        cursor.execute(
+            "SELECT seqincrement FROM pg_sequence WHERE seqrelid = %s::regclass",
+            [sequence],
+        )
+        (increment,) = cursor.fetchone()
+        if increment == step:
+            return False
+        cursor.execute(
+            "SELECT GREATEST((SELECT last_value FROM {sequence}), "
+            "(SELECT COALESCE(MAX(id), 0) FROM {table}))".format(
+                sequence=sequence, table=connection.ops.quote_name(table)
+            )
+        )
+        (last,) = cursor.fetchone()
+        start = last + 1 + (offset - last - 1) % step
+        cursor.execute(
+            "ALTER SEQUENCE {sequence} INCREMENT BY {step} "
+            "RESTART WITH {start}".format(sequence=sequence, step=step, start=start)
+        )
+    return True
+
+
+def shards_for_id(row_id):
+    """
+    Returns the aliases of the shards, starting with the one whose sequence
+    hands out `row_id`. Rows from before the sequences were interleaved can
+    be on any of them.
+    """
+    aliases = shards()
+    first = (int(row_id) - 1) % len(aliases)
+    return aliases[first:] + aliases[:first]
+
+
+def shard_querysets(queryset):
+    """
+    Returns a copy of the queryset for each shard, or just the queryset
+    when there is only one.
+    """
+    if not sharded():
+        return [queryset]
+    return [queryset.using(alias) for alias in shards()]
+
+
+def values_from_shards(queryset, field):
+    """
+    Returns the values of `field` for the rows of `queryset`, as a subquery
+    when there is only one shard, and otherwise as a set of the values from
+    every shard, since a subquery can't span databases.
+    """
+    if not sharded():
+        return queryset.values(field)
+    values = set()
+    for shard_queryset in shard_querysets(queryset):
+        values.update(shard_queryset.values_list(field, flat=True).distinct())
+    return values
+
+
+def row_value(row, field):
+    if isinstance(row, dict):
+        return row[field]
+    return getattr(row, field)
+
+
+class MergedQuerySet(object):
+
+    """
+    The same query on every shard, with enough of the QuerySet API for
+    cursor pagination. Slices fetch the rows up to the end of the slice from
+    each shard, and merge them by the first field that the querysets are
+    ordered by.
+    """
+
+    def __init__(self, querysets):
+        self.querysets = querysets
+
+    def order_by(self, *fields):
+        return MergedQuerySet(
+            [queryset.order_by(*fields) for queryset in self.querysets]
+        )
+
+    def filter(self, *args, **kwargs):
+        return MergedQuerySet(
+            [queryset.filter(*args, **kwargs) for queryset in self.querysets]
+        )
+
+    def merge(self, querysets):
+        ordering = self.querysets[0].query.order_by[0]
+        field = ordering.lstrip("-")
+        return heapq.merge(
+            *querysets,
+            key=lambda row: row_value(row, field),
+            reverse=ordering.startswith("-")
+        )
+
+    def __getitem__(self, key):
+        if not isinstance(key, slice) or key.stop is None:
+            raise TypeError("Only slices with an end are supported.")
+        rows = self.merge([queryset[: key.stop] for queryset in self.querysets])
+        return list(islice(rows, key.start or 0, key.stop))
+
+    def __iter__(self):
+        return self.merge(self.querysets)
+
+
+def merged(queryset):
+    """
+    Returns the queryset across every shard, for cursor pagination.
+    """
+    if not sharded():
+        return queryset
+    return MergedQuerySet(shard_querysets(queryset))
+
+
+class ShardScanFailed(object):
+    def __init__(self, exc):
+        self.exc = exc
+
+
+def iter_shards(queryset, default_alias=DEFAULT_DB_ALIAS):
+    """
+    Yields the rows of `queryset` from every shard, as they arrive. Each
+    shard is scanned by its own thread with its own connection, so the
+    shards are read in parallel, and at most SCHEDULER_BULK_BATCH_SIZE rows
+    are held at a time. An error on any shard stops the other scans and is
+    raised.
+
+    With a single shard, the rows are read from `default_alias` in this
+    thread.
+    """
+    if not sharded():
+        for row in queryset.using(default_alias).iterator():
+            yield row
+        return
+
+    rows = queue.Queue(settings.SCHEDULER_BULK_BATCH_SIZE)
+    stop = threading.Event()
+    done = object()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                rows.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def scan(alias):
+        try:
+            for row in queryset.using(alias).iterator():
+                if not put(row):
+                    break
+        except Exception as exc:
+            put(ShardScanFailed(exc))
+        finally:
+            connections[alias].close()
+            put(done)
+
+    threads = [
+        threading.Thread(target=scan, args=(alias,), daemon=True) for alias in shards()
+    ]
+    for thread in threads:
+        thread.start()
+    try:
+        remaining = len(threads)
+        while remaining:
+            row = rows.get()
+            if row is done:
+                remaining -= 1
+            elif isinstance(row, ShardScanFailed):
+                raise row.exc
+            else:
+                yield row
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
@@ -0,0 +1,394 @@
+import heapq
+import json
+import random
+import time
+from bisect import bisect_left
+from collections import Counter, defaultdict
+from datetime import timedelta
+from importlib import import_module
+from itertools import count
+
+from celery import Celery
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+from djcelery.models import PeriodicTask
+
+from seed_scheduler.utils import percentiles
+
+from .definitions import (
+    QUEUE_TASKS_TASK,
+    DefinitionCache,
+    crontab_entry,
+    interval_kwargs,
+)
+from .models import QueueTaskRun, Schedule
+from .stats import delivery_stats
+from .stub import StubServer
+from .tasks import deliver_task, queue_tasks
+
+DEFAULT_DEFINITIONS = (
+    "*/5 * * * *",
+    "*/15 * * * *",
+    "0 * * * *",
+    "0 */4 * * *",
+    "0 8 * * *",
+    "0 8 * * 1-5",
+    "30 9 * * *",
+    "10 minutes",
+)
+
+# How long celery beat sleeps for at most, and how often it saves the last
+# run times of the periodic tasks, which it starts from after a restart
+BEAT_MAX_INTERVAL = 300
+BEAT_SYNC_EVERY = 180
+
+
+def wall_clock():
+    """
+    Returns seconds from a clock that keeps going while the VirtualClock is
+    stopped.
+    """
+    return time.monotonic()
+
+
+class VirtualClock(object):
+
+    """
+    A clock that only moves when it is told to. While it is in use, it is
+    the time for Django, including the modules that import `now` from
+    django.utils.timezone, and for celery schedules.
+    """
+
+    PATCHED = (
+        "django.utils.timezone.now",
+        "scheduler.definitions.now",
+        "scheduler.outbox.now",
+        "scheduler.tasks.now",
+    )
+
+    def __init__(self, start):
+        self.time = start
+        self.replaced = []
+
+    def now(self):
+        return self.time
+
+    def move_to(self, time):
+        self.time = time
+
+    def __enter__(self):
+        owners = [
+            (import_module(module), name)
+            for module, name in (target.rsplit(".", 1) for target in self.PATCHED)
+        ]
+        owners.append((Celery, "now"))
+        for owner, name in owners:
+            self.replaced.append((owner, name, getattr(owner, name)))
+            setattr(owner, name, self.now)
+        return self
+
+    def __exit__(self, *exc_info):
+        while self.replaced:
+            owner, name, original = self.replaced.pop()
+            setattr(owner, name, original)
+
+
+def is_interval(definition):
+    return len(definition.split()) == 2
+
+
+def expected_ticks(definition, start, end):
+    """
+    Returns the times after `start` and before `end` that celery beat should
+    run a definition at, when it starts at `start`.
+    """
+    ticks = []
+    if is_interval(definition):
+        kwargs = interval_kwargs(definition)
+        every = timedelta(**{kwargs["period"]: kwargs["every"]})
+        tick = start + every
+        while tick < end:
+            ticks.append(tick)
+            tick += every
+        return ticks
+    entry = crontab_entry(definition)
+    tick = start
+    while True:
+        tick += timedelta(seconds=entry.next(tick, default_utc=True))
+        if tick >= end:
+            return ticks
+        ticks.append(tick)
+
+
+class Rollback(Exception):
+    pass
+
+
+class Simulation(object):
+
+    """
+    Replays celery beat, QueueTasks and DeliverTask for schedules on a set of
+    cron and interval definitions, against a virtual clock. Tasks go through
+    an in-memory broker, and deliveries are sent to a local StubServer.
+
+    Beat sends each periodic task when its schedule is due, and a worker runs
+    it up to `beat_delay` seconds later. Beat's clock is `beat_skew` seconds
+    ahead of the workers' clocks. Beat is restarted `restarts` times, and
+    starts again from the last run times that it saved.
+
+    Everything is written in a transaction that is rolled back, but
+    QueueTasks also queues the schedules of other definitions that are due
+    at the same time, so this is meant for an otherwise empty database.
+    """
+
+    def __init__(
+        self,
+        definitions=DEFAULT_DEFINITIONS,
+        schedules=10,
+        hours=24,
+        start=None,
+        beat_delay=0,
+        beat_skew=0,
+        restarts=0,
+        deliver=True,
+        seed=0,
+    ):
+        self.definitions = list(definitions)
+        self.schedules = schedules
+        self.start = (start or timezone.now()).replace(second=0, microsecond=0)
+        self.end = self.start + timedelta(hours=hours)
+        self.beat_delay = beat_delay
+        self.beat_skew = timedelta(seconds=beat_skew)
+        self.restarts = restarts
+        self.deliver = deliver
+        self.random = random.Random(seed)
+        self.broker = []
+        self.sequence = count()
+
+    def send(self, eta, kind, kwargs):
+        heapq.heappush(self.broker, (eta, next(self.sequence), kind, kwargs))
+
+    def send_delivery(self, kwargs=None, **options):
+        self.send(timezone.now(), "deliver", kwargs)
+
+    def create_schedules(self, url):
+        cache = DefinitionCache()
+        schedules = []
+        for definition in self.definitions:
+            for index in range(self.schedules):
+                schedule = Schedule(payload={"index": index})
+                if is_interval(definition):
+                    schedule.interval_definition = definition
+                else:
+                    schedule.cron_definition = definition
+                schedule.endpoint = "%s/%s/" % (url, schedule.id)
+                schedules.append(cache.resolve(schedule))
+        Schedule.objects.bulk_create(schedules)
+        return schedules
+
+    def run_worker(self, until, clock, stats):
+        """
+        Runs the tasks in the broker that are due by `until`.
+        """
+        while self.broker and self.broker[0][0] <= until:
+            eta, _, kind, kwargs = heapq.heappop(self.broker)
+            clock.move_to(eta)
+            if kind == "queue":
+                started = wall_clock()
+                result = queue_tasks.run(send_delivery=self.send_delivery, **kwargs)
+                if result.startswith("Queued"):
+                    stats["fanout_seconds"].append(wall_clock() - started)
+            elif kwargs["schedule_id"] not in self.schedule_ids:
+                # Schedules from outside of the simulation are never sent
+                stats["foreign"] += 1
+            elif self.deliver:
+                started = wall_clock()
+                try:
+                    deliver_task.run(**kwargs)
+                except Exception:
+                    stats["failed"] += 1
+                # The delivery stats and ledger are written straight away, so
+                # that they are rolled back with the rest of the simulation
+                delivery_stats.flush()
+                stats["delivery_seconds"].append(wall_clock() - started)
+            else:
+                stats["delivered"][kwargs["schedule_id"]] += 1
+
+    def run_beat(self, clock):
+        """
+        Runs celery beat from the start to the end of the simulation, along
+        with the tasks that it sends, and returns the timings.
+        """
+        stats = {
+            "fanout_seconds": [],
+            "delivery_seconds": [],
+            "failed": 0,
+            "foreign": 0,
+            "delivered": Counter(),
+        }
+        entries = []
+        for task in PeriodicTask.objects.filter(id__in=self.task_ids).select_related(
+            "crontab", "interval"
+        ):
+            entries.append(
+                {
+                    "schedule": task.schedule,
+                    "kwargs": dict(
+                        zip(("schedule_type", "lookup_id"), json.loads(task.args))
+                    ),
+                    "last_run_at": self.start + self.beat_skew,
+                    "saved_run_at": self.start + self.beat_skew,
+                }
+            )
+        restarts = [
+            self.start + (self.end - self.start) * (index + 1) / (self.restarts + 1)
+            for index in range(self.restarts)
+        ]
+        next_sync = self.start + timedelta(seconds=BEAT_SYNC_EVERY)
+
+        now = self.start
+        while now < self.end:
+            clock.move_to(now + self.beat_skew)
+            wake = now + timedelta(seconds=BEAT_MAX_INTERVAL)
+            for entry in entries:
+                due, next_seconds = entry["schedule"].is_due(entry["last_run_at"])
+                if due:
+                    entry["last_run_at"] = now + self.beat_skew
+                    delay = self.random.uniform(0, self.beat_delay)
+                    self.send(now + timedelta(seconds=delay), "queue", entry["kwargs"])
+                wake = min(wake, now + timedelta(seconds=next_seconds))
+            wake = min(max(wake, now + timedelta(seconds=1)), self.end)
+
+            if next_sync <= wake:
+                for entry in entries:
+                    entry["saved_run_at"] = entry["last_run_at"]
+                next_sync += timedelta(seconds=BEAT_SYNC_EVERY)
+            if restarts and restarts[0] <= wake:
+                wake = restarts.pop(0)
+                for entry in entries:
+                    entry["last_run_at"] = entry["saved_run_at"]
+
+            self.run_worker(wake, clock, stats)
+            now = wake
+
+        # Finish the tasks that were sent before the end
+        self.run_worker(self.end + timedelta(days=1), clock, stats)
+        return stats
+
+    def report(self, stats, stub, elapsed):
+        skew = settings.DEFAULT_CLOCK_SKEW_SECONDS
+        runs = defaultdict(list)
+        for definition, started_at in QueueTaskRun.objects.filter(
+            celery_cron_definition__in=[
+                self.crontabs[d] for d in self.definitions if d in self.crontabs
+            ]
+        ).values_list("celery_cron_definition", "started_at"):
+            runs[("crontab", definition)].append(started_at)
+        for definition, started_at in QueueTaskRun.objects.filter(
+            celery_interval_definition__in=[
+                self.intervals[d] for d in self.definitions if d in self.intervals
+            ]
+        ).values_list("celery_interval_definition", "started_at"):
+            runs[("interval", definition)].append(started_at)
+
+        summary = Counter()
+        lateness = []
+        expected = {}
+        for definition in self.definitions:
+            ticks = expected_ticks(definition, self.start, self.end)
+            expected[definition] = len(ticks)
+            if is_interval(definition):
+                key = ("interval", self.intervals[definition])
+            else:
+                key = ("crontab", self.crontabs[definition])
+            matched = Counter()
+            for started_at in runs[key]:
+                # Match the run to the nearest time that it was due at
+                index = bisect_left(ticks, started_at)
+                nearest = [ticks[i] for i in (index - 1, index) if 0 <= i < len(ticks)]
+                if not nearest:
+                    summary["unexpected_runs"] += 1
+                    continue
+                tick = min(nearest, key=lambda t: abs((started_at - t).total_seconds()))
+                if abs((started_at - tick).total_seconds()) > max(
+                    self.beat_delay + skew + abs(self.beat_skew.total_seconds()), 60
+                ):
+                    summary["unexpected_runs"] += 1
+                    continue
+                matched[tick] += 1
+                lateness.append((started_at - tick).total_seconds())
+            summary["expected_runs"] += len(ticks)
+            summary["runs"] += len(runs[key])
+            summary["duplicate_runs"] += sum(n - 1 for n in matched.values() if n > 1)
+            summary["missed_runs"] += sum(1 for tick in ticks if not matched[tick])
+
+        if self.deliver:
+            delivered = Counter(path.strip("/") for path, _ in stub.requests)
+        else:
+            delivered = stats["delivered"]
+        for schedule in self.schedule_objects:
+            wanted = expected[schedule.cron_definition or schedule.interval_definition]
+            got = delivered[str(schedule.id)]
+            summary["expected_deliveries"] += wanted
+            summary["deliveries"] += got
+            summary["duplicate_deliveries"] += max(got - wanted, 0)
+            summary["missed_deliveries"] += max(wanted - got, 0)
+
+        result = dict(summary)
+        result.update(
+            {
+                "definitions": len(self.definitions),
+                "schedules": len(self.schedule_objects),
+                "hours": (self.end - self.start).total_seconds() / 3600,
+                "restarts": self.restarts,
+                "failed_deliveries": stats["failed"],
+                "foreign_deliveries": stats["foreign"],
+                "fanout_lateness_seconds": percentiles(lateness),
+                "fanout_seconds": percentiles(stats["fanout_seconds"]),
+                "delivery_seconds": percentiles(stats["delivery_seconds"]),
+                "seconds": round(elapsed, 3),
+                "deliveries_per_second": round(summary["deliveries"] / elapsed),
+                "simulated_hours_per_second": round(
+                    (self.end - self.start).total_seconds() / 3600 / elapsed, 1
+                ),
+            }
+        )
+        return result
+
+    def run(self):
+        """
+        Runs the simulation and returns a report of the expected, duplicate
+        and missed runs and deliveries, how late and how long the fan-outs
+        took, and the throughput.
+        """
+        started = wall_clock()
+        with StubServer() as stub:
+            try:
+                with transaction.atomic(), VirtualClock(self.start) as clock:
+                    self.schedule_objects = self.create_schedules(stub.url)
+                    self.schedule_ids = set(str(s.id) for s in self.schedule_objects)
+                    self.crontabs = {
+                        s.cron_definition: s.celery_cron_definition_id
+                        for s in self.schedule_objects
+                        if s.cron_definition
+                    }
+                    self.intervals = {
+                        s.interval_definition: s.celery_interval_definition_id
+                        for s in self.schedule_objects
+                        if s.interval_definition
+                    }
+                    self.task_ids = list(
+                        PeriodicTask.objects.filter(
+                            Q(crontab__in=self.crontabs.values())
+                            | Q(interval__in=self.intervals.values()),
+                            task=QUEUE_TASKS_TASK,
+                        ).values_list("id", flat=True)
+                    )
+                    stats = self.run_beat(clock)
+                    report = self.report(stats, stub, wall_clock() - started)
+                    raise Rollback()
+            except Rollback:
+                pass
+        return report
@@ -0,0 +1,259 @@
+import csv
+import io
+import logging
+import os
+import socket
+import threading
+from operator import itemgetter
+
+from celery.signals import worker_process_shutdown, worker_shutdown
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, connection, connections
+
+from .bulk import chunks
+from .importer import copy_value
+from .models import Delivery, Schedule
+from .partitions import ensure_partitions
+from .shards import group_by_shard
+
+logger = logging.getLogger(__name__)
+
+
+def merge_stats(earlier, later):
+    """
+    Returns the stats of a schedule's deliveries in `earlier`, followed by
+    the ones in `later`.
+    """
+    merged = dict(later)
+    merged["successes"] += earlier["successes"]
+    merged["failures"] += earlier["failures"]
+    if not later["reset"]:
+        merged["consecutive_failures"] += earlier["consecutive_failures"]
+        merged["reset"] = earlier["reset"]
+    merged["last_run"] = later["last_run"] or earlier["last_run"]
+    merged["last_error_at"] = later["last_error_at"] or earlier["last_error_at"]
+    return merged
+
+
+class DeliveryStats(object):
+
+    """
+    Adds up the results of each schedule's deliveries in a worker process,
+    and writes them to the schedules with one UPDATE for every
+    SCHEDULER_BULK_BATCH_SIZE schedules, at most
+    SCHEDULER_DELIVERY_STATS_INTERVAL milliseconds after the first result.
+    Sharded schedules are updated on each of their shards.
+
+    With SCHEDULER_DELIVERY_LEDGER, each attempt is also kept, and written to
+    the delivery ledger with a COPY when the stats are written.
+
+    Stats and deliveries that can't be written are kept, and tried again
+    with the next flush.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.deliveries = []
+        self.timer = None
+        self.worker = "%s:%s" % (socket.gethostname(), os.getpid())
+
+    def add(
+        self, schedule_id, status_code, latency, error_at=None, run_at=None, attempt=1
+    ):
+        """
+        Records a delivery attempt, which failed if `error_at` is set and
+        succeeded at `run_at` otherwise.
+        """
+        with self.lock:
+            if settings.SCHEDULER_DELIVERY_LEDGER:
+                self.deliveries.append(
+                    Delivery(
+                        schedule_id=schedule_id,
+                        fired_at=error_at or run_at,
+                        attempt=attempt,
+                        status_code=status_code,
+                        latency=latency,
+                        worker=self.worker,
+                    )
+                )
+            stats = self.pending.setdefault(
+                str(schedule_id),
+                {
+                    "successes": 0,
+                    "failures": 0,
+                    # The failures since the last success, and whether there
+                    # was a success to reset the count to them
+                    "consecutive_failures": 0,
+                    "reset": False,
+                    "last_run": None,
+                    "last_error_at": None,
+                },
+            )
+            if error_at is None:
+                stats["successes"] += 1
+                stats["consecutive_failures"] = 0
+                stats["reset"] = True
+                stats["last_run"] = run_at
+            else:
+                stats["failures"] += 1
+                stats["consecutive_failures"] += 1
+                stats["last_error_at"] = error_at
+            stats["last_status_code"] = status_code
+            stats["last_latency"] = latency
+            flush = (
+                not settings.SCHEDULER_DELIVERY_STATS_INTERVAL
+                or len(self.pending) >= settings.SCHEDULER_BULK_BATCH_SIZE
+                or len(self.deliveries) >= settings.SCHEDULER_BULK_BATCH_SIZE
+            )
+            if not flush:
+                self.start_timer()
+        if flush:
+            self.flush()
+
+    def start_timer(self):
+        """
+        Flushes in SCHEDULER_DELIVERY_STATS_INTERVAL milliseconds, unless a
+        flush is already due. Must be called with the lock held.
+        """
+        if self.timer is None and settings.SCHEDULER_DELIVERY_STATS_INTERVAL:
+            self.timer = threading.Timer(
+                settings.SCHEDULER_DELIVERY_STATS_INTERVAL / 1000.0,
+                self.flush_in_thread,
+            )
+            self.timer.daemon = True
+            self.timer.start()
+
+    def retry(self, rows, deliveries):
+        """
+        Puts back the stats and deliveries that couldn't be written, ahead of
+        the ones that have been added since.
+        """
+        with self.lock:
+            for schedule_id, stats in rows:
+                if schedule_id in self.pending:
+                    stats = merge_stats(stats, self.pending[schedule_id])
+                self.pending[schedule_id] = stats
+            self.deliveries[:0] = deliveries
+            self.start_timer()
+
+    def flush(self):
+        """
+        Writes everything that is waiting, and returns the number of
+        schedules that were updated.
+        """
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            deliveries, self.deliveries = self.deliveries, []
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+        # Always in the same order, so that concurrent flushes from different
+        # workers lock the rows in the same order
+        rows = sorted(pending.items())
+        updated = 0
+        failed_rows = []
+        failed_deliveries = []
+        for alias, shard_rows in sorted(group_by_shard(rows, itemgetter(0)).items()):
+            for batch in chunks(shard_rows, settings.SCHEDULER_BULK_BATCH_SIZE):
+                try:
+                    updated += self.write(batch, alias)
+                except DatabaseError:
+                    logger.exception("Could not write the delivery stats")
+                    failed_rows.extend(batch)
+        for batch in chunks(deliveries, settings.SCHEDULER_BULK_BATCH_SIZE):
+            try:
+                self.copy(batch)
+            except DatabaseError:
+                logger.exception("Could not write the delivery ledger")
+                failed_deliveries.extend(batch)
+        if failed_rows or failed_deliveries:
+            self.retry(failed_rows, failed_deliveries)
+        return updated
+
+    def flush_in_thread(self):
+        try:
+            self.flush()
+        finally:
+            # Each thread has its own database connections
+            connections.close_all()
+
+    def write(self, batch, using=DEFAULT_DB_ALIAS):
+        connection = connections[using]
+        qn = connection.ops.quote_name
+        params = []
+        for schedule_id, stats in batch:
+            params.extend(
+                [
+                    schedule_id,
+                    stats["successes"],
+                    stats["failures"],
+                    stats["consecutive_failures"],
+                    stats["reset"],
+                    stats["last_status_code"],
+                    stats["last_latency"],
+                    stats["last_error_at"],
+                    stats["last_run"],
+                ]
+            )
+        row = (
+            "(%s::uuid, %s::integer, %s::integer, %s::integer, %s::boolean, "
+            "%s::integer, %s::double precision, %s::timestamptz, %s::timestamptz)"
+        )
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "UPDATE {table} AS s SET "
+                "success_count = s.success_count + v.successes, "
+                "failure_count = s.failure_count + v.failures, "
+                "consecutive_failures = CASE WHEN v.reset "
+                "THEN v.consecutive_failures "
+                "ELSE s.consecutive_failures + v.consecutive_failures END, "
+                "last_status_code = v.last_status_code, "
+                "last_latency = v.last_latency, "
+                "last_error_at = COALESCE(v.last_error_at, s.last_error_at), "
+                "last_run = COALESCE(v.last_run, s.last_run) "
+                "FROM (VALUES {rows}) AS v(id, successes, failures, "
+                "consecutive_failures, reset, last_status_code, last_latency, "
+                "last_error_at, last_run) "
+                "WHERE s.id = v.id".format(
+                    table=qn(Schedule._meta.db_table),
+                    rows=", ".join([row] * len(batch)),
+                ),
+                params,
+            )
+            return cursor.rowcount
+
+    def copy(self, deliveries):
+        """
+        Writes the deliveries to the ledger with a single COPY, creating the
+        partitions that they fall in first.
+        """
+        table = Delivery._meta.db_table
+        ensure_partitions(table, [d.fired_at for d in deliveries], "day")
+        fields = [
+            field for field in Delivery._meta.concrete_fields if not field.primary_key
+        ]
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        for delivery in deliveries:
+            writer.writerow(
+                [copy_value(getattr(delivery, field.attname)) for field in fields]
+            )
+        buffer.seek(0)
+
+        qn = connection.ops.quote_name
+        with connection.cursor() as cursor:
+            cursor.copy_expert(
+                "COPY %s (%s) FROM STDIN WITH (FORMAT csv)"
+                % (qn(table), ", ".join(qn(field.column) for field in fields)),
+                buffer,
+            )
+
+
+delivery_stats = DeliveryStats()
+
+
+@worker_process_shutdown.connect
+@worker_shutdown.connect
+def flush_delivery_stats(**kwargs):
+    delivery_stats.flush()
@@ -0,0 +1,74 @@
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class StubServer(object):
+
+    """
+    A local HTTP server that stands in for the endpoints that schedules are
+    delivered to, for simulations and benchmarks. Each POST is answered
+    after `latency` seconds, with a 500 for `error_rate` of them and a 201
+    for the rest. The path and status of every request are kept in
+    `requests`.
+    """
+
+    def __init__(self, latency=0, error_rate=0, seed=None):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = []
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self.handler_class())
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return "http://%s:%s" % (host, port)
+
+    def handler_class(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get("Content-Length") or 0))
+                self.send_response(stub.respond(self.path))
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def respond(self, path):
+        if self.latency:
+            time.sleep(self.latency)
+        with self.lock:
+            status = 500 if self.random.random() < self.error_rate else 201
+            self.requests.append((path, status))
+        return status
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
@@ -1,23 +1,41 @@
 import json
+import time
+import weakref
+from datetime import timedelta
+from http.cookiejar import DefaultCookiePolicy
 from uuid import uuid4
 
 import requests
 from celery.task import Task
 from celery.utils.log import get_task_logger
 from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import BooleanField, Case, DateTimeField, F, Max, Q, Value, When
 from django.utils.timezone import now
-from djcelery.models import CrontabSchedule, IntervalSchedule
+from djcelery.models import CrontabSchedule, IntervalSchedule, PeriodicTask
 from requests import exceptions as requests_exceptions
-from seed_services_client.metrics import MetricsApiClient
 
 from seed_scheduler import utils
 
-from .models import QueueTaskRun, Schedule, ScheduleFailure
+from . import archive, definitions
+from .bulk import chunks
+from .models import Delivery, HookDelivery, QueueTaskRun, Schedule, ScheduleFailure
+from .outbox import deliver_outbox
+from .partitions import maintain_partitions
+from .replica import fanout_database, replica_configured, replica_lag
+from .shards import group_by_shard, iter_shards, shard_querysets, shards
+from .stats import delivery_stats
 
 logger = get_task_logger(__name__)
 
 
 class DeliverHook(Task):
+
+    """
+    Task to deliver a webhook, only kept for the deliveries that were queued
+    before the outbox. See DeliverHooks.
+    """
+
     def run(self, target, payload, instance_id=None, hook_id=None, **kwargs):
         """
         target:     the url to receive the payload.
@@ -32,18 +50,96 @@ class DeliverHook(Task):
                 "Content-Type": "application/json",
                 "Authorization": "Token %s" % settings.HOOK_AUTH_TOKEN,
             },
+            timeout=settings.DEFAULT_REQUEST_TIMEOUT,
         )
 
 
+def queue_deliver_hooks():
+    deliver_hooks.apply_async()
+
+
+def queue_batched_deliver_hooks():
+    deliver_hooks.apply_async(countdown=settings.SCHEDULER_HOOK_BATCH_INTERVAL / 1000.0)
+
+
+def on_commit_once(func):
+    """
+    Calls `func` once the transaction is committed, however many times this
+    is called during the transaction. The waiting callback is kept on the
+    connection by a weak reference, which goes away along with the callback
+    once it has run, or if the transaction is rolled back.
+    """
+    waiting = getattr(connection, "scheduler_on_commit", None)
+    if waiting is None:
+        waiting = connection.scheduler_on_commit = weakref.WeakValueDictionary()
+    if waiting.get(func) is not None:
+        return
+
+    def callback():
+        func()
+
+    waiting[func] = callback
+    transaction.on_commit(callback)
+
+
 def deliver_hook_wrapper(target, payload, instance, hook):
-    if instance is not None:
-        instance_id = instance.id
-    else:
-        instance_id = None
-    kwargs = dict(
-        target=target, payload=payload, instance_id=instance_id, hook_id=hook.id
+    """
+    Writes the delivery to the outbox, in the same transaction as the change
+    that caused it, and queues a task to send it once that is committed.
+    """
+    HookDelivery.objects.create(hook=hook, payload=payload, next_attempt_at=now())
+    # One task is enough for all of the deliveries in a transaction
+    on_commit_once(queue_deliver_hooks)
+
+
+def deliver_batched_hook(hook, data):
+    """
+    Writes an item of a batched delivery to the outbox, in the same
+    transaction as the change that caused it. It is sent
+    SCHEDULER_HOOK_BATCH_INTERVAL milliseconds later, along with the other
+    items for the hook that are due by then.
+    """
+    HookDelivery.objects.create(
+        hook=hook,
+        payload=data,
+        batched=True,
+        next_attempt_at=now()
+        + timedelta(milliseconds=settings.SCHEDULER_HOOK_BATCH_INTERVAL),
     )
-    DeliverHook.apply_async(kwargs=kwargs)
+    on_commit_once(queue_batched_deliver_hooks)
+
+
+class DeliverHooks(Task):
+
+    """
+    Task to send the webhook deliveries waiting in the outbox
+    """
+
+    name = "seed_scheduler.scheduler.tasks.deliver_hooks"
+    ignore_result = True
+
+    def run(self, **kwargs):
+        return "Delivered <%s> Hooks" % (deliver_outbox(),)
+
+
+deliver_hooks = DeliverHooks()
+
+
+delivery_session = None
+
+
+def get_delivery_session():
+    """
+    Returns the session that schedules are delivered with, which keeps
+    connections to the endpoints open between deliveries.
+    """
+    global delivery_session
+    if delivery_session is None:
+        session = requests.Session()
+        # Cookies set by one schedule's endpoint mustn't be sent with another
+        session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+        delivery_session = session
+    return delivery_session
 
 
 class DeliverTask(Task):
@@ -70,8 +166,10 @@ class DeliverTask(Task):
         headers = {"Content-Type": "application/json"}
         if auth_token is not None:
             headers["Authorization"] = "Token %s" % auth_token
+        started = time.monotonic()
+        response = None
         try:
-            response = requests.post(
+            response = get_delivery_session().post(
                 url=endpoint,
                 data=json.dumps(payload),
                 headers=headers,
@@ -80,12 +178,14 @@ class DeliverTask(Task):
             # Expecting a 201, raise for errors.
             response.raise_for_status()
 
-            Schedule.objects.filter(id=schedule_id).update(last_run=now())
+            self.record(schedule_id, response, started)
         except requests_exceptions.ConnectionError as exc:
+            self.record(schedule_id, response, started, failed=True)
             log.info("Connection Error to endpoint: %s" % endpoint)
             fire_metric.delay("scheduler.deliver_task.connection_error.sum", 1)
             self.retry(exc=exc, countdown=retry_delay)
         except requests_exceptions.HTTPError as exc:
+            self.record(schedule_id, response, started, failed=True)
             # Recoverable HTTP errors: 500, 401
             log.info("Request failed due to status: %s" % exc.response.status_code)
             metric_name = (
@@ -94,12 +194,33 @@ class DeliverTask(Task):
             fire_metric.delay(metric_name, 1)
             self.retry(exc=exc, countdown=retry_delay)
         except requests_exceptions.Timeout as exc:
+            self.record(schedule_id, response, started, failed=True)
             log.info("Request failed due to timeout")
             fire_metric.delay("scheduler.deliver_task.timeout.sum", 1)
             self.retry(exc=exc, countdown=retry_delay)
 
         return True
 
+    def record(self, schedule_id, response, started, failed=False):
+        """
+        Adds the result of the delivery to the schedule's delivery stats and
+        the delivery ledger.
+        """
+        latency = time.monotonic() - started
+        status_code = response.status_code if response is not None else None
+        attempt = self.request.retries + 1
+        if failed:
+            delivery_stats.add(
+                schedule_id, status_code, latency, error_at=now(), attempt=attempt
+            )
+        else:
+            delivery_stats.add(
+                schedule_id, status_code, latency, run_at=now(), attempt=attempt
+            )
+        # Nothing flushes the stats of tasks run outside of a worker later
+        if self.request.is_eager:
+            delivery_stats.flush()
+
     def on_failure(self, exc, task_id, args, kwargs, einfo):
         if self.request.retries == self.max_retries:
             if "schedule_id" in kwargs:
@@ -118,6 +239,83 @@ class DeliverTask(Task):
 deliver_task = DeliverTask()
 
 
+def claim_crontab_runs(lookup_id, task_id, started_at):
+    """
+    Creates the QueueTaskRuns for a crontab definition and for every other
+    enabled crontab definition that is due at the same time, and hasn't
+    been queued for that time yet. Returns the new QueueTaskRuns, or the
+    started_at of the last run if the definition isn't due.
+
+    The definitions are locked while they are claimed, so that the runs for
+    definitions that are due together are only ever queued once.
+    """
+    skew = settings.DEFAULT_CLOCK_SKEW_SECONDS
+    with transaction.atomic():
+        crontabs = CrontabSchedule.objects.filter(
+            Q(id=lookup_id)
+            | Q(
+                id__in=PeriodicTask.objects.filter(
+                    task=definitions.QUEUE_TASKS_TASK,
+                    enabled=True,
+                    crontab__isnull=False,
+                ).values("crontab")
+            )
+        )
+        crontabs = {c.id: c for c in crontabs.select_for_update().order_by("id")}
+        if lookup_id not in crontabs:
+            raise CrontabSchedule.DoesNotExist(
+                "CrontabSchedule <%s> does not exist" % lookup_id
+            )
+        last_runs = dict(
+            QueueTaskRun.objects.filter(celery_cron_definition__in=list(crontabs))
+            .values_list("celery_cron_definition")
+            .annotate(Max("started_at"))
+        )
+
+        # Confirm that this task should run now based on last run time.
+        last_run = last_runs.get(lookup_id)
+        if last_run is not None:
+            # This basicly replicates what celery beat is meant to do, but
+            # we can't trust celery beat and django-celery to always
+            # accurately update their own last run time.
+            due, due_next = crontabs[lookup_id].schedule.is_due(last_run)
+            if not due and due_next >= skew:
+                return last_run
+
+        tick = definitions.crontab_tick(
+            definitions.crontab_definition(crontabs[lookup_id]), started_at
+        )
+        # A run that started early is recorded at the time it was due, so
+        # that the definitions it claimed aren't due again at that time
+        started_at = max(started_at, tick)
+        lookup_ids = [lookup_id]
+        for crontab_id, crontab in crontabs.items():
+            last_run = last_runs.get(crontab_id)
+            if crontab_id == lookup_id or (
+                last_run is not None and last_run >= tick - timedelta(seconds=skew)
+            ):
+                continue
+            try:
+                entry = definitions.crontab_entry(
+                    definitions.crontab_definition(crontab)
+                )
+            except ValueError:
+                continue
+            if entry.test(tick):
+                lookup_ids.append(crontab_id)
+
+        return QueueTaskRun.objects.bulk_create(
+            [
+                QueueTaskRun(
+                    task_id=task_id,
+                    celery_cron_definition_id=crontab_id,
+                    started_at=started_at,
+                )
+                for crontab_id in lookup_ids
+            ]
+        )
+
+
 class QueueTasks(Task):
 
     """
@@ -127,11 +325,108 @@ class QueueTasks(Task):
     name = "seed_scheduler.scheduler.tasks.queue_tasks"
     ignore_result = True
 
-    def run(self, schedule_type, lookup_id, **kwargs):
+    def queue_schedules(self, schedules, send_delivery=None):
+        """
+        Creates a DeliverTask for each of the enabled schedules that haven't
+        reached their end_at or max_runs, and returns the number created.
+        They are sent with `send_delivery` if it is given, instead of
+        DeliverTask.apply_async.
+        With SCHEDULER_REPLICA_FANOUT, the schedules are read from the
+        replica while it is keeping up. Sharded schedules are read from all
+        of the shards at once.
+        """
+        send_delivery = send_delivery or DeliverTask.apply_async
+        at = now()
+        queued = 0
+        counted = []
+        values = (
+            schedules.filter(enabled=True)
+            .exclude(end_at__lte=at)
+            .exclude(max_runs__lte=F("triggered"))
+            .values("id", "auth_token", "endpoint", "payload", "max_runs")
+        )
+        for schedule in iter_shards(values, fanout_database()):
+            if schedule.pop("max_runs") is not None:
+                counted.append(schedule["id"])
+            schedule["schedule_id"] = str(schedule.pop("id"))
+            send_delivery(kwargs=schedule)
+            queued += 1
+        self.end_schedules(schedules, counted, at)
+        return queued
+
+    def end_schedules(self, schedules, counted, at):
+        """
+        Counts the run of each of the `counted` schedules, the ones with a
+        max_runs that were queued at `at`, and disables the ones that have
+        reached their end_at or max_runs. The counted schedules are updated
+        by id, SCHEDULER_BULK_BATCH_SIZE at a time on each shard, so that
+        schedules that were added or changed after they were read aren't
+        counted. Schedules without an end_at or max_runs aren't touched.
+        """
+        queued = (Q(end_at__isnull=True) | Q(end_at__gt=at)) & Q(
+            max_runs__gt=F("triggered")
+        )
+        ended = Q(end_at__lte=at) | Q(max_runs__lte=F("triggered") + 1)
+        changes = {
+            "triggered": Case(
+                When(queued, then=F("triggered") + 1), default=F("triggered")
+            ),
+            "enabled": Case(
+                When(ended, then=Value(False)),
+                default=Value(True),
+                output_field=BooleanField(),
+            ),
+            # Schedules are archived some time after they're disabled
+            "updated_at": Case(
+                When(ended, then=Value(at)),
+                default=F("updated_at"),
+                output_field=DateTimeField(),
+            ),
+        }
+        counted = group_by_shard(counted)
+        for queryset in shard_querysets(schedules):
+            ids = counted.get(queryset.db, [])
+            batches = list(chunks(ids, settings.SCHEDULER_BULK_BATCH_SIZE)) or [[]]
+            for index, batch in enumerate(batches):
+                condition = Q(id__in=batch)
+                if index == 0:
+                    # The schedules that reached their end_at without being
+                    # queued are disabled along with the first batch
+                    condition |= Q(end_at__lte=at)
+                queryset.filter(condition, enabled=True).update(**changes)
+
+    def run_crontabs(self, lookup_id, log, send_delivery=None):
+        """
+        Queues the schedules of a crontab definition along with those of the
+        other definitions due at the same time, with a single query.
+        """
+        task_runs = claim_crontab_runs(lookup_id, self.request.id or uuid4(), now())
+        if not isinstance(task_runs, list):
+            return "Aborted Queuing <crontab> <%s> due to last task run at %s" % (
+                lookup_id,
+                task_runs,
+            )
+        lookup_ids = [task_run.celery_cron_definition_id for task_run in task_runs]
+        log.info("Queuing crontabs <%s>" % (lookup_ids,))
+
+        queued = self.queue_schedules(
+            Schedule.objects.filter(celery_cron_definition__in=lookup_ids),
+            send_delivery,
+        )
+        # The runs all started at the same time, which limits the update to
+        # the partition they're in
+        QueueTaskRun.objects.filter(
+            id__in=[r.id for r in task_runs], started_at=task_runs[0].started_at
+        ).update(completed_at=now())
+        return "Queued <%s> Tasks" % (queued,)
+
+    def run(self, schedule_type, lookup_id, send_delivery=None, **kwargs):
         """
         Loads Schedule linked to provided lookup
         """
         log = self.get_logger(**kwargs)
+        if schedule_type == "crontab" and settings.SCHEDULER_COALESCE_CRONTABS:
+            return self.run_crontabs(lookup_id, log, send_delivery)
         log.info("Queuing <%s> <%s>" % (schedule_type, lookup_id))
 
         task_run = QueueTaskRun()
@@ -140,7 +435,7 @@ class QueueTasks(Task):
         tr_qs = QueueTaskRun.objects
 
         # Load the schedule active items
-        schedules = Schedule.objects.filter(enabled=True)
+        schedules = Schedule.objects.all()
         if schedule_type == "crontab":
             schedules = schedules.filter(celery_cron_definition=lookup_id)
             tr_qs = tr_qs.filter(celery_cron_definition=lookup_id)
@@ -178,12 +473,7 @@ class QueueTasks(Task):
 
         task_run.save()
         # create tasks for each active schedule
-        queued = 0
-        schedules = schedules.values("id", "auth_token", "endpoint", "payload")
-        for schedule in schedules.iterator():
-            schedule["schedule_id"] = str(schedule.pop("id"))
-            DeliverTask.apply_async(kwargs=schedule)
-            queued += 1
+        queued = self.queue_schedules(schedules, send_delivery)
 
         task_run.completed_at = now()
         task_run.save()
@@ -194,6 +484,9 @@ queue_tasks = QueueTasks()
 
 
 def get_metric_client(session=None):
+    # Only imported when it's used, since most processes never fire metrics
+    from seed_services_client.metrics import MetricsApiClient
+
     return MetricsApiClient(
         url=settings.METRICS_URL, auth=settings.METRICS_AUTH, session=session
     )
@@ -230,17 +523,135 @@ class RequeueFailedTasks(Task):
         Runs an instance of a scheduled task
         """
         log = self.get_logger(**kwargs)
-        failures = ScheduleFailure.objects
-        log.info("Attempting to requeue <%s> failed schedules" % failures.count())
-        for failure in failures.iterator():
-            schedule = Schedule.objects.values(
-                "id", "auth_token", "endpoint", "payload"
-            )
-            schedule = schedule.get(id=failure.schedule_id)
-            schedule["schedule_id"] = str(schedule.pop("id"))
-            # Cleanup the failure before requeueing it.
-            failure.delete()
-            DeliverTask.apply_async(kwargs=schedule)
+        # Failures are on the same shard as their schedules
+        querysets = shard_querysets(ScheduleFailure.objects.all())
+        log.info(
+            "Attempting to requeue <%s> failed schedules"
+            % sum(failures.count() for failures in querysets)
+        )
+        for failures in querysets:
+            for failure in failures.iterator():
+                schedule = Schedule.objects.using(failure._state.db).values(
+                    "id", "auth_token", "endpoint", "payload"
+                )
+                schedule = schedule.get(id=failure.schedule_id)
+                schedule["schedule_id"] = str(schedule.pop("id"))
+                # Cleanup the failure before requeueing it.
+                failure.delete()
+                DeliverTask.apply_async(kwargs=schedule)
 
 
 requeue_failed_tasks = RequeueFailedTasks()
+
+
+class ReconcilePeriodicTasks(Task):
+
+    """
+    Task to disable, re-enable and clean up the PeriodicTasks for cron and
+    interval definitions, depending on whether schedules still use them.
+    """
+
+    name = "seed_scheduler.scheduler.tasks.reconcile_periodic_tasks"
+    ignore_result = True
+
+    def run(self, **kwargs):
+        log = self.get_logger(**kwargs)
+        summary = definitions.reconcile_periodic_tasks()
+        log.info("Reconciled periodic tasks: %s" % summary)
+        return summary
+
+
+reconcile_periodic_tasks = ReconcilePeriodicTasks()
+
+
+class ManagePartitions(Task):
+
+    """
+    Task to create the partitions of the delivery ledger, QueueTaskRuns and
+    ScheduleFailures ahead of time, and to drop the ones that are older than
+    their retention periods. ScheduleFailures are partitioned on every shard.
+    """
+
+    name = "seed_scheduler.scheduler.tasks.manage_partitions"
+    ignore_result = True
+
+    def run(self, **kwargs):
+        log = self.get_logger(**kwargs)
+        tables = [
+            (
+                Delivery,
+                "day",
+                settings.SCHEDULER_DELIVERY_LEDGER_PRECREATE_DAYS,
+                settings.SCHEDULER_DELIVERY_LEDGER_RETENTION_DAYS,
+                ["default"],
+            ),
+            (
+                QueueTaskRun,
+                "month",
+                settings.SCHEDULER_PARTITION_PRECREATE_MONTHS,
+                settings.SCHEDULER_QUEUE_TASK_RUN_RETENTION_MONTHS,
+                ["default"],
+            ),
+            (
+                ScheduleFailure,
+                "month",
+                settings.SCHEDULER_PARTITION_PRECREATE_MONTHS,
+                settings.SCHEDULER_SCHEDULE_FAILURE_RETENTION_MONTHS,
+                shards(),
+            ),
+        ]
+        dropped = {}
+        for model, period, ahead, keep, aliases in tables:
+            table = model._meta.db_table
+            dropped[table] = []
+            for alias in aliases:
+                dropped[table].extend(
+                    maintain_partitions(table, period, ahead, keep, alias)
+                )
+        log.info("Dropped partitions: %s" % dropped)
+        return dropped
+
+
+manage_partitions = ManagePartitions()
+
+
+class ArchiveSchedules(Task):
+
+    """
+    Task to move the schedules that have been disabled for longer than
+    SCHEDULER_ARCHIVE_AFTER_DAYS into the archive table.
+    """
+
+    name = "seed_scheduler.scheduler.tasks.archive_schedules"
+    ignore_result = True
+
+    def run(self, **kwargs):
+        log = self.get_logger(**kwargs)
+        archived = archive.archive_schedules()
+        log.info("Archived <%s> schedules" % archived)
+        return archived
+
+
+archive_schedules = ArchiveSchedules()
+
+
+class ReportReplicaLag(Task):
+
+    """
+    Task to report how many seconds the replica is behind the primary
+    database as a metric, from one worker instead of every process that
+    checks it.
+    """
+
+    name = "seed_scheduler.scheduler.tasks.report_replica_lag"
+    ignore_result = True
+
+    def run(self, **kwargs):
+        if not replica_configured():
+            return None
+        lag = replica_lag()
+        fire_metric.delay("scheduler.replica.lag_seconds.last", lag)
+        return lag
+
+
+report_replica_lag = ReportReplicaLag()
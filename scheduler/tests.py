@@ -1,14 +1,34 @@
+import base64
 import json
-from datetime import timedelta
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+from importlib import import_module
+from unittest import mock
 from uuid import uuid4
 
 import responses
+from django.apps import apps
+from django.conf import settings
 from django.contrib.auth.models import Group, User
-from django.core.management import call_command
-from django.test import TestCase, override_settings
+from django.core.management import CommandError, call_command
+from django.db import DatabaseError, connection
+from django.http import HttpResponse
+from django.test import RequestFactory, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.utils import timezone
 from django.utils.six import StringIO
-from djcelery.models import CrontabSchedule, IntervalSchedule, PeriodicTask
+from djcelery.models import (
+    CrontabSchedule,
+    IntervalSchedule,
+    PeriodicTask,
+    PeriodicTasks,
+)
 from freezegun import freeze_time
 from requests_testadapter import TestAdapter, TestSession
 from rest_framework import status
@@ -18,8 +38,52 @@ from rest_hooks.models import Hook
 
 from seed_scheduler import celery_app
 
-from .models import QueueTaskRun, Schedule, ScheduleFailure
-from .tasks import deliver_task, fire_metric, queue_tasks, requeue_failed_tasks
+from .archive import ARCHIVE_TABLE
+from .authentication import auth_cache
+from .benchmark import Benchmark
+from .definitions import (
+    canonical_cron_definition,
+    crontab_entry,
+    reconcile_periodic_tasks,
+)
+from .hooks import hook_cache
+from .memory import EX_RECYCLE, MemoryTracker, peak_rss, rss, start_worker_process
+from .models import (
+    Delivery,
+    HookDelivery,
+    QueueTaskRun,
+    Schedule,
+    ScheduleArchive,
+    ScheduleFailure,
+)
+from .outbox import deliver_outbox
+from .partitions import (
+    add_periods,
+    create_partition,
+    list_partitions,
+    maintain_partitions,
+    partition_name,
+    period_start,
+)
+from .preload import PRELOAD_MODULES, preload
+from .replica import ReplicaMiddleware, fanout_database, lag_monitor, pinned_clients
+from .routers import ReplicaRouter, ShardRouter, read_from_replica
+from .serializers import ScheduleSerializer
+from .shards import interleave_ids, shard_for
+from .simulation import Simulation
+from .stats import DeliveryStats
+from .tasks import (
+    archive_schedules,
+    deliver_task,
+    fire_metric,
+    get_delivery_session,
+    manage_partitions,
+    on_commit_once,
+    queue_tasks,
+    report_replica_lag,
+    requeue_failed_tasks,
+)
+from .views import CreatedAtCursorPagination
 
 try:
     from urllib.parse import urlparse, urlencode
@@ -45,6 +109,8 @@ class APITestCase(TestCase):
         self.client = APIClient()
         self.adminclient = APIClient()
         self.session = TestSession()
+        auth_cache.clear()
+        hook_cache.clear()
 
 
 class AuthenticatedAPITestCase(APITestCase):
@@ -394,6 +460,1121 @@ class TestSchedulerAppAPI(AuthenticatedAPITestCase):
     #                      "http://example.com/registration/")
 
 
+class TestCachedAuthentication(AuthenticatedAPITestCase):
+    def basic_auth(self, password):
+        credentials = "%s:%s" % (self.username, password)
+        return "Basic %s" % base64.b64encode(credentials.encode("utf-8")).decode()
+
+    def test_token_cached(self):
+        response = self.client.get("/api/health/")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get("/api/health/")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(queries), 0)
+
+    def test_token_deleted(self):
+        self.client.get("/api/health/")
+        Token.objects.filter(user=self.user).delete()
+
+        response = self.client.get("/api/health/")
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_user_deactivated(self):
+        self.client.get("/api/health/")
+        self.user.is_active = False
+        self.user.save()
+
+        response = self.client.get("/api/health/")
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_password_changed(self):
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION=self.basic_auth(self.password))
+        response = client.get("/api/health/")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        self.user.set_password("newpass")
+        self.user.save()
+
+        response = client.get("/api/health/")
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_shared_cache(self):
+        with mock.patch.object(auth_cache, "shared_alias", "default"):
+            self.client.get("/api/health/")
+            auth_cache.clear()
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get("/api/health/")
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(len(queries), 0)
+
+            self.user.is_active = False
+            self.user.save()
+            auth_cache.clear()
+            response = self.client.get("/api/health/")
+            self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    @override_settings(
+        PASSWORD_HASHERS=("django.contrib.auth.hashers.PBKDF2PasswordHasher",)
+    )
+    def test_basic_auth_benchmark(self):
+        self.user.set_password("benchpass")
+        self.user.save()
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION=self.basic_auth("benchpass"))
+
+        def requests_per_second(clear_cache):
+            started = time.time()
+            for i in range(5):
+                if clear_cache:
+                    auth_cache.clear()
+                response = client.get("/api/health/")
+                self.assertEqual(response.status_code, status.HTTP_200_OK)
+            return 5 / (time.time() - started)
+
+        uncached = requests_per_second(clear_cache=True)
+        cached = requests_per_second(clear_cache=False)
+        self.assertGreater(cached, uncached * 5)
+
+
+class TestScheduleHooks(AuthenticatedAPITestCase):
+    def setUp(self):
+        super(TestScheduleHooks, self).setUp()
+        self.hook = Hook.objects.create(
+            user=self.user,
+            event="schedule.added",
+            target="http://example.com/registration/",
+        )
+        responses.add(
+            responses.POST, "http://example.com/registration/", status=200, json={}
+        )
+
+    def create_schedule(self):
+        response = self.client.post(
+            "/api/v1/schedule/",
+            json.dumps({"cron_definition": "25 * * * *", "endpoint": "http://a.com/"}),
+            content_type="application/json",
+        )
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        return response.json()
+
+    @responses.activate
+    def test_hooks_cached(self):
+        self.create_schedule()
+        with CaptureQueriesContext(connection) as queries:
+            schedule = self.create_schedule()
+
+        self.assertFalse(
+            [query for query in queries if "rest_hooks_hook" in query["sql"]]
+        )
+        deliver_outbox()
+        self.assertEqual(len(responses.calls), 2)
+        bodies = [json.loads(call.request.body) for call in responses.calls]
+        self.assertIn(schedule["id"], [body["data"]["id"] for body in bodies])
+
+    @responses.activate
+    def test_hook_cache_invalidated(self):
+        self.create_schedule()
+        deliver_outbox()
+        response = self.client.delete("/api/v1/webhook/%s/" % self.hook.id)
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+
+        self.create_schedule()
+        deliver_outbox()
+        self.assertEqual(len(responses.calls), 1)
+
+    @responses.activate
+    def test_shared_hook_cache_invalidated(self):
+        with mock.patch.object(hook_cache, "shared_alias", "default"):
+            self.create_schedule()
+            # Another process, with the hooks in the shared cache
+            hook_cache.clear()
+            with CaptureQueriesContext(connection) as queries:
+                self.create_schedule()
+            self.assertFalse(
+                [query for query in queries if "rest_hooks_hook" in query["sql"]]
+            )
+
+            Hook.objects.create(
+                user=self.user,
+                event="schedule.added",
+                target="http://example.com/registration/",
+            )
+            hook_cache.clear()
+            self.create_schedule()
+
+        self.assertEqual(deliver_outbox(), 4)
+
+    @responses.activate
+    @override_settings(SCHEDULER_HOOK_BATCH_INTERVAL=60000, SCHEDULER_HOOK_BATCH_SIZE=2)
+    def test_hooks_batched(self):
+        schedules = [self.create_schedule() for i in range(3)]
+        self.assertEqual(HookDelivery.objects.filter(batched=True).count(), 3)
+        # Not due yet
+        self.assertEqual(deliver_outbox(), 0)
+
+        HookDelivery.objects.update(next_attempt_at=timezone.now())
+        self.assertEqual(deliver_outbox(), 3)
+        self.assertEqual(len(responses.calls), 2)
+        bodies = [json.loads(call.request.body) for call in responses.calls]
+        self.assertEqual(bodies[0]["hook"]["id"], self.hook.id)
+        self.assertEqual(
+            sorted(item["id"] for body in bodies for item in body["data"]),
+            sorted(schedule["id"] for schedule in schedules),
+        )
+
+
+class TestHookOutbox(AuthenticatedAPITestCase):
+    def setUp(self):
+        super(TestHookOutbox, self).setUp()
+        self.hook = Hook.objects.create(
+            user=self.user,
+            event="schedule.added",
+            target="http://example.com/registration/",
+        )
+
+    def test_schedule_added_written_to_outbox(self):
+        schedule = self.make_schedule()
+
+        delivery = HookDelivery.objects.get()
+        self.assertEqual(delivery.hook, self.hook)
+        self.assertEqual(delivery.payload["data"]["id"], str(schedule.id))
+        self.assertEqual(delivery.attempts, 0)
+
+    @responses.activate
+    def test_deliver(self):
+        responses.add(
+            responses.POST, "http://example.com/registration/", status=200, json={}
+        )
+        self.make_schedule()
+        self.make_schedule()
+
+        self.assertEqual(deliver_outbox(), 2)
+        self.assertEqual(len(responses.calls), 2)
+        self.assertEqual(
+            responses.calls[0].request.headers["Authorization"], "Token REPLACEME"
+        )
+        self.assertFalse(HookDelivery.objects.exists())
+
+    @responses.activate
+    def test_deliver_failure_retried(self):
+        responses.add(responses.POST, "http://example.com/registration/", status=500)
+        self.make_schedule()
+
+        self.assertEqual(deliver_outbox(), 0)
+
+        delivery = HookDelivery.objects.get()
+        self.assertEqual(delivery.attempts, 1)
+        self.assertIn("500", delivery.last_error)
+        self.assertGreater(delivery.next_attempt_at, timezone.now())
+        # Not due yet, so it isn't sent again
+        deliver_outbox()
+        self.assertEqual(len(responses.calls), 1)
+
+    @responses.activate
+    @override_settings(SCHEDULER_HOOK_MAX_ATTEMPTS=2)
+    def test_deliver_gives_up(self):
+        responses.add(responses.POST, "http://example.com/registration/", status=500)
+        self.make_schedule()
+
+        for i in range(2):
+            HookDelivery.objects.update(next_attempt_at=timezone.now())
+            deliver_outbox()
+
+        delivery = HookDelivery.objects.get()
+        self.assertEqual(delivery.attempts, 2)
+        self.assertIsNone(delivery.next_attempt_at)
+
+    def test_on_commit_once(self):
+        calls = []
+
+        def queue():
+            calls.append(1)
+
+        with mock.patch("scheduler.tasks.transaction.on_commit") as on_commit:
+            on_commit_once(queue)
+            on_commit_once(queue)
+            self.assertEqual(on_commit.call_count, 1)
+            on_commit.call_args[0][0]()
+            self.assertEqual(calls, [1])
+
+            # The callback is gone once it has run, or has been rolled back
+            on_commit.reset_mock()
+            on_commit_once(queue)
+            self.assertEqual(on_commit.call_count, 1)
+
+
+class TestScheduleReadAPI(AuthenticatedAPITestCase):
+    def make_schedule(self):
+        schedule = super(TestScheduleReadAPI, self).make_schedule()
+        schedule.created_by = self.user
+        schedule.updated_by = self.user
+        schedule.next_send_at = timezone.now()
+        schedule.payload = {"run": 1}
+        schedule.save()
+        return schedule
+
+    def assertSerialized(self, data, schedule, request):
+        serializer = ScheduleSerializer(schedule, context={"request": request})
+        self.assertEqual(data, json.loads(json.dumps(serializer.data)))
+
+    def test_list_matches_serializer(self):
+        schedule = self.make_schedule()
+
+        response = self.client.get("/api/v1/schedule/")
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertSerialized(
+            response.json()["results"][0], schedule, response.wsgi_request
+        )
+
+    def test_detail_matches_serializer(self):
+        schedule = self.make_schedule()
+
+        response = self.client.get("/api/v1/schedule/%s/" % schedule.id)
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertSerialized(response.json(), schedule, response.wsgi_request)
+
+    def test_delivery_stats(self):
+        failing = self.make_schedule()
+        Schedule.objects.filter(id=failing.id).update(
+            failure_count=3,
+            consecutive_failures=3,
+            last_status_code=500,
+            last_latency=0.25,
+            last_error_at=timezone.now(),
+        )
+        failing.refresh_from_db()
+        self.make_schedule()
+
+        response = self.client.get("/api/v1/schedule/?consecutive_failures__gte=2")
+
+        [data] = response.json()["results"]
+        self.assertSerialized(data, failing, response.wsgi_request)
+        self.assertEqual(data["consecutive_failures"], 3)
+        self.assertEqual(data["last_status_code"], 500)
+        self.assertEqual(data["last_latency"], 0.25)
+
+    def test_detail_not_found(self):
+        response = self.client.get("/api/v1/schedule/%s/" % uuid4())
+
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_sparse_fields(self):
+        schedule = self.make_schedule()
+
+        response = self.client.get("/api/v1/schedule/?fields=id,endpoint")
+        self.assertEqual(
+            response.json()["results"],
+            [{"id": str(schedule.id), "endpoint": "http://example.com"}],
+        )
+
+        response = self.client.get(
+            "/api/v1/schedule/%s/?fields=url,enabled" % schedule.id
+        )
+        self.assertEqual(
+            response.json(),
+            {
+                "url": "http://testserver/api/v1/schedule/%s/" % schedule.id,
+                "enabled": True,
+            },
+        )
+
+    def test_sparse_fields_unknown(self):
+        response = self.client.get("/api/v1/schedule/?fields=id,celery_cron")
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.json(), {"fields": ["Unknown fields: celery_cron"]})
+
+    def test_list_page_benchmark(self):
+        Schedule.objects.bulk_create(
+            Schedule(
+                cron_definition="25 * * * *",
+                endpoint="http://example.com",
+                payload={"run": i},
+                created_by=self.user,
+                updated_by=self.user,
+            )
+            for i in range(1000)
+        )
+
+        with mock.patch.object(CreatedAtCursorPagination, "page_size", 1000):
+            with CaptureQueriesContext(connection) as queries:
+                started = time.time()
+                response = self.client.get("/api/v1/schedule/")
+                elapsed = time.time() - started
+
+        self.assertEqual(len(response.json()["results"]), 1000)
+        # At most one query for the token, and one for the page
+        self.assertLessEqual(len(queries), 2)
+        self.assertLess(elapsed, 2)
+
+
+class TestScheduleBulkAPI(AuthenticatedAPITestCase):
+    def make_item(self, **kwargs):
+        item = {
+            "cron_definition": "25 * * * *",
+            "interval_definition": None,
+            "endpoint": "http://example.com/trigger/",
+            "payload": {},
+        }
+        item.update(kwargs)
+        return item
+
+    def test_bulk_create(self):
+        items = [
+            self.make_item(),
+            self.make_item(cron_definition="99 * * * *"),
+            self.make_item(endpoint="http://example.com/other/"),
+        ]
+        response = self.client.post(
+            "/api/v1/schedule/bulk/", json.dumps(items), content_type="application/json"
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        body = response.json()
+        self.assertEqual(body["created"], 2)
+        self.assertEqual(len(body["ids"]), 2)
+        self.assertEqual(
+            body["errors"],
+            [
+                {
+                    "index": 1,
+                    "errors": {
+                        "cron_definition": [
+                            "99 * * * * is not a valid crontab string: item value "
+                            "99 out of range [0, 59]"
+                        ]
+                    },
+                }
+            ],
+        )
+        self.assertEqual(Schedule.objects.count(), 2)
+        self.assertEqual(CrontabSchedule.objects.count(), 1)
+        self.assertEqual(PeriodicTask.objects.count(), 1)
+        for schedule in Schedule.objects.all():
+            self.assertEqual(schedule.celery_cron_definition.minute, "25")
+            self.assertEqual(schedule.created_by, self.user)
+
+    def test_bulk_create_ndjson(self):
+        items = [
+            self.make_item(),
+            self.make_item(cron_definition=None, interval_definition="1 minutes"),
+        ]
+        response = self.client.post(
+            "/api/v1/schedule/bulk/",
+            "\n".join(json.dumps(item) for item in items),
+            content_type="application/x-ndjson",
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.json()["created"], 2)
+        self.assertEqual(
+            Schedule.objects.filter(celery_interval_definition__every=1).count(), 1
+        )
+
+    def test_bulk_create_query_count(self):
+        items = []
+        for i in range(500):
+            items.append(self.make_item(cron_definition="%s * * * *" % (i % 5)))
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(
+                "/api/v1/schedule/bulk/",
+                json.dumps(items),
+                content_type="application/json",
+            )
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(Schedule.objects.count(), 500)
+        self.assertEqual(CrontabSchedule.objects.count(), 5)
+        # The number of queries depends on the number of definitions, not
+        # the number of schedules
+        self.assertLess(len(queries), 100)
+
+    def test_bulk_create_all_invalid(self):
+        response = self.client.post(
+            "/api/v1/schedule/bulk/",
+            json.dumps([self.make_item(interval_definition="every one mins")]),
+            content_type="application/json",
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.json()["created"], 0)
+        self.assertEqual(Schedule.objects.count(), 0)
+
+    def test_bulk_requires_list(self):
+        response = self.client.post(
+            "/api/v1/schedule/bulk/",
+            json.dumps(self.make_item()),
+            content_type="application/json",
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.json(), ["Expected a list of items."])
+
+    @responses.activate
+    @override_settings(SCHEDULER_BULK_HOOK_BATCH_SIZE=2)
+    def test_bulk_create_batched_webhook(self):
+        Hook.objects.create(
+            user=self.user,
+            event="schedule.added",
+            target="http://example.com/registration/",
+        )
+        responses.add(
+            responses.POST, "http://example.com/registration/", status=200, json={}
+        )
+
+        response = self.client.post(
+            "/api/v1/schedule/bulk/",
+            json.dumps([self.make_item() for i in range(3)]),
+            content_type="application/json",
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        deliver_outbox()
+        self.assertEqual(len(responses.calls), 2)
+        bodies = [json.loads(call.request.body) for call in responses.calls]
+        self.assertEqual(bodies[0]["hook"]["event"], "schedule.added")
+        self.assertEqual(
+            sorted(item["id"] for body in bodies for item in body["data"]),
+            sorted(response.json()["ids"]),
+        )
+
+    def test_bulk_update(self):
+        s1 = self.make_schedule()
+        s2 = self.make_schedule()
+        items = [
+            {"id": str(s1.id), "enabled": False},
+            {"id": str(s2.id), "cron_definition": "30 * * * *"},
+            {"id": str(uuid4()), "enabled": False},
+            {"enabled": False},
+        ]
+        response = self.client.patch(
+            "/api/v1/schedule/bulk/", json.dumps(items), content_type="application/json"
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        body = response.json()
+        self.assertEqual(body["updated"], 2)
+        self.assertEqual(
+            body["errors"],
+            [
+                {"index": 2, "errors": {"id": ["Not found."]}},
+                {"index": 3, "errors": {"id": ["A valid id is required."]}},
+            ],
+        )
+        s1.refresh_from_db()
+        s2.refresh_from_db()
+        self.assertEqual(s1.enabled, False)
+        self.assertEqual(s1.updated_by, self.user)
+        self.assertEqual(s2.enabled, True)
+        self.assertEqual(s2.cron_definition, "30 * * * *")
+        self.assertEqual(s2.celery_cron_definition.minute, "30")
+
+    def test_bulk_delete(self):
+        s1 = self.make_schedule()
+        s2 = self.make_schedule()
+        s3 = self.make_schedule()
+        missing = str(uuid4())
+        response = self.client.delete(
+            "/api/v1/schedule/bulk/",
+            json.dumps([str(s1.id), {"id": str(s2.id)}, missing, "nonsense"]),
+            content_type="application/json",
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        body = response.json()
+        self.assertEqual(body["deleted"], 2)
+        self.assertEqual(
+            body["errors"],
+            [
+                {"index": 2, "errors": {"id": ["Not found."]}},
+                {"index": 3, "errors": {"id": ["A valid id is required."]}},
+            ],
+        )
+        self.assertEqual(list(Schedule.objects.values_list("id", flat=True)), [s3.id])
+
+
+class TestScheduleSyncAPI(AuthenticatedAPITestCase):
+    def make_item(self, external_id, **kwargs):
+        item = {
+            "external_id": external_id,
+            "cron_definition": "25 * * * *",
+            "endpoint": "http://example.com/%s/" % external_id,
+            "payload": {},
+        }
+        item.update(kwargs)
+        return item
+
+    def sync(self, items):
+        return self.client.post(
+            "/api/v1/schedule/sync/", json.dumps(items), content_type="application/json"
+        )
+
+    def test_sync_creates(self):
+        response = self.sync([self.make_item("sub-1"), self.make_item("sub-2")])
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            response.json(),
+            {"created": 2, "updated": 0, "unchanged": 0, "disabled": 0, "errors": []},
+        )
+        schedule = Schedule.objects.get(external_id="sub-1")
+        self.assertEqual(schedule.endpoint, "http://example.com/sub-1/")
+        self.assertEqual(schedule.celery_cron_definition.minute, "25")
+        self.assertEqual(schedule.created_by, self.user)
+
+    def test_sync_updates_and_disables(self):
+        self.sync(
+            [self.make_item("sub-1"), self.make_item("sub-2"), self.make_item("sub-3")]
+        )
+        original = Schedule.objects.get(external_id="sub-1")
+
+        response = self.sync(
+            [
+                self.make_item("sub-1", payload={"changed": True}),
+                self.make_item("sub-2"),
+                self.make_item("sub-4"),
+            ]
+        )
+
+        self.assertEqual(
+            response.json(),
+            {"created": 1, "updated": 1, "unchanged": 1, "disabled": 1, "errors": []},
+        )
+        updated = Schedule.objects.get(external_id="sub-1")
+        self.assertEqual(updated.id, original.id)
+        self.assertEqual(updated.payload, {"changed": True})
+        self.assertEqual(updated.created_at, original.created_at)
+        self.assertFalse(Schedule.objects.get(external_id="sub-3").enabled)
+        self.assertTrue(Schedule.objects.get(external_id="sub-4").enabled)
+
+    def test_sync_ndjson(self):
+        response = self.client.post(
+            "/api/v1/schedule/sync/",
+            "\n".join(json.dumps(self.make_item("sub-%s" % i)) for i in range(5)),
+            content_type="application/x-ndjson",
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.json()["created"], 5)
+        self.assertEqual(Schedule.objects.count(), 5)
+
+    def test_sync_errors_skip_disabling(self):
+        self.sync([self.make_item("sub-1"), self.make_item("sub-2")])
+
+        response = self.sync(
+            [
+                self.make_item("sub-1"),
+                self.make_item("sub-3", cron_definition="99 * * * *"),
+                {"endpoint": "http://example.com/"},
+            ]
+        )
+
+        body = response.json()
+        self.assertEqual(body["unchanged"], 1)
+        self.assertEqual(body["disabled"], 0)
+        self.assertEqual([error["index"] for error in body["errors"]], [1, 2])
+        self.assertEqual(
+            body["errors"][1]["errors"], {"external_id": ["This field is required."]}
+        )
+        self.assertTrue(Schedule.objects.get(external_id="sub-2").enabled)
+
+    def test_sync_rejects_other_users(self):
+        other = Schedule.objects.create(
+            external_id="sub-1",
+            cron_definition="25 * * * *",
+            endpoint="http://example.com/other/",
+            created_by=self.superuser,
+        )
+        self.sync([self.make_item("sub-3")])
+
+        response = self.sync(
+            [
+                self.make_item("sub-1", endpoint="http://example.com/changed/"),
+                self.make_item("sub-2"),
+            ]
+        )
+
+        self.assertEqual(
+            response.json(),
+            {
+                "created": 1,
+                "updated": 0,
+                "unchanged": 0,
+                "disabled": 0,
+                "errors": [
+                    {
+                        "index": 0,
+                        "errors": {
+                            "external_id": [
+                                "A schedule with this external id belongs to "
+                                "another user."
+                            ]
+                        },
+                    }
+                ],
+            },
+        )
+        self.assertTrue(Schedule.objects.get(external_id="sub-3").enabled)
+        other.refresh_from_db()
+        self.assertEqual(other.endpoint, "http://example.com/other/")
+        self.assertTrue(other.enabled)
+
+
+class TestScheduleForecast(AuthenticatedAPITestCase):
+    def make_schedules(self):
+        for endpoint, definition, enabled in (
+            ("http://a.example.com/x", {"cron_definition": "*/15 * * * *"}, True),
+            ("http://a.example.com/y", {"cron_definition": "0,15,30,45 * * * *"}, True),
+            ("http://a.example.com/z", {"cron_definition": "*/15 * * * *"}, False),
+            ("https://u@b.example.com:8000/", {"cron_definition": "0 * * * *"}, True),
+            ("http://c.example.com", {"interval_definition": "30 minutes"}, True),
+        ):
+            Schedule.objects.create(endpoint=endpoint, enabled=enabled, **definition)
+
+    def test_forecast(self):
+        self.make_schedules()
+
+        response = self.adminclient.get(
+            "/api/v1/schedule/forecast/",
+            {"start": "2017-01-01T00:00:30Z", "minutes": 60},
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        data = response.json()
+        self.assertEqual(data["start"], "2017-01-01T00:00:00+00:00")
+        self.assertEqual(data["total"], 11)
+        self.assertEqual(
+            data["peak"], {"at": "2017-01-01T00:00:00+00:00", "deliveries": 4}
+        )
+        expected = [0] * 60
+        expected[0], expected[15], expected[30], expected[45] = 4, 2, 3, 2
+        self.assertEqual(data["histogram"], expected)
+        self.assertEqual(
+            data["hosts"],
+            [
+                {"host": "a.example.com", "total": 8, "peak": 2},
+                {"host": "c.example.com", "total": 2, "peak": 1},
+                {"host": "b.example.com", "total": 1, "peak": 1},
+            ],
+        )
+
+    def test_forecast_invalid(self):
+        response = self.adminclient.get(
+            "/api/v1/schedule/forecast/", {"minutes": 0, "start": "tomorrow"}
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(sorted(response.json()), ["minutes", "start"])
+
+    def test_forecast_not_admin(self):
+        response = self.client.get("/api/v1/schedule/forecast/")
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_forecast_command(self):
+        self.make_schedules()
+        stdout = StringIO()
+
+        call_command(
+            "forecast_schedules",
+            "--start",
+            "2017-01-01T00:00:00",
+            "--minutes",
+            "15",
+            stdout=stdout,
+        )
+
+        data = json.loads(stdout.getvalue())
+        self.assertEqual(data["total"], 4)
+        self.assertEqual(len(data["histogram"]), 15)
+
+    def test_forecast_many_definitions(self):
+        crontabs = CrontabSchedule.objects.bulk_create(
+            [
+                CrontabSchedule(
+                    minute=str(minute), hour=str(hour), day_of_week=str(day)
+                )
+                for minute in range(60)
+                for hour in range(24)
+                for day in range(7)
+            ]
+        )
+        Schedule.objects.bulk_create(
+            [
+                Schedule(
+                    cron_definition="x",
+                    celery_cron_definition=crontab,
+                    endpoint="http://%s.example.com/" % (crontab.id % 10),
+                )
+                for crontab in crontabs
+            ]
+        )
+
+        started = time.time()
+        response = self.adminclient.get(
+            "/api/v1/schedule/forecast/", {"start": "2017-01-01T00:00:00Z"}
+        )
+        elapsed = time.time() - started
+
+        data = response.json()
+        # Every minute and hour, on one of the days of the week
+        self.assertEqual(data["total"], 1440)
+        self.assertEqual(len(data["hosts"]), 10)
+        self.assertLess(elapsed, 2)
+
+
+class TestScheduleExport(AuthenticatedAPITestCase):
+    def setUp(self):
+        super(TestScheduleExport, self).setUp()
+        self.schedules = [self.make_schedule() for i in range(3)]
+        self.schedules[0].enabled = False
+        self.schedules[0].save()
+
+    def export(self, query=""):
+        response = self.client.get("/api/v1/schedule/export/%s" % query)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return b"".join(response.streaming_content).decode("utf-8")
+
+    @override_settings(SCHEDULER_BULK_BATCH_SIZE=2)
+    def test_export_ndjson(self):
+        content = self.export()
+
+        rows = [json.loads(line) for line in content.splitlines()]
+        self.assertEqual(
+            sorted(row["id"] for row in rows),
+            sorted(str(schedule.id) for schedule in self.schedules),
+        )
+        self.assertEqual(rows[0]["cron_definition"], "25 * * * *")
+        self.assertEqual(rows[0]["payload"], {})
+        self.assertNotIn("created_by", rows[0])
+
+    def test_export_filtered(self):
+        content = self.export("?enabled=false")
+
+        rows = [json.loads(line) for line in content.splitlines()]
+        self.assertEqual([row["id"] for row in rows], [str(self.schedules[0].id)])
+
+    def test_export_csv(self):
+        content = self.export("?output=csv")
+
+        lines = content.splitlines()
+        self.assertEqual(len(lines), 4)
+        self.assertTrue(lines[0].startswith("id,external_id,frequency,"))
+
+    def test_export_invalid_output(self):
+        response = self.client.get("/api/v1/schedule/export/?output=xml")
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_export_command(self):
+        stdout = StringIO()
+        call_command("export_schedules", "--filter", "enabled=true", stdout=stdout)
+
+        rows = [json.loads(line) for line in stdout.getvalue().splitlines()]
+        self.assertEqual(
+            sorted(row["id"] for row in rows),
+            sorted(str(schedule.id) for schedule in self.schedules[1:]),
+        )
+
+
+class TestScheduleImport(AuthenticatedAPITestCase):
+    def post_import(self, body, content_type="application/x-ndjson"):
+        response = self.adminclient.post(
+            "/api/v1/schedule/import/", body, content_type=content_type
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response.json()
+
+    def test_import_ndjson(self):
+        schedule_id = str(uuid4())
+        rows = [
+            {
+                "id": schedule_id,
+                "cron_definition": "25 * * * *",
+                "endpoint": "http://example.com/trigger/",
+                "payload": {"run": 1},
+                "created_at": "2017-01-01T00:00:00+00:00",
+            },
+            {"cron_definition": "99 * * * *", "endpoint": "http://example.com/"},
+        ]
+        body = "\n".join(
+            [json.dumps(rows[0]), json.dumps(rows[1]), "{not json", ""]
+            + [json.dumps({"interval_definition": "1 minutes", "endpoint": "x"})]
+        )
+
+        resp = self.post_import(body)
+
+        self.assertEqual(resp["imported"], 2)
+        self.assertEqual(resp["rejected"], 2)
+        self.assertEqual([error["row"] for error in resp["errors"]], [2, 3])
+        self.assertIn("cron_definition", resp["errors"][0]["errors"])
+        schedule = Schedule.objects.get(id=schedule_id)
+        self.assertEqual(schedule.payload, {"run": 1})
+        self.assertEqual(schedule.created_at.year, 2017)
+        self.assertEqual(schedule.celery_cron_definition.minute, "25")
+        self.assertEqual(schedule.created_by, self.superuser)
+        self.assertTrue(PeriodicTask.objects.filter(name="Run 1 minutes").exists())
+
+    def test_import_csv_export(self):
+        schedules = [self.make_schedule() for i in range(3)]
+        response = self.client.get("/api/v1/schedule/export/?output=csv")
+        body = b"".join(response.streaming_content)
+        Schedule.objects.all().delete()
+
+        resp = self.post_import(body, content_type="text/csv")
+
+        self.assertEqual(resp["imported"], 3)
+        self.assertEqual(resp["rejected"], 0)
+        for schedule in schedules:
+            imported = Schedule.objects.get(id=schedule.id)
+            self.assertEqual(imported.created_at, schedule.created_at)
+            self.assertEqual(imported.payload, schedule.payload)
+            self.assertEqual(imported.enabled, schedule.enabled)
+            self.assertEqual(
+                imported.celery_cron_definition, schedule.celery_cron_definition
+            )
+
+    def test_import_existing_id(self):
+        schedule = self.make_schedule()
+        Schedule.objects.filter(id=schedule.id).update(external_id="sub-1")
+        new_id = str(uuid4())
+        body = "\n".join(
+            [
+                json.dumps({"id": str(schedule.id), "endpoint": "http://a.com/"}),
+                json.dumps({"id": new_id, "endpoint": "http://b.com/"}),
+                json.dumps({"external_id": "sub-1", "endpoint": "http://c.com/"}),
+                json.dumps({"id": new_id, "endpoint": "http://d.com/"}),
+                json.dumps({"endpoint": "http://e.com/"}),
+            ]
+        )
+
+        resp = self.post_import(body)
+
+        self.assertEqual(resp["imported"], 2)
+        self.assertEqual(resp["rejected"], 3)
+        self.assertEqual(
+            resp["errors"],
+            [
+                {
+                    "row": 1,
+                    "errors": {"id": ["A schedule with this value already exists."]},
+                },
+                {
+                    "row": 3,
+                    "errors": {
+                        "external_id": ["A schedule with this value already exists."]
+                    },
+                },
+                {
+                    "row": 4,
+                    "errors": {
+                        "id": ["An earlier row in the import has the same value."]
+                    },
+                },
+            ],
+        )
+        self.assertEqual(Schedule.objects.get(id=new_id).endpoint, "http://b.com/")
+        self.assertEqual(Schedule.objects.count(), 3)
+
+    def test_import_requires_admin(self):
+        response = self.client.post(
+            "/api/v1/schedule/import/", "", content_type="application/x-ndjson"
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_import_command(self):
+        with tempfile.NamedTemporaryFile(suffix=".ndjson") as f:
+            f.write(json.dumps({"endpoint": "http://example.com/"}).encode("utf-8"))
+            f.flush()
+            stdout = StringIO()
+            call_command(
+                "import_schedules", f.name, "--user", self.user.username, stdout=stdout
+            )
+
+        self.assertEqual(json.loads(stdout.getvalue())["imported"], 1)
+        self.assertEqual(Schedule.objects.get().created_by, self.user)
+
+
+class TestCrontabCanonicalization(AuthenticatedAPITestCase):
+    def make_cron_schedule(self, cron_definition):
+        return Schedule.objects.create(
+            cron_definition=cron_definition, endpoint="http://example.com"
+        )
+
+    def test_canonical_cron_definition(self):
+        self.assertEqual(canonical_cron_definition("0-59/15 * * * *"), "*/15 * * * *")
+        self.assertEqual(canonical_cron_definition("0 8 * * 1,2,3,4,5"), "0 8 * * 1-5")
+        self.assertEqual(canonical_cron_definition("0 0 1-31 * 0-7"), "0 0 * * *")
+        self.assertEqual(
+            canonical_cron_definition("5 1,2,3,7 * jan-mar sun"), "5 1-3,7 * 1-3 0"
+        )
+        self.assertEqual(
+            canonical_cron_definition("10-50/20 * * * *"), "10-50/20 * * * *"
+        )
+
+    def test_equivalent_definitions_share_crontab(self):
+        schedules = [
+            self.make_cron_schedule(cron_definition)
+            for cron_definition in (
+                "*/15 * * * *",
+                "0,15,30,45 * * * *",
+                "0-59/15 * * * *",
+            )
+        ]
+
+        self.assertEqual(len(set(s.celery_cron_definition_id for s in schedules)), 1)
+        crontab = CrontabSchedule.objects.get()
+        self.assertEqual(crontab.minute, "*/15")
+        task = PeriodicTask.objects.get(crontab=crontab)
+        self.assertEqual(task.name, "Run */15 * * * *")
+        # The definition that was asked for is kept on the schedule
+        self.assertEqual(schedules[1].cron_definition, "0,15,30,45 * * * *")
+
+    def test_merge_migration(self):
+        migration = import_module("scheduler.migrations.0009_merge_crontab_schedules")
+        kept = self.make_cron_schedule("*/15 * * * *").celery_cron_definition
+        duplicate = CrontabSchedule.objects.create(minute="0,15,30,45")
+        PeriodicTask.objects.create(
+            name="Run 0,15,30,45 * * * *",
+            task="seed_scheduler.scheduler.tasks.queue_tasks",
+            crontab=duplicate,
+            args='["crontab", %s]' % duplicate.id,
+        )
+        other = PeriodicTask.objects.create(
+            name="other", task="other", crontab=duplicate
+        )
+        schedule = self.make_cron_schedule("*/15 * * * *")
+        Schedule.objects.filter(id=schedule.id).update(celery_cron_definition=duplicate)
+        run = QueueTaskRun.objects.create(
+            task_id=uuid4(), celery_cron_definition=duplicate, started_at=timezone.now()
+        )
+        noncanonical = CrontabSchedule.objects.create(minute="0", hour="1,2,3")
+        last_update = PeriodicTasks.last_change()
+
+        migration.merge_crontab_schedules(apps, None)
+
+        self.assertFalse(CrontabSchedule.objects.filter(id=duplicate.id).exists())
+        schedule.refresh_from_db()
+        self.assertEqual(schedule.celery_cron_definition_id, kept.id)
+        run.refresh_from_db()
+        self.assertEqual(run.celery_cron_definition_id, kept.id)
+        other.refresh_from_db()
+        self.assertEqual(other.crontab_id, kept.id)
+        self.assertEqual(
+            PeriodicTask.objects.filter(
+                crontab=kept, task="seed_scheduler.scheduler.tasks.queue_tasks"
+            ).count(),
+            1,
+        )
+        noncanonical.refresh_from_db()
+        self.assertEqual(noncanonical.hour, "1-3")
+        self.assertGreater(PeriodicTasks.last_change(), last_update)
+
+
+class TestReconcilePeriodicTasks(AuthenticatedAPITestCase):
+    def get_task(self, schedule):
+        return PeriodicTask.objects.get(crontab=schedule.celery_cron_definition)
+
+    def test_disable_unused(self):
+        schedule = self.make_schedule()
+        schedule.enabled = False
+        schedule.save()
+
+        with mock.patch("scheduler.definitions.bump_periodic_tasks") as bump:
+            summary = reconcile_periodic_tasks()
+
+        self.assertEqual(summary["disabled"], 1)
+        self.assertFalse(self.get_task(schedule).enabled)
+        bump.assert_called_once_with()
+
+    def test_enable_used_again(self):
+        schedule = self.make_schedule()
+        Schedule.objects.update(enabled=False)
+        reconcile_periodic_tasks()
+        Schedule.objects.update(enabled=True)
+
+        summary = reconcile_periodic_tasks()
+
+        self.assertEqual(summary["enabled"], 1)
+        self.assertTrue(self.get_task(schedule).enabled)
+
+    def test_enable_on_save(self):
+        schedule = self.make_schedule()
+        Schedule.objects.update(enabled=False)
+        reconcile_periodic_tasks()
+        last_update = PeriodicTasks.last_change()
+
+        schedule.refresh_from_db()
+        schedule.enabled = True
+        schedule.save()
+
+        self.assertTrue(self.get_task(schedule).enabled)
+        self.assertGreater(PeriodicTasks.last_change(), last_update)
+
+    def test_save_unchanged(self):
+        schedule = self.make_schedule()
+        schedule.refresh_from_db()
+        schedule.payload = {"changed": True}
+
+        with CaptureQueriesContext(connection) as queries:
+            schedule.save()
+
+        self.assertFalse(
+            [query for query in queries if "djcelery_periodictask" in query["sql"]]
+        )
+
+    def test_enable_on_create(self):
+        schedule = self.make_schedule()
+        schedule.delete()
+        reconcile_periodic_tasks()
+
+        schedule = self.make_schedule()
+
+        self.assertTrue(self.get_task(schedule).enabled)
+
+    def test_delete_unused(self):
+        schedule = self.make_schedule()
+        crontab = schedule.celery_cron_definition
+        QueueTaskRun.objects.create(
+            task_id=uuid4(), celery_cron_definition=crontab, started_at=timezone.now()
+        )
+        other = CrontabSchedule.objects.create(minute="1")
+        PeriodicTask.objects.create(name="other", task="other", crontab=other)
+        schedule.delete()
+
+        summary = reconcile_periodic_tasks()
+        self.assertEqual(summary["deleted_crontabs"], 0)
+        PeriodicTask.objects.filter(crontab=crontab).update(
+            date_changed=timezone.now() - timedelta(days=2)
+        )
+        with mock.patch("scheduler.definitions.bump_periodic_tasks") as bump:
+            summary = reconcile_periodic_tasks()
+
+        self.assertEqual(summary["deleted_crontabs"], 1)
+        self.assertFalse(CrontabSchedule.objects.filter(id=crontab.id).exists())
+        self.assertFalse(PeriodicTask.objects.filter(crontab=crontab).exists())
+        self.assertFalse(QueueTaskRun.objects.exists())
+        self.assertTrue(PeriodicTask.objects.filter(crontab=other).exists())
+        bump.assert_called_once_with()
+
+    def test_keep_used_by_disabled(self):
+        schedule = self.make_schedule()
+        schedule.enabled = False
+        schedule.save()
+        reconcile_periodic_tasks()
+        PeriodicTask.objects.update(date_changed=timezone.now() - timedelta(days=2))
+
+        summary = reconcile_periodic_tasks()
+
+        self.assertEqual(summary["deleted_crontabs"], 0)
+        self.assertFalse(self.get_task(schedule).enabled)
+
+
 class TestSchedudlerTasks(AuthenticatedAPITestCase):
     @responses.activate
     def test_deliver_task(self):
@@ -431,6 +1612,128 @@ class TestSchedudlerTasks(AuthenticatedAPITestCase):
         self.assertEqual(result.get(), True)
         self.assertEqual(responses.calls[0].request.url, "http://example.com/trigger/")
 
+    @responses.activate
+    def test_deliver_task_stats(self):
+        responses.add(responses.POST, "http://example.com/trigger/", status=201)
+        schedule = Schedule.objects.create(
+            cron_definition="25 * * * *", endpoint="http://example.com/trigger/"
+        )
+
+        deliver_task.apply_async(
+            kwargs={
+                "schedule_id": str(schedule.id),
+                "auth_token": None,
+                "endpoint": schedule.endpoint,
+                "payload": {},
+            }
+        )
+
+        # Eager tasks write their stats straight away
+        schedule.refresh_from_db()
+        self.assertEqual(schedule.success_count, 1)
+        self.assertEqual(schedule.failure_count, 0)
+        self.assertEqual(schedule.last_status_code, 201)
+        self.assertGreaterEqual(schedule.last_latency, 0)
+        self.assertIsNotNone(schedule.last_run)
+        self.assertIsNone(schedule.last_error_at)
+
+    @responses.activate
+    def test_deliver_task_ledger(self):
+        responses.add(responses.POST, "http://example.com/trigger/", status=500)
+        responses.add(responses.POST, "http://example.com/trigger/", status=201)
+        schedule = Schedule.objects.create(
+            cron_definition="25 * * * *", endpoint="http://example.com/trigger/"
+        )
+
+        deliver_task.apply_async(
+            kwargs={
+                "schedule_id": str(schedule.id),
+                "auth_token": None,
+                "endpoint": schedule.endpoint,
+                "payload": {},
+            }
+        )
+
+        # Each attempt is a row in the ledger, written straight away
+        deliveries = Delivery.objects.filter(schedule_id=schedule.id)
+        self.assertEqual(
+            list(deliveries.order_by("attempt").values_list("attempt", "status_code")),
+            [(1, 500), (2, 201)],
+        )
+        for delivery in deliveries:
+            self.assertIsNotNone(delivery.fired_at)
+            self.assertGreaterEqual(delivery.latency, 0)
+            self.assertTrue(delivery.worker.endswith(":%s" % os.getpid()))
+
+    @override_settings(
+        SCHEDULER_DELIVERY_STATS_INTERVAL=60000, SCHEDULER_DELIVERY_LEDGER=False
+    )
+    def test_delivery_stats_batched(self):
+        failing = self.make_schedule()
+        Schedule.objects.filter(id=failing.id).update(consecutive_failures=1)
+        recovered = self.make_schedule()
+        stats = DeliveryStats()
+        self.addCleanup(stats.flush)
+        error_at = timezone.now()
+
+        with CaptureQueriesContext(connection) as queries:
+            stats.add(failing.id, 500, 0.5, error_at=error_at)
+            stats.add(failing.id, None, 30, error_at=error_at)
+            stats.add(recovered.id, 500, 0.5, error_at=error_at)
+            stats.add(recovered.id, 201, 0.1, run_at=error_at)
+            stats.add(recovered.id, 404, 0.2, error_at=error_at)
+        self.assertEqual(len(queries), 0)
+
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(stats.flush(), 2)
+        self.assertEqual(len(queries), 1)
+
+        failing.refresh_from_db()
+        self.assertEqual(failing.success_count, 0)
+        self.assertEqual(failing.failure_count, 2)
+        self.assertEqual(failing.consecutive_failures, 3)
+        self.assertIsNone(failing.last_status_code)
+        self.assertEqual(failing.last_latency, 30)
+        self.assertEqual(failing.last_error_at, error_at)
+        self.assertIsNone(failing.last_run)
+        recovered.refresh_from_db()
+        self.assertEqual(recovered.success_count, 1)
+        self.assertEqual(recovered.failure_count, 2)
+        self.assertEqual(recovered.consecutive_failures, 1)
+        self.assertEqual(recovered.last_status_code, 404)
+        self.assertEqual(recovered.last_run, error_at)
+
+    @override_settings(SCHEDULER_DELIVERY_STATS_INTERVAL=60000)
+    def test_delivery_stats_retried(self):
+        schedule = self.make_schedule()
+        stats = DeliveryStats()
+        self.addCleanup(stats.flush)
+        error_at = timezone.now()
+        stats.add(schedule.id, 500, 0.5, error_at=error_at)
+
+        with mock.patch.object(
+            stats, "write", side_effect=DatabaseError()
+        ), mock.patch.object(stats, "copy", side_effect=DatabaseError()):
+            self.assertEqual(stats.flush(), 0)
+        stats.add(schedule.id, 201, 0.1, run_at=error_at, attempt=2)
+        self.assertEqual(stats.flush(), 1)
+
+        schedule.refresh_from_db()
+        self.assertEqual(schedule.success_count, 1)
+        self.assertEqual(schedule.failure_count, 1)
+        self.assertEqual(schedule.consecutive_failures, 0)
+        self.assertEqual(schedule.last_status_code, 201)
+        self.assertEqual(schedule.last_error_at, error_at)
+        self.assertEqual(schedule.last_run, error_at)
+        self.assertEqual(
+            list(
+                Delivery.objects.filter(schedule_id=schedule.id)
+                .order_by("attempt")
+                .values_list("attempt", flat=True)
+            ),
+            [1, 2],
+        )
+
     @responses.activate
     def test_queue_tasks_one_crontab(self):
         # Tests crontab based task runs
@@ -766,17 +2069,139 @@ class TestSchedudlerTasks(AuthenticatedAPITestCase):
             completed_at=d1,
         )
 
-        # Execute
+        # Execute
+        result = queue_tasks.apply_async(
+            kwargs={
+                "schedule_type": "crontab",
+                "lookup_id": schedule.celery_cron_definition.id,
+            }
+        )
+
+        # Check
+        self.assertIn("Aborted Queuing", result.get())
+        self.assertEqual(QueueTaskRun.objects.all().count(), 1)
+
+    @responses.activate
+    @freeze_time("2017-01-01 08:00:00")
+    def test_queue_tasks_coalesce_crontabs(self):
+        responses.add(responses.POST, "http://example.com/trigger/", status=200)
+        schedules = [
+            Schedule.objects.create(
+                cron_definition=cron_definition,
+                endpoint="http://example.com/trigger/",
+                payload={},
+            )
+            for cron_definition in (
+                "0 8 * * *",
+                "0 */4 * * *",
+                "0 8 * * 0",
+                "30 8 * * *",
+                "0 8 1 * *",
+            )
+        ]
+        # Not due, and disabled
+        PeriodicTask.objects.filter(crontab=schedules[4].celery_cron_definition).update(
+            enabled=False
+        )
+
+        with CaptureQueriesContext(connection) as queries:
+            result = queue_tasks.apply_async(
+                kwargs={
+                    "schedule_type": "crontab",
+                    "lookup_id": schedules[0].celery_cron_definition_id,
+                }
+            )
+
+        self.assertEqual(result.get(), "Queued <3> Tasks")
+        self.assertEqual(
+            sorted(c.request.url for c in responses.calls),
+            ["http://example.com/trigger/"] * 3,
+        )
+        self.assertEqual(
+            sorted(
+                QueueTaskRun.objects.filter(completed_at__isnull=False).values_list(
+                    "celery_cron_definition", flat=True
+                )
+            ),
+            sorted(s.celery_cron_definition_id for s in schedules[:3]),
+        )
+        scans = [
+            q
+            for q in queries.captured_queries
+            if 'FROM "scheduler_schedule"' in q["sql"]
+        ]
+        self.assertEqual(len(scans), 1)
+
+        # The other definitions were queued already
+        result = queue_tasks.apply_async(
+            kwargs={
+                "schedule_type": "crontab",
+                "lookup_id": schedules[1].celery_cron_definition_id,
+            }
+        )
+        self.assertIn("Aborted Queuing", result.get())
+        self.assertEqual(QueueTaskRun.objects.count(), 3)
+
+    @responses.activate
+    def test_queue_tasks_coalesce_crontabs_early(self):
+        responses.add(responses.POST, "http://example.com/trigger/", status=200)
+        schedules = [
+            Schedule.objects.create(
+                cron_definition=cron_definition,
+                endpoint="http://example.com/trigger/",
+                payload={},
+            )
+            for cron_definition in ("0 8 * * *", "0 */4 * * *")
+        ]
+
+        # The first definition's run starts within the clock skew allowance
+        with freeze_time("2017-01-01 07:59:55"):
+            result = queue_tasks.apply_async(
+                kwargs={
+                    "schedule_type": "crontab",
+                    "lookup_id": schedules[0].celery_cron_definition_id,
+                }
+            )
+        self.assertEqual(result.get(), "Queued <2> Tasks")
+        self.assertEqual(
+            set(QueueTaskRun.objects.values_list("started_at", flat=True)),
+            {datetime(2017, 1, 1, 8, tzinfo=timezone.utc)},
+        )
+
+        # The coalesced definition was queued for 08:00 already
+        with freeze_time("2017-01-01 08:00:00"):
+            result = queue_tasks.apply_async(
+                kwargs={
+                    "schedule_type": "crontab",
+                    "lookup_id": schedules[1].celery_cron_definition_id,
+                }
+            )
+        self.assertIn("Aborted Queuing", result.get())
+        self.assertEqual(len(responses.calls), 2)
+
+    @responses.activate
+    @freeze_time("2017-01-01 08:00:00")
+    @override_settings(SCHEDULER_COALESCE_CRONTABS=False)
+    def test_queue_tasks_without_coalescing(self):
+        responses.add(responses.POST, "http://example.com/trigger/", status=200)
+        schedules = [
+            Schedule.objects.create(
+                cron_definition=cron_definition,
+                endpoint="http://example.com/trigger/",
+                payload={},
+            )
+            for cron_definition in ("0 8 * * *", "0 */4 * * *")
+        ]
+
         result = queue_tasks.apply_async(
             kwargs={
                 "schedule_type": "crontab",
-                "lookup_id": schedule.celery_cron_definition.id,
+                "lookup_id": schedules[0].celery_cron_definition_id,
             }
         )
 
-        # Check
-        self.assertIn("Aborted Queuing", result.get())
-        self.assertEqual(QueueTaskRun.objects.all().count(), 1)
+        self.assertEqual(result.get(), "Queued <1> Tasks")
+        self.assertEqual(QueueTaskRun.objects.count(), 1)
 
     @responses.activate
     def test_requeue_failed_tasks(self):
@@ -829,6 +2254,9 @@ class TestMetricsAPI(AuthenticatedAPITestCase):
                 "scheduler.deliver_task.http_error.404.sum",
                 "scheduler.deliver_task.http_error.500.sum",
                 "scheduler.deliver_task.timeout.sum",
+                "scheduler.worker.recycled.sum",
+                "scheduler.worker.rss_bytes.last",
+                "scheduler.replica.lag_seconds.last",
             ],
         )
 
@@ -1007,12 +2435,308 @@ class TestTriggerPeriodicTask(TestCase):
         self.assertTrue(pt_after_run.last_run_at)
 
 
+class TestSchedulerSimulation(TestCase):
+    def test_simulation(self):
+        simulation = Simulation(
+            definitions=["*/15 * * * *", "0 * * * *", "10 minutes"],
+            schedules=2,
+            hours=2,
+            start=datetime(2017, 1, 1, tzinfo=timezone.utc),
+            beat_delay=2,
+            restarts=2,
+        )
+
+        report = simulation.run()
+
+        self.assertEqual(report["expected_runs"], 7 + 1 + 11)
+        self.assertEqual(report["duplicate_runs"], 0)
+        self.assertEqual(report["missed_runs"], 0)
+        self.assertEqual(report["deliveries"], 19 * 2)
+        self.assertEqual(report["duplicate_deliveries"], 0)
+        self.assertEqual(report["missed_deliveries"], 0)
+        self.assertLessEqual(report["fanout_lateness_seconds"]["max"], 3)
+        # Nothing is kept
+        self.assertFalse(Schedule.objects.exists())
+        self.assertFalse(QueueTaskRun.objects.exists())
+
+    def test_simulate_command(self):
+        stdout = StringIO()
+
+        call_command(
+            "simulate_scheduler",
+            "--definition",
+            "*/30 * * * *",
+            "--schedules",
+            "3",
+            "--hours",
+            "1",
+            "--start",
+            "2017-01-01T00:00:00",
+            "--no-deliver",
+            stdout=stdout,
+        )
+
+        report = json.loads(stdout.getvalue())
+        self.assertEqual(report["expected_deliveries"], 3)
+        self.assertEqual(report["deliveries"], 3)
+
+
+class TestBenchScheduler(TestCase):
+    def test_benchmark(self):
+        report = Benchmark(
+            schedules=20, definitions=3, hosts=2, error_rate=0.5, concurrency=2
+        ).run()
+
+        self.assertEqual(report["definitions"], 3)
+        self.assertEqual(report["queue"]["queued"], 20)
+        self.assertEqual(report["deliver"]["deliveries"], 20)
+        self.assertGreater(report["deliver"]["errors"], 0)
+        self.assertLess(report["deliver"]["errors"], 20)
+        self.assertGreater(report["queue"]["queries"], 0)
+        self.assertIsNotNone(report["deliver"]["latency_seconds"]["p99"])
+        self.assertGreater(report["peak_rss_bytes"], 0)
+        self.assertFalse(Schedule.objects.exists())
+        self.assertFalse(QueueTaskRun.objects.exists())
+        self.assertFalse(PeriodicTask.objects.exists())
+        self.assertFalse(CrontabSchedule.objects.exists())
+
+    def test_bench_command(self):
+        stdout = StringIO()
+
+        call_command(
+            "bench_scheduler", "--schedules", "5", "--definitions", "1", stdout=stdout
+        )
+
+        report = json.loads(stdout.getvalue())
+        self.assertEqual(report["deliver"]["deliveries"], 5)
+        self.assertEqual(report["deliver"]["errors"], 0)
+
+    def test_bench_command_existing_schedules(self):
+        schedule = Schedule.objects.create(
+            cron_definition="* * * * *", endpoint="http://example.com/real/"
+        )
+        QueueTaskRun.objects.create(
+            task_id=uuid4(),
+            celery_cron_definition=schedule.celery_cron_definition,
+            started_at=timezone.now(),
+        )
+        stdout = StringIO()
+
+        with self.assertRaises(CommandError):
+            call_command("bench_scheduler", "--schedules", "5", stdout=stdout)
+        call_command("bench_scheduler", "--schedules", "5", "--force", stdout=stdout)
+
+        report = json.loads(stdout.getvalue())
+        self.assertEqual(report["queue"]["queued"], 5)
+        self.assertEqual(report["queue"]["foreign"], 0)
+        self.assertEqual(list(Schedule.objects.all()), [schedule])
+        self.assertEqual(QueueTaskRun.objects.count(), 1)
+        self.assertEqual(
+            list(CrontabSchedule.objects.all()), [schedule.celery_cron_definition]
+        )
+
+    @override_settings(SCHEDULER_SHARDS=["default", "shard1"])
+    def test_bench_command_sharded(self):
+        with self.assertRaises(CommandError):
+            call_command("bench_scheduler", "--schedules", "5", stdout=StringIO())
+        self.assertFalse(Schedule.objects.exists())
+
+
+class TestTaskProfiling(TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.task_dir = os.path.join(self.directory.name, requeue_failed_tasks.name)
+
+    def run_task(self, **options):
+        def slow_run(**kwargs):
+            time.sleep(0.05)
+
+        with mock.patch.object(requeue_failed_tasks, "run", slow_run):
+            requeue_failed_tasks.apply_async(**options)
+
+    def test_profile_header(self):
+        with override_settings(SCHEDULER_PROFILE_DIR=self.directory.name):
+            self.run_task(headers={"profile": True})
+            self.run_task(headers={"profile": True})
+
+        [name] = os.listdir(self.task_dir)
+        self.assertEqual(name, "%s.collapsed" % os.getpid())
+        with open(os.path.join(self.task_dir, name)) as f:
+            lines = f.read().splitlines()
+        # The samples from both runs are added up
+        samples = sum(int(line.rsplit(" ", 1)[1]) for line in lines)
+        self.assertGreaterEqual(samples, 10)
+        self.assertTrue(any("slow_run" in line for line in lines))
+
+    def test_profile_rate(self):
+        with override_settings(
+            SCHEDULER_PROFILE_DIR=self.directory.name,
+            SCHEDULER_PROFILE_RATE=1,
+            SCHEDULER_PROFILE_TASKS=[deliver_task.name],
+        ):
+            self.run_task()
+        self.assertFalse(os.path.exists(self.task_dir))
+
+        with override_settings(
+            SCHEDULER_PROFILE_DIR=self.directory.name,
+            SCHEDULER_PROFILE_RATE=1,
+            SCHEDULER_PROFILE_TASKS=[requeue_failed_tasks.name],
+        ):
+            self.run_task()
+        self.assertTrue(os.path.exists(self.task_dir))
+
+    def test_profile_thread(self):
+        """
+        Tasks that don't run in the main thread are sampled too.
+        """
+        with override_settings(SCHEDULER_PROFILE_DIR=self.directory.name):
+            thread = threading.Thread(
+                target=self.run_task, kwargs={"headers": {"profile": True}}
+            )
+            thread.start()
+            thread.join()
+
+        path = os.path.join(self.task_dir, "%s.collapsed" % os.getpid())
+        with open(path) as f:
+            self.assertIn("slow_run", f.read())
+
+    def test_profile_max_bytes(self):
+        os.makedirs(self.task_dir)
+        old = os.path.join(self.task_dir, "1.collapsed")
+        with open(old, "w") as f:
+            f.write("x" * 1000000)
+        os.utime(old, (0, 0))
+
+        with override_settings(
+            SCHEDULER_PROFILE_DIR=self.directory.name,
+            SCHEDULER_PROFILE_MAX_BYTES=1000000,
+        ):
+            self.run_task(headers={"profile": True})
+
+        self.assertEqual(os.listdir(self.task_dir), ["%s.collapsed" % os.getpid()])
+
+
+class TestWorkerMemory(TestCase):
+    def setUp(self):
+        self.tracker = MemoryTracker()
+
+    def test_rss(self):
+        self.assertGreater(rss(), 0)
+        self.assertLessEqual(rss(), peak_rss())
+
+    @mock.patch("scheduler.tasks.fire_metric.delay")
+    def test_recycle_over_max_rss(self, mock_metric):
+        self.tracker.task_started("a")
+        with override_settings(SCHEDULER_WORKER_MAX_RSS_BYTES=rss() * 10):
+            self.tracker.task_finished("a", "task")
+        self.assertFalse(self.tracker.recycle)
+
+        self.tracker.task_started("b")
+        with override_settings(SCHEDULER_WORKER_MAX_RSS_BYTES=1):
+            self.tracker.task_finished("b", "task")
+        self.assertTrue(self.tracker.recycle)
+        self.assertEqual(self.tracker.tasks, 2)
+        mock_metric.assert_called_once_with("scheduler.worker.recycled.sum", 1)
+
+    @mock.patch("scheduler.memory.tracker")
+    @mock.patch("scheduler.memory.current_process")
+    def test_recycle_before_next_task(self, mock_process, mock_tracker):
+        """
+        Once the tracker asks for the worker process to be replaced, it exits
+        before it takes another task.
+        """
+        wait_for_job = mock_process.return_value.wait_for_job
+        mock_tracker.recycle = False
+        start_worker_process()
+        receive = mock_process.return_value.wait_for_job
+
+        receive()
+        self.assertEqual(wait_for_job.call_count, 1)
+
+        mock_tracker.recycle = True
+        with self.assertRaises(SystemExit) as cm:
+            receive()
+        self.assertEqual(cm.exception.code, EX_RECYCLE)
+        self.assertEqual(wait_for_job.call_count, 1)
+
+    @mock.patch("scheduler.tasks.fire_metric.delay")
+    def test_memory_report(self, mock_metric):
+        self.addCleanup(tracemalloc.stop)
+        with override_settings(
+            SCHEDULER_MEMORY_TRACKING=True, SCHEDULER_MEMORY_REPORT_EVERY=2
+        ):
+            self.tracker.task_started("a")
+            leak = [str(i) * 100 for i in range(10000)]
+            self.tracker.task_finished("a", "task")
+            mock_metric.assert_not_called()
+
+            self.tracker.task_started("b")
+            with self.assertLogs("scheduler.memory", "INFO") as logs:
+                self.tracker.task_finished("b", "task")
+
+        self.assertIn("tests.py", logs.output[0])
+        self.assertEqual(len(leak), 10000)
+        [(name, _), _] = mock_metric.call_args
+        self.assertEqual(name, "scheduler.worker.rss_bytes.last")
+
+
+class TestWorkerStartup(TestCase):
+    def test_import_time(self):
+        """
+        Loading Django and the tasks doesn't import the modules that the
+        tasks only use now and then.
+        """
+        result = subprocess.run(
+            [
+                sys.executable,
+                "-X",
+                "importtime",
+                "-c",
+                "import django; django.setup(); import scheduler.tasks",
+            ],
+            cwd=settings.BASE_DIR,
+            env=dict(os.environ, DJANGO_SETTINGS_MODULE="seed_scheduler.testsettings"),
+            stderr=subprocess.PIPE,
+            universal_newlines=True,
+        )
+        self.assertEqual(result.returncode, 0, result.stderr)
+        # Each line is "import time: <self us> | <cumulative us> | <module>"
+        imported = set(
+            line.rsplit("|", 1)[1].strip()
+            for line in result.stderr.splitlines()
+            if line.startswith("import time:") and line.count("|") == 2
+        )
+        self.assertIn("scheduler.tasks", imported)
+        for name in PRELOAD_MODULES:
+            self.assertNotIn(name, imported)
+
+    @mock.patch("scheduler.preload.connections")
+    @mock.patch("scheduler.preload.import_module")
+    def test_preload(self, mock_import, mock_connections):
+        Schedule.objects.create(
+            cron_definition="7 * * * *", endpoint="http://example.com/"
+        )
+        crontab_entry.cache_clear()
+
+        preload()
+
+        mock_import.assert_called_once_with("seed_services_client.metrics")
+        mock_connections.close_all.assert_called_once_with()
+        # The cron definition was parsed before the worker processes fork
+        hits = crontab_entry.cache_info().hits
+        crontab_entry("7 * * * *")
+        self.assertEqual(crontab_entry.cache_info().hits, hits + 1)
+        self.assertIs(get_delivery_session(), get_delivery_session())
+
+
 class TestTriggerDeliverTasks(TestCase):
 
     timeout = 1
 
     def setUp(self):
         self.session = TestSession()
+        hook_cache.clear()
         self.crontab_schedule = CrontabSchedule.objects.create(
             **{
                 "minute": "*",
@@ -1321,3 +3045,698 @@ class TestFailedTaskAPI(AuthenticatedAPITestCase):
         self.assertEqual(response.data["requeued_failed_tasks"], True)
         self.assertEqual(responses.calls[0].request.url, "http://example.com/trigger/")
         self.assertEqual(ScheduleFailure.objects.all().count(), 0)
+
+
+class TestDeliveryLedger(AuthenticatedAPITestCase):
+    def add_delivery(self, schedule_id, fired_at, status_code=201):
+        delivery = Delivery(
+            schedule_id=schedule_id,
+            fired_at=fired_at,
+            attempt=1,
+            status_code=status_code,
+            latency=0.1,
+            worker="test:1",
+        )
+        DeliveryStats().copy([delivery])
+        return Delivery.objects.get(schedule_id=schedule_id, fired_at=fired_at)
+
+    def test_list_deliveries(self):
+        schedule_id = uuid4()
+        now = timezone.now()
+        old = self.add_delivery(schedule_id, now - timedelta(days=2), 500)
+        recent = self.add_delivery(schedule_id, now - timedelta(hours=1))
+        self.add_delivery(uuid4(), now)
+
+        response = self.client.get(
+            "/api/v1/deliveries/", {"schedule": str(schedule_id)}
+        )
+        self.assertEqual(response.status_code, 200)
+        body = response.json()
+        self.assertEqual([d["id"] for d in body["results"]], [recent.id, old.id])
+        self.assertEqual(body["results"][1]["schedule"], str(schedule_id))
+        self.assertEqual(body["results"][1]["status_code"], 500)
+        self.assertEqual(body["results"][1]["worker"], "test:1")
+
+        response = self.client.get(
+            "/api/v1/deliveries/",
+            {
+                "schedule": str(schedule_id),
+                "fired_at__gte": (now - timedelta(days=1)).isoformat(),
+            },
+        )
+        self.assertEqual([d["id"] for d in response.json()["results"]], [recent.id])
+
+    def test_list_deliveries_needs_schedule(self):
+        response = self.client.get("/api/v1/deliveries/")
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("schedule", response.json())
+
+    def test_maintain_partitions(self):
+        table = Delivery._meta.db_table
+        today = timezone.now().date()
+        self.add_delivery(uuid4(), timezone.now() - timedelta(days=10))
+        old_partition = partition_name(table, today - timedelta(days=10))
+        self.assertIn(old_partition, [p[0] for p in list_partitions(table)])
+
+        dropped = maintain_partitions(table, "day", 2, 5)
+
+        self.assertIn(old_partition, dropped)
+        names = [p[0] for p in list_partitions(table)]
+        self.assertNotIn(old_partition, names)
+        for days in range(3):
+            self.assertIn(partition_name(table, today + timedelta(days=days)), names)
+        self.assertFalse(
+            Delivery.objects.filter(
+                fired_at__lt=timezone.now() - timedelta(days=6)
+            ).exists()
+        )
+
+
+class TestPartitionedTables(TestCase):
+    def partition_of(self, table, id):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT tableoid::regclass::text FROM {} WHERE id = %s".format(table),
+                [id],
+            )
+            return cursor.fetchone()[0]
+
+    def test_tables_are_partitioned(self):
+        for model in (QueueTaskRun, ScheduleFailure):
+            partitions = list_partitions(model._meta.db_table)
+            # Everything from before the migration is in the first partition
+            self.assertIsNone(partitions[0][1])
+
+    def test_default_partition_moved(self):
+        table = QueueTaskRun._meta.db_table
+        started_at = timezone.now() + timedelta(days=800)
+        run = QueueTaskRun.objects.create(task_id=uuid4(), started_at=started_at)
+        self.assertEqual(self.partition_of(table, run.id), "%s_default" % table)
+
+        start = period_start(started_at, "month")
+        create_partition(table, start, "month")
+
+        self.assertEqual(self.partition_of(table, run.id), partition_name(table, start))
+        QueueTaskRun.objects.filter(id=run.id).update(completed_at=started_at)
+        run.refresh_from_db()
+        self.assertEqual(run.completed_at, started_at)
+
+    def test_failures_partitioned(self):
+        schedule = Schedule.objects.create(
+            cron_definition="25 * * * *", endpoint="http://example.com"
+        )
+        failure = ScheduleFailure.objects.create(
+            schedule=schedule,
+            task_id=uuid4(),
+            initiated_at=timezone.now(),
+            reason="Error",
+        )
+
+        self.assertEqual(ScheduleFailure.objects.get(id=failure.id), failure)
+        schedule.delete()
+        self.assertFalse(ScheduleFailure.objects.filter(id=failure.id).exists())
+
+    def test_manage_partitions(self):
+        manage_partitions.run()
+
+        current = period_start(timezone.now(), "month")
+        for model in (QueueTaskRun, ScheduleFailure):
+            table = model._meta.db_table
+            names = [p[0] for p in list_partitions(table)]
+            self.assertIn(
+                partition_name(table, add_periods(current, "month", 3)), names
+            )
+        names = [p[0] for p in list_partitions(Delivery._meta.db_table)]
+        self.assertIn(
+            partition_name(Delivery._meta.db_table, timezone.now().date()), names
+        )
+
+
+@override_settings(SCHEDULER_REPLICA_DATABASE="postgres://replica/seed_scheduler")
+class TestReplicaRouting(TestCase):
+    def setUp(self):
+        lag_monitor.checked_at = None
+        patcher = mock.patch.object(pinned_clients, "shared_alias", "default")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        pinned_clients.clear()
+        pinned_clients.shared.clear()
+        self.factory = RequestFactory()
+        self.router = ReplicaRouter()
+
+    def request(self, method, token="abc"):
+        request = getattr(self.factory, method)(
+            "/api/v1/schedule/", HTTP_AUTHORIZATION="Token %s" % token
+        )
+        databases = []
+
+        def get_response(request):
+            databases.append(self.router.db_for_read(Schedule))
+            return HttpResponse()
+
+        ReplicaMiddleware(get_response)(request)
+        return databases[0]
+
+    def test_router(self):
+        self.assertEqual(self.router.db_for_read(Schedule), "default")
+        with read_from_replica():
+            self.assertEqual(self.router.db_for_read(Schedule), "replica")
+            self.assertEqual(self.router.db_for_write(Schedule), "default")
+        self.assertEqual(self.router.db_for_read(Schedule), "default")
+        self.assertFalse(self.router.allow_migrate("replica", "scheduler"))
+        self.assertTrue(self.router.allow_migrate("default", "scheduler"))
+
+    @mock.patch("scheduler.tasks.fire_metric.delay")
+    @mock.patch("scheduler.replica.replica_lag", return_value=0.5)
+    def test_reads_from_replica(self, mock_lag, mock_metric):
+        self.assertEqual(self.request("get"), "replica")
+        self.assertEqual(self.request("post"), "default")
+        # The client that wrote reads from the primary for a while, in every
+        # process
+        pinned_clients.clear()
+        self.assertEqual(self.request("get"), "default")
+        self.assertEqual(self.request("get", token="other"), "replica")
+        # The lag is only checked every so often, and isn't reported
+        mock_lag.assert_called_once_with()
+        mock_metric.assert_not_called()
+
+    @override_settings(SCHEDULER_REPLICA_DATABASE=None)
+    def test_no_replica(self):
+        self.assertEqual(self.request("get"), "default")
+        self.assertEqual(fanout_database(), "default")
+
+    @mock.patch("scheduler.replica.replica_lag", return_value=0)
+    def test_no_shared_cache(self, mock_lag):
+        pinned_clients.shared_alias = None
+        self.assertEqual(self.request("get"), "default")
+        with override_settings(SCHEDULER_REPLICA_FANOUT=True):
+            self.assertEqual(fanout_database(), "replica")
+
+    @mock.patch("scheduler.replica.replica_lag", return_value=30)
+    def test_replica_behind(self, mock_lag):
+        self.assertEqual(self.request("get"), "default")
+        with override_settings(SCHEDULER_REPLICA_FANOUT=True):
+            self.assertEqual(fanout_database(), "default")
+
+    @mock.patch("scheduler.tasks.fire_metric.delay")
+    @mock.patch("scheduler.tasks.replica_lag", return_value=30)
+    def test_report_replica_lag(self, mock_lag, mock_metric):
+        self.assertEqual(report_replica_lag.run(), 30)
+        mock_metric.assert_called_once_with("scheduler.replica.lag_seconds.last", 30)
+
+        with override_settings(SCHEDULER_REPLICA_DATABASE=None):
+            self.assertIsNone(report_replica_lag.run())
+        mock_lag.assert_called_once_with()
+
+    @mock.patch("scheduler.replica.replica_lag", return_value=0)
+    def test_fanout_database(self, mock_lag):
+        self.assertEqual(fanout_database(), "default")
+        with override_settings(SCHEDULER_REPLICA_FANOUT=True):
+            self.assertEqual(fanout_database(), "replica")
+            lag_monitor.checked_at = None
+            mock_lag.side_effect = DatabaseError()
+            self.assertEqual(fanout_database(), "default")
+
+
+class TestScheduleArchive(AuthenticatedAPITestCase):
+    def make_disabled(self, days, **kwargs):
+        schedule = Schedule.objects.create(
+            cron_definition="25 * * * *",
+            endpoint="http://example.com",
+            enabled=False,
+            created_by=self.user,
+            **kwargs
+        )
+        Schedule.objects.filter(id=schedule.id).update(
+            updated_at=timezone.now() - timedelta(days=days)
+        )
+        return schedule
+
+    def archived_ids(self):
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT id FROM %s" % ARCHIVE_TABLE)
+            return set(schedule_id for schedule_id, in cursor.fetchall())
+
+    def test_archive(self):
+        old = self.make_disabled(31)
+        ScheduleFailure.objects.create(
+            schedule=old, task_id=uuid4(), initiated_at=timezone.now(), reason="Error"
+        )
+        recent = self.make_disabled(29)
+        enabled = self.make_schedule()
+        Schedule.objects.filter(id=enabled.id).update(
+            updated_at=timezone.now() - timedelta(days=31)
+        )
+
+        self.assertEqual(archive_schedules.run(), 1)
+
+        self.assertEqual(self.archived_ids(), set([old.id]))
+        self.assertEqual(
+            set(Schedule.objects.values_list("id", flat=True)),
+            set([recent.id, enabled.id]),
+        )
+        self.assertFalse(ScheduleFailure.objects.exists())
+
+    @override_settings(SCHEDULER_BULK_BATCH_SIZE=2)
+    def test_archive_in_batches(self):
+        for _ in range(5):
+            self.make_disabled(31)
+
+        self.assertEqual(archive_schedules.run(), 5)
+        self.assertEqual(len(self.archived_ids()), 5)
+
+    @override_settings(SCHEDULER_ARCHIVE_AFTER_DAYS=0)
+    def test_archive_off(self):
+        self.make_disabled(365)
+
+        self.assertEqual(archive_schedules.run(), 0)
+        self.assertEqual(Schedule.objects.count(), 1)
+
+    def test_restore_on_enable(self):
+        schedule = self.make_disabled(31)
+        archive_schedules.run()
+        url = "/api/v1/schedule/%s/" % schedule.id
+
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        response = self.client.patch(
+            url, json.dumps({"payload": {}}), content_type="application/json"
+        )
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+        # The crontab is cleaned up while the schedule is archived
+        CrontabSchedule.objects.all().delete()
+        response = self.client.patch(
+            url, json.dumps({"enabled": True}), content_type="application/json"
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(self.archived_ids(), set())
+        schedule.refresh_from_db()
+        self.assertTrue(schedule.enabled)
+        self.assertEqual(schedule.created_by, self.user)
+        self.assertEqual(schedule.celery_cron_definition.minute, "25")
+
+    def test_bulk_restore(self):
+        schedules = [self.make_disabled(31) for _ in range(2)]
+        archive_schedules.run()
+
+        response = self.client.patch(
+            "/api/v1/schedule/bulk/",
+            json.dumps(
+                [
+                    {"id": str(schedules[0].id), "enabled": True},
+                    {"id": str(schedules[1].id), "payload": {}},
+                ]
+            ),
+            content_type="application/json",
+        )
+
+        self.assertEqual(response.json()["updated"], 1)
+        self.assertEqual(response.json()["errors"][0]["index"], 1)
+        self.assertEqual(self.archived_ids(), set([schedules[1].id]))
+        self.assertTrue(Schedule.objects.get(id=schedules[0].id).enabled)
+
+    def test_sync_restores(self):
+        schedule = self.make_disabled(31, external_id="sub-1")
+        archive_schedules.run()
+
+        response = self.client.post(
+            "/api/v1/schedule/sync/",
+            json.dumps(
+                [
+                    {
+                        "external_id": "sub-1",
+                        "cron_definition": "25 * * * *",
+                        "endpoint": "http://example.com",
+                    }
+                ]
+            ),
+            content_type="application/json",
+        )
+
+        self.assertEqual(response.json()["created"], 0)
+        self.assertEqual(response.json()["updated"], 1)
+        self.assertEqual(self.archived_ids(), set())
+        self.assertTrue(Schedule.objects.get(id=schedule.id).enabled)
+
+    def test_delete_archived(self):
+        schedules = [self.make_disabled(31) for _ in range(3)]
+        archive_schedules.run()
+        url = "/api/v1/schedule/%s/" % schedules[0].id
+
+        response = self.client.delete(url)
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+        response = self.client.delete(url)
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+        response = self.client.delete(
+            "/api/v1/schedule/bulk/",
+            json.dumps([str(schedule.id) for schedule in schedules]),
+            content_type="application/json",
+        )
+        self.assertEqual(response.json()["deleted"], 2)
+        self.assertEqual(response.json()["errors"][0]["index"], 0)
+        self.assertEqual(self.archived_ids(), set())
+
+    def test_export_archived(self):
+        archived = self.make_disabled(31, external_id="sub-1")
+        archive_schedules.run()
+        self.make_disabled(31, external_id="sub-2")
+        self.assertEqual(
+            list(ScheduleArchive.objects.values_list("id", "enabled")),
+            [(archived.id, False)],
+        )
+
+        def export(query):
+            response = self.client.get("/api/v1/schedule/export/%s" % query)
+            content = b"".join(response.streaming_content)
+            return [json.loads(line) for line in content.splitlines()]
+
+        rows = export("?enabled=false")
+        self.assertEqual([row["external_id"] for row in rows], ["sub-2", "sub-1"])
+        self.assertEqual(rows[1]["id"], str(archived.id))
+        rows = export("?external_id=sub-1")
+        self.assertEqual([row["id"] for row in rows], [str(archived.id)])
+
+
+class TestScheduleEndConditions(AuthenticatedAPITestCase):
+    def queue(self):
+        with mock.patch("scheduler.tasks.DeliverTask.apply_async") as deliver:
+            queue_tasks.queue_schedules(Schedule.objects.all())
+        return set(call[1]["kwargs"]["schedule_id"] for call in deliver.call_args_list)
+
+    def test_max_runs(self):
+        schedule = self.make_schedule()
+        Schedule.objects.filter(id=schedule.id).update(max_runs=2)
+        unlimited = self.make_schedule()
+
+        self.assertEqual(self.queue(), set([str(schedule.id), str(unlimited.id)]))
+        schedule.refresh_from_db()
+        self.assertEqual(schedule.triggered, 1)
+        self.assertTrue(schedule.enabled)
+
+        self.assertEqual(self.queue(), set([str(schedule.id), str(unlimited.id)]))
+        schedule.refresh_from_db()
+        self.assertEqual(schedule.triggered, 2)
+        self.assertFalse(schedule.enabled)
+
+        self.assertEqual(self.queue(), set([str(unlimited.id)]))
+        unlimited.refresh_from_db()
+        self.assertEqual(unlimited.triggered, 0)
+        self.assertTrue(unlimited.enabled)
+
+    def test_end_at(self):
+        ended = self.make_schedule()
+        past = timezone.now() - timedelta(minutes=1)
+        Schedule.objects.filter(id=ended.id).update(
+            end_at=past, updated_at=past - timedelta(days=1)
+        )
+        running = self.make_schedule()
+        Schedule.objects.filter(id=running.id).update(
+            end_at=timezone.now() + timedelta(days=1)
+        )
+
+        self.assertEqual(self.queue(), set([str(running.id)]))
+        ended.refresh_from_db()
+        self.assertFalse(ended.enabled)
+        self.assertGreater(ended.updated_at, past)
+        running.refresh_from_db()
+        self.assertTrue(running.enabled)
+        self.assertEqual(running.triggered, 0)
+
+    def test_single_update(self):
+        for _ in range(3):
+            schedule = self.make_schedule()
+            Schedule.objects.filter(id=schedule.id).update(max_runs=1)
+
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(len(self.queue()), 3)
+        updates = [q for q in queries.captured_queries if q["sql"].startswith("UPDATE")]
+        self.assertEqual(len(updates), 1)
+        self.assertFalse(Schedule.objects.filter(enabled=True).exists())
+
+    def test_only_queued_counted(self):
+        schedule = self.make_schedule()
+        Schedule.objects.filter(id=schedule.id).update(max_runs=2)
+        added = []
+
+        def add_schedule(**kwargs):
+            # A schedule that is added after the schedules were read
+            if not added:
+                added.append(self.make_schedule())
+                Schedule.objects.filter(id=added[0].id).update(max_runs=2)
+
+        with mock.patch(
+            "scheduler.tasks.DeliverTask.apply_async", side_effect=add_schedule
+        ):
+            self.assertEqual(queue_tasks.queue_schedules(Schedule.objects.all()), 1)
+
+        schedule.refresh_from_db()
+        self.assertEqual(schedule.triggered, 1)
+        added[0].refresh_from_db()
+        self.assertEqual(added[0].triggered, 0)
+
+    def test_create(self):
+        post_data = {
+            "cron_definition": "25 * * * *",
+            "endpoint": "http://example.com",
+            "payload": {},
+            "end_at": "2030-01-01T00:00:00Z",
+            "max_runs": 3,
+        }
+        response = self.client.post(
+            "/api/v1/schedule/", json.dumps(post_data), content_type="application/json"
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data["max_runs"], 3)
+        self.assertEqual(response.data["triggered"], 0)
+        d = Schedule.objects.get(id=response.data["id"])
+        self.assertEqual(d.end_at, datetime(2030, 1, 1, tzinfo=timezone.utc))
+
+        post_data["max_runs"] = 0
+        response = self.client.post(
+            "/api/v1/schedule/", json.dumps(post_data), content_type="application/json"
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+def schedule_id_on(alias):
+    """
+    Returns a new schedule id that is stored on the shard `alias`.
+    """
+    while True:
+        schedule_id = uuid4()
+        if shard_for(schedule_id) == alias:
+            return schedule_id
+
+
+def make_sharded_schedule(alias, **kwargs):
+    kwargs.setdefault("cron_definition", "25 * * * *")
+    kwargs.setdefault("endpoint", "http://example.com")
+    return Schedule.objects.create(id=schedule_id_on(alias), **kwargs)
+
+
+@override_settings(SCHEDULER_SHARDS=["default", "shard1"])
+class TestShardedSchedules(AuthenticatedAPITestCase):
+    databases = {"default", "shard1"}
+
+    def test_router(self):
+        router = ShardRouter()
+        schedule = Schedule(id=schedule_id_on("shard1"))
+        failure = ScheduleFailure(schedule=schedule)
+        self.assertEqual(router.db_for_write(Schedule, instance=schedule), "shard1")
+        self.assertEqual(
+            router.db_for_read(ScheduleFailure, instance=schedule), "shard1"
+        )
+        self.assertEqual(router.db_for_read(Schedule, instance=failure), "shard1")
+        self.assertIsNone(router.db_for_read(User, instance=schedule))
+        self.assertIsNone(router.db_for_read(Schedule))
+        with override_settings(SCHEDULER_SHARDS=["default"]):
+            self.assertIsNone(router.db_for_write(Schedule, instance=schedule))
+
+    def test_create_on_shard(self):
+        response = self.client.post(
+            "/api/v1/schedule/",
+            json.dumps(
+                {"cron_definition": "25 * * * *", "endpoint": "http://example.com"}
+            ),
+            content_type="application/json",
+        )
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+        schedule_id = response.json()["id"]
+        alias = shard_for(schedule_id)
+        other = "default" if alias == "shard1" else "shard1"
+        self.assertTrue(Schedule.objects.using(alias).filter(id=schedule_id).exists())
+        self.assertFalse(Schedule.objects.using(other).filter(id=schedule_id).exists())
+
+    def test_detail_on_shard(self):
+        schedule = make_sharded_schedule("shard1", created_by=self.user)
+        url = "/api/v1/schedule/%s/" % schedule.id
+
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.json()["id"], str(schedule.id))
+
+        response = self.client.patch(
+            url, json.dumps({"enabled": False}), content_type="application/json"
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        schedule.refresh_from_db()
+        self.assertFalse(schedule.enabled)
+        self.assertEqual(schedule.updated_by, self.user)
+
+        response = self.client.delete(url)
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertFalse(Schedule.objects.using("shard1").exists())
+
+    def test_list_merges_shards(self):
+        schedules = []
+        for day, alias in enumerate(["default", "shard1", "shard1", "default"], 1):
+            with freeze_time("2026-01-%02d" % day):
+                schedules.append(make_sharded_schedule(alias))
+
+        ids = []
+        url = "/api/v1/schedule/"
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            ids.extend(result["id"] for result in response.json()["results"])
+            url = response.json()["next"]
+
+        self.assertEqual(ids, [str(s.id) for s in reversed(schedules)])
+
+    def test_bulk_on_shards(self):
+        response = self.client.post(
+            "/api/v1/schedule/bulk/",
+            json.dumps(
+                [{"interval_definition": "1 minutes", "endpoint": "http://example.com"}]
+                * 6
+            ),
+            content_type="application/json",
+        )
+        ids = response.json()["ids"]
+        self.assertEqual(len(ids), 6)
+        for schedule_id in ids:
+            self.assertTrue(
+                Schedule.objects.using(shard_for(schedule_id))
+                .filter(id=schedule_id)
+                .exists()
+            )
+
+        response = self.client.patch(
+            "/api/v1/schedule/bulk/",
+            json.dumps([{"id": schedule_id, "enabled": False} for schedule_id in ids]),
+            content_type="application/json",
+        )
+        self.assertEqual(response.json()["updated"], 6)
+
+        response = self.client.delete(
+            "/api/v1/schedule/bulk/", json.dumps(ids), content_type="application/json"
+        )
+        self.assertEqual(response.json()["deleted"], 6)
+
+    def test_sync_unavailable(self):
+        response = self.client.post(
+            "/api/v1/schedule/sync/", json.dumps([]), content_type="application/json"
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_failures_on_shard(self):
+        schedule = make_sharded_schedule("shard1")
+        failure = ScheduleFailure.objects.create(
+            schedule=schedule,
+            task_id=uuid4(),
+            initiated_at=timezone.now(),
+            reason="Error",
+        )
+        self.assertTrue(
+            ScheduleFailure.objects.using("shard1").filter(id=failure.id).exists()
+        )
+
+        response = self.client.get("/api/v1/failed-tasks/")
+        [result] = response.json()["results"]
+        self.assertEqual(result["id"], failure.id)
+        self.assertTrue(result["schedule"].endswith("/%s/" % schedule.id))
+        response = self.client.get("/api/v1/failed-tasks/%s/" % failure.id)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        with mock.patch("scheduler.tasks.DeliverTask.apply_async") as mock_deliver:
+            requeue_failed_tasks.run()
+        mock_deliver.assert_called_once_with(
+            kwargs={
+                "schedule_id": str(schedule.id),
+                "auth_token": None,
+                "endpoint": "http://example.com",
+                "payload": {},
+            }
+        )
+        self.assertFalse(ScheduleFailure.objects.using("shard1").exists())
+
+    def test_failure_ids_interleaved(self):
+        table = ScheduleFailure._meta.db_table
+        failures = []
+        for alias in ("default", "shard1"):
+            interleave_ids(table, alias)
+            self.assertFalse(interleave_ids(table, alias))
+            for _ in range(2):
+                failures.append(
+                    ScheduleFailure.objects.create(
+                        schedule=make_sharded_schedule(alias),
+                        task_id=uuid4(),
+                        initiated_at=timezone.now(),
+                        reason="Error",
+                    )
+                )
+
+        self.assertEqual([f.id % 2 for f in failures], [1, 1, 0, 0])
+        ids = []
+        url = "/api/v1/failed-tasks/"
+        while url:
+            response = self.client.get(url)
+            ids.extend(result["id"] for result in response.json()["results"])
+            url = response.json()["next"]
+        self.assertEqual(ids, sorted((f.id for f in failures), reverse=True))
+        for failure in failures:
+            response = self.client.get("/api/v1/failed-tasks/%s/" % failure.id)
+            self.assertEqual(
+                response.json()["schedule"].split("/")[-2], str(failure.schedule_id)
+            )
+
+    @override_settings(SCHEDULER_DELIVERY_LEDGER=False)
+    def test_delivery_stats_on_shard(self):
+        schedules = [make_sharded_schedule(alias) for alias in ("default", "shard1")]
+        stats = DeliveryStats()
+        for schedule in schedules:
+            stats.add(schedule.id, 200, 0.1, run_at=timezone.now())
+
+        self.assertEqual(stats.flush(), 2)
+        for schedule in schedules:
+            schedule.refresh_from_db()
+            self.assertEqual(schedule.success_count, 1)
+
+
+@override_settings(SCHEDULER_SHARDS=["default", "shard1"])
+class TestShardedFanout(TransactionTestCase):
+    # The shards are scanned by other threads, which only see committed rows
+    databases = {"default", "shard1"}
+
+    def test_queue_schedules(self):
+        schedules = [
+            make_sharded_schedule(alias)
+            for alias in ("default", "shard1", "shard1", "default")
+        ]
+        make_sharded_schedule("shard1", enabled=False)
+
+        with mock.patch("scheduler.tasks.DeliverTask.apply_async") as mock_deliver:
+            queued = queue_tasks.queue_schedules(Schedule.objects.all())
+
+        self.assertEqual(queued, 4)
+        self.assertEqual(
+            sorted(
+                call[1]["kwargs"]["schedule_id"] for call in mock_deliver.call_args_list
+            ),
+            sorted(str(schedule.id) for schedule in schedules),
+        )
@@ -9,6 +9,7 @@ router.register(r"group", views.GroupViewSet)
 router.register(r"schedule", views.ScheduleViewSet)
 router.register(r"webhook", views.HookViewSet)
 router.register(r"failed-tasks", views.FailedTaskViewSet)
+router.register(r"deliveries", views.DeliveryViewSet)
 
 # Wire up our API using automatic URL routing.
 # Additionally, we include login URLs for the browseable API.
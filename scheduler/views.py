@@ -1,23 +1,56 @@
+from itertools import chain
+
+import django
+import rest_framework
+from django.conf import settings
 from django.contrib.auth.models import Group, User
+from django.db import transaction
+from django.http import Http404, StreamingHttpResponse
+from django.utils import timezone
 from rest_framework import mixins, status, viewsets
 from rest_framework.authtoken.models import Token
+from rest_framework.decorators import action
+from rest_framework.exceptions import ValidationError
+from rest_framework.generics import get_object_or_404
 from rest_framework.pagination import CursorPagination
+from rest_framework.parsers import JSONParser
 from rest_framework.permissions import IsAdminUser, IsAuthenticated
 from rest_framework.response import Response
 from rest_framework.views import APIView
 from rest_hooks.models import Hook
 
+import seed_scheduler
 from seed_scheduler.utils import get_available_metrics
 
-from .models import Schedule, ScheduleFailure
+from .archive import delete_archived_schedules, enables, restore_schedules
+from .bulk import (
+    bulk_create_schedules,
+    bulk_delete_schedules,
+    bulk_update_schedules,
+    sync_schedules,
+    validate_creates,
+    validate_deletes,
+    validate_updates,
+)
+from .export import EXPORT_FORMATS, export_querysets, iter_schedule_rows
+from .filters import DeliveryFilter, ScheduleFilter
+from .forecast import forecast
+from .importer import IMPORT_FORMATS, import_schedules
+from .models import Delivery, Schedule, ScheduleFailure
+from .parsers import NDJSONParser, iter_ndjson
 from .serializers import (
     CreateUserSerializer,
+    DeliverySerializer,
+    ForecastSerializer,
     GroupSerializer,
     HookSerializer,
     ScheduleFailureSerializer,
     ScheduleSerializer,
+    ScheduleSyncSerializer,
+    ScheduleValuesSerializer,
     UserSerializer,
 )
+from .shards import merged, on_shard, sharded, shards_for_id
 from .tasks import requeue_failed_tasks
 
 # Uncomment line below if scheduled metrics are added
@@ -32,6 +65,21 @@ class IdCursorPagination(CursorPagination):
     ordering = "-id"
 
 
+class FiredAtCursorPagination(CursorPagination):
+    ordering = "-fired_at"
+
+
+class ShardedListMixin(object):
+
+    """
+    Pages through the listed rows of every shard, merged in the pagination
+    order.
+    """
+
+    def paginate_queryset(self, queryset):
+        return super(ShardedListMixin, self).paginate_queryset(merged(queryset))
+
+
 class HookViewSet(viewsets.ModelViewSet):
     """
     Retrieve, create, update or destroy webhooks.
@@ -93,7 +141,7 @@ class UserView(APIView):
         return Response(status=status.HTTP_201_CREATED, data={"token": token.key})
 
 
-class ScheduleViewSet(viewsets.ModelViewSet):
+class ScheduleViewSet(ShardedListMixin, viewsets.ModelViewSet):
 
     """
     API endpoint that allows schedule models to be viewed or edited.
@@ -103,13 +151,232 @@ class ScheduleViewSet(viewsets.ModelViewSet):
     queryset = Schedule.objects.all()
     serializer_class = ScheduleSerializer
     pagination_class = CreatedAtCursorPagination
+    filterset_class = ScheduleFilter
+
+    def get_queryset(self):
+        queryset = super(ScheduleViewSet, self).get_queryset()
+        # A single schedule is only looked for on its own shard
+        lookup = self.kwargs.get(self.lookup_url_kwarg or self.lookup_field)
+        if lookup is None:
+            return queryset
+        return on_shard(queryset, lookup)
+
+    def get_object(self):
+        try:
+            return super(ScheduleViewSet, self).get_object()
+        except Http404:
+            # Archived schedules are restored when they are enabled again
+            if self.request.method not in ("PUT", "PATCH") or not enables(
+                self.request.data
+            ):
+                raise
+        lookup_url_kwarg = self.lookup_url_kwarg or self.lookup_field
+        try:
+            restored = restore_schedules([self.kwargs[lookup_url_kwarg]])
+        except ValueError:
+            restored = None
+        if not restored:
+            raise Http404
+        return super(ScheduleViewSet, self).get_object()
+
+    def destroy(self, request, *args, **kwargs):
+        try:
+            return super(ScheduleViewSet, self).destroy(request, *args, **kwargs)
+        except Http404:
+            # Archived schedules are deleted from the archive
+            lookup_url_kwarg = self.lookup_url_kwarg or self.lookup_field
+            try:
+                deleted = delete_archived_schedules([self.kwargs[lookup_url_kwarg]])
+            except ValueError:
+                deleted = 0
+            if not deleted:
+                raise
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+    def check_unsharded(self, action):
+        if sharded():
+            raise ValidationError(
+                "%s isn't available when schedules are sharded." % action
+            )
 
     def perform_create(self, serializer):
-        serializer.save(created_by=self.request.user, updated_by=self.request.user)
+        # The schedule.added webhooks are written to the outbox along with
+        # the schedule
+        with transaction.atomic():
+            serializer.save(created_by=self.request.user, updated_by=self.request.user)
 
     def perform_update(self, serializer):
         serializer.save(updated_by=self.request.user)
 
+    def get_values_fields(self):
+        """
+        Returns the fields requested with ?fields=, or all of the fields.
+        """
+        fields = ScheduleSerializer.Meta.fields
+        names = [
+            name.strip()
+            for name in self.request.query_params.get("fields", "").split(",")
+            if name.strip()
+        ]
+        unknown = [name for name in names if name not in fields]
+        if unknown:
+            raise ValidationError(
+                {"fields": ["Unknown fields: %s" % ", ".join(unknown)]}
+            )
+        return names or fields
+
+    def get_values_serializer(self, *args, **kwargs):
+        kwargs["context"] = self.get_serializer_context()
+        return ScheduleValuesSerializer(*args, **kwargs)
+
+    def list(self, request, *args, **kwargs):
+        """
+        Lists schedules from values() rows rather than model instances, with
+        only the columns needed for the ?fields= requested.
+        """
+        fields = self.get_values_fields()
+        # The pagination cursor is taken from created_at
+        columns = set(ScheduleValuesSerializer.columns(fields)) | set(["created_at"])
+        queryset = self.filter_queryset(self.get_queryset()).values(*columns)
+
+        page = self.paginate_queryset(queryset)
+        if page is not None:
+            serializer = self.get_values_serializer(page, many=True, fields=fields)
+            return self.get_paginated_response(serializer.data)
+        serializer = self.get_values_serializer(queryset, many=True, fields=fields)
+        return Response(serializer.data)
+
+    def retrieve(self, request, *args, **kwargs):
+        fields = self.get_values_fields()
+        queryset = self.filter_queryset(self.get_queryset()).values(
+            *ScheduleValuesSerializer.columns(fields)
+        )
+        lookup_url_kwarg = self.lookup_url_kwarg or self.lookup_field
+        row = get_object_or_404(
+            queryset, **{self.lookup_field: kwargs[lookup_url_kwarg]}
+        )
+        return Response(self.get_values_serializer(row, fields=fields).data)
+
+    @action(
+        detail=False,
+        methods=["post", "patch", "delete"],
+        parser_classes=(JSONParser, NDJSONParser),
+    )
+    def bulk(self, request):
+        """
+        Creates (POST), updates (PATCH) or deletes (DELETE) many schedules
+        from a JSON list or newline delimited JSON. Valid items are written,
+        and the errors for invalid items are returned with their index.
+        """
+        items = request.data
+        if not isinstance(items, list):
+            raise ValidationError("Expected a list of items.")
+
+        if request.method == "POST":
+            data, errors = validate_creates(self.get_serializer(), items)
+            schedules = bulk_create_schedules(data, request.user)
+            resp = {
+                "created": len(schedules),
+                "ids": [str(schedule.id) for schedule in schedules],
+                "errors": errors,
+            }
+            status = 201
+        elif request.method == "PATCH":
+            updates, errors = validate_updates(self.get_serializer(partial=True), items)
+            schedules = bulk_update_schedules(updates, request.user)
+            resp = {"updated": len(schedules), "errors": errors}
+            status = 200
+        else:
+            ids, errors = validate_deletes(items)
+            resp = {"deleted": bulk_delete_schedules(ids), "errors": errors}
+            status = 200
+
+        if errors and len(errors) == len(items):
+            status = 400
+        return Response(resp, status=status)
+
+    @action(detail=False, methods=["post"], parser_classes=(JSONParser, NDJSONParser))
+    def sync(self, request):
+        """
+        Makes this user's schedules with an external_id match the given set
+        of schedules, from a JSON list or streamed newline delimited JSON.
+        """
+        if request.content_type.startswith(NDJSONParser.media_type):
+            items = iter_ndjson(request.stream)
+        else:
+            items = request.data
+            if not isinstance(items, list):
+                raise ValidationError("Expected a list of items.")
+
+        # External ids are only unique on each shard
+        self.check_unsharded("Syncing")
+        serializer = ScheduleSyncSerializer(context=self.get_serializer_context())
+        resp = sync_schedules(serializer, items, request.user)
+        return Response(resp, status=200)
+
+    @action(detail=False, methods=["get"])
+    def export(self, request):
+        """
+        Streams all of the schedules matching the list filters, followed by
+        the archived ones, as newline delimited JSON, or as CSV with
+        ?output=csv. Sharded schedules are streamed one shard after the other.
+        """
+        output = request.query_params.get("output", "ndjson")
+        if output not in EXPORT_FORMATS:
+            raise ValidationError(
+                {"output": ["Must be one of: %s" % ", ".join(sorted(EXPORT_FORMATS))]}
+            )
+        content_type, lines = EXPORT_FORMATS[output]
+        rows = chain.from_iterable(
+            iter_schedule_rows(queryset, settings.SCHEDULER_BULK_BATCH_SIZE)
+            for queryset in export_querysets(
+                self.filter_queryset(self.get_queryset()), request.query_params
+            )
+        )
+        response = StreamingHttpResponse(lines(rows), content_type=content_type)
+        response["Content-Disposition"] = 'attachment; filename="schedules.%s"' % (
+            output,
+        )
+        return response
+
+    @action(detail=False, methods=["get"], permission_classes=(IsAdminUser,))
+    def forecast(self, request):
+        """
+        Returns the expected number of deliveries in each minute, from ?start
+        (defaults to now) for ?minutes (defaults to a day), for all of the
+        enabled schedules. Only admin users can see this, since it covers
+        every user's schedules.
+        """
+        serializer = ForecastSerializer(data=request.query_params)
+        serializer.is_valid(raise_exception=True)
+        start = serializer.validated_data.get("start") or timezone.now()
+        resp = forecast(start, serializer.validated_data["minutes"])
+        return Response(resp, status=200)
+
+    @action(
+        detail=False,
+        methods=["post"],
+        url_path="import",
+        url_name="import",
+        permission_classes=(IsAdminUser,),
+    )
+    def load(self, request):
+        """
+        Loads schedules from streamed newline delimited JSON, or CSV with a
+        text/csv content type, in the format of the export. Only admin users
+        can do this, since ids and timestamps are kept as they are.
+        """
+        # Each chunk is loaded in a single transaction, which can't span shards
+        self.check_unsharded("Importing")
+        if request.stream is None:
+            raise ValidationError("Expected newline delimited JSON or CSV.")
+        if request.content_type.startswith("text/csv"):
+            rows = IMPORT_FORMATS["csv"](request.stream)
+        else:
+            rows = IMPORT_FORMATS["ndjson"](request.stream)
+        resp = import_schedules(rows, request.user)
+        return Response(resp, status=200)
+
 
 class MetricsView(APIView):
 
@@ -142,10 +409,6 @@ class HealthcheckView(APIView):
     permission_classes = (IsAuthenticated,)
 
     def get(self, request, *args, **kwargs):
-        import seed_scheduler
-        import django
-        import rest_framework
-
         status = 200
         resp = {
             "up": True,
@@ -162,15 +425,52 @@ class HealthcheckView(APIView):
 
 
 class FailedTaskViewSet(
-    mixins.ListModelMixin, mixins.RetrieveModelMixin, viewsets.GenericViewSet
+    ShardedListMixin,
+    mixins.ListModelMixin,
+    mixins.RetrieveModelMixin,
+    viewsets.GenericViewSet,
 ):
     permission_classes = (IsAuthenticated,)
     queryset = ScheduleFailure.objects.all()
     serializer_class = ScheduleFailureSerializer
     pagination_class = IdCursorPagination
 
+    def get_object(self):
+        if not sharded():
+            return super(FailedTaskViewSet, self).get_object()
+        # Each shard's sequence hands out different failure ids, so the shard
+        # that the id comes from is looked in first
+        lookup_url_kwarg = self.lookup_url_kwarg or self.lookup_field
+        failure_id = self.kwargs[lookup_url_kwarg]
+        try:
+            aliases = shards_for_id(failure_id)
+        except ValueError:
+            raise Http404
+        filter_kwargs = {self.lookup_field: failure_id}
+        queryset = self.filter_queryset(self.get_queryset())
+        for alias in aliases:
+            obj = queryset.using(alias).filter(**filter_kwargs).first()
+            if obj is not None:
+                self.check_object_permissions(self.request, obj)
+                return obj
+        raise Http404
+
     def create(self, request):
         status = 201
         resp = {"requeued_failed_tasks": True}
         requeue_failed_tasks.delay()
         return Response(resp, status=status)
+
+
+class DeliveryViewSet(mixins.ListModelMixin, viewsets.GenericViewSet):
+
+    """
+    API endpoint that lists a schedule's delivery attempts from the delivery
+    ledger.
+    """
+
+    permission_classes = (IsAuthenticated,)
+    queryset = Delivery.objects.all()
+    serializer_class = DeliverySerializer
+    pagination_class = FiredAtCursorPagination
+    filterset_class = DeliveryFilter
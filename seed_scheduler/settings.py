@@ -10,6 +10,7 @@ https://docs.djangoproject.com/en/1.9/ref/settings/
 
 import mimetypes
 import os
+from datetime import timedelta
 
 import dj_database_url
 import djcelery
@@ -63,6 +64,7 @@ MIDDLEWARE = (
     "django.middleware.common.CommonMiddleware",
     "django.middleware.csrf.CsrfViewMiddleware",
     "django.contrib.auth.middleware.AuthenticationMiddleware",
+    "scheduler.replica.ReplicaMiddleware",
     "django.contrib.messages.middleware.MessageMiddleware",
     "django.middleware.clickjacking.XFrameOptionsMiddleware",
     "django_prometheus.middleware.PrometheusAfterMiddleware",
@@ -85,6 +87,32 @@ DATABASES = {
     )
 }
 
+# A streaming replica of the default database, for read-only API requests and
+# optionally the schedule reads of QueueTasks
+SCHEDULER_REPLICA_DATABASE = os.environ.get("SCHEDULER_REPLICA_DATABASE", None)
+if SCHEDULER_REPLICA_DATABASE:
+    DATABASES["replica"] = dj_database_url.parse(
+        SCHEDULER_REPLICA_DATABASE, engine="django_prometheus.db.backends.postgresql"
+    )
+    DATABASES["replica"]["TEST"] = {"MIRROR": "default"}
+
+# Extra databases that the schedules and their failures are spread across,
+# along with the default database, by a hash of the schedule id
+SCHEDULER_SHARD_DATABASES = [
+    url.strip()
+    for url in os.environ.get("SCHEDULER_SHARD_DATABASES", "").split(",")
+    if url.strip()
+]
+SCHEDULER_SHARDS = ["default"]
+for index, url in enumerate(SCHEDULER_SHARD_DATABASES, 1):
+    alias = "shard%s" % index
+    DATABASES[alias] = dj_database_url.parse(
+        url, engine="django_prometheus.db.backends.postgresql"
+    )
+    SCHEDULER_SHARDS.append(alias)
+
+DATABASE_ROUTERS = ["scheduler.routers.ShardRouter", "scheduler.routers.ReplicaRouter"]
+
 PROMETHEUS_EXPORT_MIGRATIONS = False
 
 
@@ -140,8 +168,8 @@ REST_FRAMEWORK = {
     "DEFAULT_PAGINATION_CLASS": "rest_framework.pagination.CursorPagination",
     "PAGE_SIZE": 1000,
     "DEFAULT_AUTHENTICATION_CLASSES": (
-        "rest_framework.authentication.BasicAuthentication",
-        "rest_framework.authentication.TokenAuthentication",
+        "scheduler.authentication.CachedBasicAuthentication",
+        "scheduler.authentication.CachedTokenAuthentication",
     ),
     "DEFAULT_PERMISSION_CLASSES": ("rest_framework.permissions.IsAuthenticated",),
     "DEFAULT_FILTER_BACKENDS": ("django_filters.rest_framework.DjangoFilterBackend",),
@@ -154,6 +182,7 @@ HOOK_EVENTS = {
 }
 
 HOOK_DELIVERER = "scheduler.tasks.deliver_hook_wrapper"
+HOOK_FINDER = "scheduler.hooks.find_and_fire_hook"
 
 HOOK_AUTH_TOKEN = os.environ.get("HOOK_AUTH_TOKEN", "REPLACEME")
 
@@ -177,10 +206,17 @@ CELERY_CREATE_MISSING_QUEUES = True
 CELERY_ROUTES = {
     "celery.backend_cleanup": {"queue": "mediumpriority"},
     "scheduler.tasks.DeliverHook": {"queue": "priority"},
+    "seed_scheduler.scheduler.tasks.deliver_hooks": {"queue": "priority"},
+    "seed_scheduler.scheduler.tasks.reconcile_periodic_tasks": {
+        "queue": "mediumpriority"
+    },
     "seed_scheduler.scheduler.tasks.queue_tasks": {"queue": "priority"},
     "seed_scheduler.scheduler.tasks.requeue_failed_tasks": {"queue": "priority"},
     "seed_scheduler.scheduler.tasks.deliver_task": {"queue": "lowpriority"},
     "seed_scheduler.scheduler.tasks.fire_metric": {"queue": "metrics"},
+    "seed_scheduler.scheduler.tasks.manage_partitions": {"queue": "mediumpriority"},
+    "seed_scheduler.scheduler.tasks.archive_schedules": {"queue": "mediumpriority"},
+    "seed_scheduler.scheduler.tasks.report_replica_lag": {"queue": "mediumpriority"},
 }
 
 METRICS_REALTIME = [
@@ -192,6 +228,9 @@ METRICS_REALTIME = [
     "scheduler.deliver_task.http_error.404.sum",
     "scheduler.deliver_task.http_error.500.sum",
     "scheduler.deliver_task.timeout.sum",
+    "scheduler.worker.recycled.sum",
+    "scheduler.worker.rss_bytes.last",
+    "scheduler.replica.lag_seconds.last",
 ]
 METRICS_SCHEDULED = []
 METRICS_SCHEDULED_TASKS = []
@@ -200,7 +239,47 @@ CELERY_TASK_SERIALIZER = "json"
 CELERY_RESULT_SERIALIZER = "json"
 CELERY_ACCEPT_CONTENT = ["json"]
 CELERY_IGNORE_RESULT = True
-CELERYD_MAX_TASKS_PER_CHILD = 50
+CELERYD_MAX_TASKS_PER_CHILD = (
+    int(os.environ.get("CELERYD_MAX_TASKS_PER_CHILD", 50)) or None
+)
+
+CELERYBEAT_SCHEDULE = {
+    # Retries the webhook deliveries that failed
+    "deliver-hooks": {
+        "task": "seed_scheduler.scheduler.tasks.deliver_hooks",
+        "schedule": timedelta(
+            seconds=int(os.environ.get("SCHEDULER_HOOK_OUTBOX_INTERVAL", 30))
+        ),
+    },
+    # Cleans up the periodic tasks for definitions that aren't used
+    "reconcile-periodic-tasks": {
+        "task": "seed_scheduler.scheduler.tasks.reconcile_periodic_tasks",
+        "schedule": timedelta(
+            seconds=int(os.environ.get("SCHEDULER_DEFINITION_GC_INTERVAL", 3600))
+        ),
+    },
+    # Creates and drops the partitions of the delivery ledger, QueueTaskRuns
+    # and ScheduleFailures
+    "manage-partitions": {
+        "task": "seed_scheduler.scheduler.tasks.manage_partitions",
+        "schedule": timedelta(
+            seconds=int(os.environ.get("SCHEDULER_PARTITION_INTERVAL", 3600))
+        ),
+    },
+    "archive-schedules": {
+        "task": "seed_scheduler.scheduler.tasks.archive_schedules",
+        "schedule": timedelta(
+            seconds=int(os.environ.get("SCHEDULER_ARCHIVE_INTERVAL", 3600))
+        ),
+    },
+    # Reports the replica's lag, when there is one
+    "report-replica-lag": {
+        "task": "seed_scheduler.scheduler.tasks.report_replica_lag",
+        "schedule": timedelta(
+            seconds=int(os.environ.get("SCHEDULER_REPLICA_LAG_REPORT_INTERVAL", 60))
+        ),
+    },
+}
 
 djcelery.setup_loader()
 
@@ -212,3 +291,99 @@ METRICS_AUTH = (
 
 DEFAULT_REQUEST_TIMEOUT = float(os.environ.get("DEFAULT_REQUEST_TIMEOUT", 30))
 DEFAULT_CLOCK_SKEW_SECONDS = int(os.environ.get("DEFAULT_CLOCK_SKEW_SECONDS", 5))
+
+SCHEDULER_BULK_BATCH_SIZE = int(os.environ.get("SCHEDULER_BULK_BATCH_SIZE", 1000))
+SCHEDULER_BULK_HOOK_BATCH_SIZE = int(
+    os.environ.get("SCHEDULER_BULK_HOOK_BATCH_SIZE", 1000)
+)
+SCHEDULER_IMPORT_CHUNK_SIZE = int(os.environ.get("SCHEDULER_IMPORT_CHUNK_SIZE", 10000))
+SCHEDULER_IMPORT_MAX_ERRORS = int(os.environ.get("SCHEDULER_IMPORT_MAX_ERRORS", 1000))
+
+SCHEDULER_FORECAST_MAX_MINUTES = int(
+    os.environ.get("SCHEDULER_FORECAST_MAX_MINUTES", 10080)
+)
+
+SCHEDULER_AUTH_CACHE_TTL = int(os.environ.get("SCHEDULER_AUTH_CACHE_TTL", 10))
+SCHEDULER_AUTH_SHARED_CACHE = os.environ.get("SCHEDULER_AUTH_SHARED_CACHE", None)
+SCHEDULER_AUTH_SHARED_CACHE_TTL = int(
+    os.environ.get("SCHEDULER_AUTH_SHARED_CACHE_TTL", 60)
+)
+SCHEDULER_HOOK_CACHE_TTL = int(os.environ.get("SCHEDULER_HOOK_CACHE_TTL", 5))
+SCHEDULER_HOOK_SHARED_CACHE = os.environ.get(
+    "SCHEDULER_HOOK_SHARED_CACHE", SCHEDULER_AUTH_SHARED_CACHE
+)
+SCHEDULER_HOOK_SHARED_CACHE_TTL = int(
+    os.environ.get("SCHEDULER_HOOK_SHARED_CACHE_TTL", 60)
+)
+SCHEDULER_HOOK_BATCH_SIZE = int(os.environ.get("SCHEDULER_HOOK_BATCH_SIZE", 100))
+SCHEDULER_HOOK_BATCH_INTERVAL = int(os.environ.get("SCHEDULER_HOOK_BATCH_INTERVAL", 0))
+SCHEDULER_HOOK_OUTBOX_BATCH_SIZE = int(
+    os.environ.get("SCHEDULER_HOOK_OUTBOX_BATCH_SIZE", 100)
+)
+SCHEDULER_HOOK_CONCURRENCY = int(os.environ.get("SCHEDULER_HOOK_CONCURRENCY", 10))
+SCHEDULER_HOOK_MAX_ATTEMPTS = int(os.environ.get("SCHEDULER_HOOK_MAX_ATTEMPTS", 10))
+SCHEDULER_COALESCE_CRONTABS = (
+    os.environ.get("SCHEDULER_COALESCE_CRONTABS", "true").lower() == "true"
+)
+SCHEDULER_DEFINITION_GC_GRACE = int(
+    os.environ.get("SCHEDULER_DEFINITION_GC_GRACE", 86400)
+)
+SCHEDULER_DELIVERY_STATS_INTERVAL = int(
+    os.environ.get("SCHEDULER_DELIVERY_STATS_INTERVAL", 1000)
+)
+SCHEDULER_DELIVERY_LEDGER = (
+    os.environ.get("SCHEDULER_DELIVERY_LEDGER", "true").lower() == "true"
+)
+SCHEDULER_DELIVERY_LEDGER_PRECREATE_DAYS = int(
+    os.environ.get("SCHEDULER_DELIVERY_LEDGER_PRECREATE_DAYS", 7)
+)
+SCHEDULER_DELIVERY_LEDGER_RETENTION_DAYS = int(
+    os.environ.get("SCHEDULER_DELIVERY_LEDGER_RETENTION_DAYS", 90)
+)
+SCHEDULER_REPLICA_FANOUT = (
+    os.environ.get("SCHEDULER_REPLICA_FANOUT", "false").lower() == "true"
+)
+SCHEDULER_REPLICA_MAX_LAG = float(os.environ.get("SCHEDULER_REPLICA_MAX_LAG", 5))
+SCHEDULER_REPLICA_LAG_CHECK_INTERVAL = float(
+    os.environ.get("SCHEDULER_REPLICA_LAG_CHECK_INTERVAL", 5)
+)
+SCHEDULER_REPLICA_PIN_SECONDS = int(os.environ.get("SCHEDULER_REPLICA_PIN_SECONDS", 10))
+SCHEDULER_REPLICA_SHARED_CACHE = os.environ.get(
+    "SCHEDULER_REPLICA_SHARED_CACHE", SCHEDULER_AUTH_SHARED_CACHE
+)
+SCHEDULER_PARTITION_PRECREATE_MONTHS = int(
+    os.environ.get("SCHEDULER_PARTITION_PRECREATE_MONTHS", 3)
+)
+SCHEDULER_QUEUE_TASK_RUN_RETENTION_MONTHS = int(
+    os.environ.get("SCHEDULER_QUEUE_TASK_RUN_RETENTION_MONTHS", 12)
+)
+SCHEDULER_SCHEDULE_FAILURE_RETENTION_MONTHS = int(
+    os.environ.get("SCHEDULER_SCHEDULE_FAILURE_RETENTION_MONTHS", 0)
+)
+SCHEDULER_ARCHIVE_AFTER_DAYS = int(os.environ.get("SCHEDULER_ARCHIVE_AFTER_DAYS", 30))
+
+SCHEDULER_PROFILE_RATE = float(os.environ.get("SCHEDULER_PROFILE_RATE", 0))
+SCHEDULER_PROFILE_TASKS = [
+    name.strip()
+    for name in os.environ.get("SCHEDULER_PROFILE_TASKS", "").split(",")
+    if name.strip()
+]
+SCHEDULER_PROFILE_INTERVAL = float(os.environ.get("SCHEDULER_PROFILE_INTERVAL", 0.005))
+SCHEDULER_PROFILE_DIR = os.environ.get("SCHEDULER_PROFILE_DIR", None)
+SCHEDULER_PROFILE_MAX_BYTES = int(
+    os.environ.get("SCHEDULER_PROFILE_MAX_BYTES", 100 * 1024 * 1024)
+)
+
+SCHEDULER_WORKER_MAX_RSS_BYTES = int(
+    os.environ.get("SCHEDULER_WORKER_MAX_RSS_BYTES", 0)
+)
+SCHEDULER_MEMORY_TRACKING = (
+    os.environ.get("SCHEDULER_MEMORY_TRACKING", "false").lower() == "true"
+)
+SCHEDULER_MEMORY_REPORT_EVERY = int(
+    os.environ.get("SCHEDULER_MEMORY_REPORT_EVERY", 100)
+)
+SCHEDULER_MEMORY_REPORT_TOP = int(os.environ.get("SCHEDULER_MEMORY_REPORT_TOP", 10))
+SCHEDULER_WORKER_PRELOAD = (
+    os.environ.get("SCHEDULER_WORKER_PRELOAD", "true").lower() == "true"
+)
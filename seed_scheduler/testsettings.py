@@ -15,3 +15,12 @@ PASSWORD_HASHERS = ("django.contrib.auth.hashers.MD5PasswordHasher",)
 
 # REST Framework conf defaults
 REST_FRAMEWORK["PAGE_SIZE"] = 2  # noqa: F405
+
+# A second database on the same server for the sharding tests, which turn
+# sharding on with SCHEDULER_SHARDS
+DATABASES["shard1"] = dict(  # noqa: F405
+    DATABASES["default"],  # noqa: F405
+    NAME="%s_shard1" % DATABASES["default"]["NAME"],  # noqa: F405
+)
+SCHEDULER_SHARD_DATABASES = []
+SCHEDULER_SHARDS = ["default"]
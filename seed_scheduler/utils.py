@@ -20,3 +20,15 @@ def calculate_retry_delay(attempt, max_delay=300):
         # and keep the delay nearby the max.
         delay = int(random.uniform(max_delay - 20, max_delay + 20))
     return delay
+
+
+def percentiles(values, points=(50, 95, 99)):
+    """Returns the nearest rank percentiles and the maximum of some
+    values, or None for each if there are no values."""
+    values = sorted(values)
+    result = {}
+    for point in points:
+        index = max(int(round(point / 100.0 * len(values))) - 1, 0)
+        result["p%s" % point] = round(values[index], 3) if values else None
+    result["max"] = round(values[-1], 3) if values else None
+    return result
@@ -48,6 +48,7 @@ setup(
         "crontab==0.22.4",
         "seed-services-client==0.37.0",
         "django_prometheus==1.0.15",
+        "numpy==1.19.5",
     ],
     classifiers=[
         "Development Status :: 4 - Beta",